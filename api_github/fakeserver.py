@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+'''
+Fake GitHub API server (local Twisted site) and checks of the client against it
+
+    python fakeserver.py
+
+Checks:
+    - the same GET twice: the second one is a conditional request, "304 Not Modified" returns the cached body
+    - get_all(): all pages of a list endpoint
+    - rate limit: exhausted quota and Retry-After responses delay the calls instead of failing them,
+      PRIORITY_HIGH calls (commit status posts) are not blocked by calls waiting for the quota reset
+    - commit status updates: coalescing, serialized (ordered) POSTs of the same (sha, context)
+    - checkCommits(): each check uses the response code of its own request
+'''
+
+import hashlib, json, os, sys, time
+from urlparse import parse_qs
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.web import resource, server
+
+import github
+from github import GitHub
+
+USER = 'user'
+REPO = 'repo'
+
+
+class FakeGitHub(resource.Resource):
+    '''
+    Serves:
+        GET  /repos/<user>/<repo>/pulls?per_page=&page=  (Link header, ETag)
+        GET  /repos/<user>/<repo>/commits/<sha>/status?per_page=  (combined status, 404 for unknown sha "missing*")
+        POST /repos/<user>/<repo>/statuses/<sha>  (delayed by 'postDelay' seconds)
+
+    Rate limit: 'limit' requests per 'window' seconds ("304 Not Modified" responses are not counted),
+    403 with "X-RateLimit-Remaining: 0" when the quota is exhausted.
+    'retryAfter' rejects the next request with 403 and Retry-After header (secondary rate limit).
+    '''
+    isLeaf = True
+
+    def __init__(self, pullsCount=250, limit=5000, window=3600):
+        resource.Resource.__init__(self)
+        self.pulls = [dict(number=i, title='PR %d' % i) for i in range(1, pullsCount + 1)]
+        self.statuses = {}  # sha -> [status]
+        self.log = []  # (method, path, response code)
+        self.setRateLimit(limit, window)
+        self.retryAfter = None
+        self.postDelay = 0
+        self.errorBodyDelay = 0  # the body of 404 responses is finished later, after the status line and headers
+        self.postsInFlight = 0
+        self.maxPostsInFlight = 0
+
+    def setRateLimit(self, limit, window, remaining=None):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit if remaining is None else remaining
+        self.reset = int(time.time()) + window
+
+    def checkRateLimit(self):
+        now = time.time()
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = int(now) + self.window
+        headers = {'X-RateLimit-Limit': self.limit, 'X-RateLimit-Reset': self.reset}
+        if self.retryAfter is not None:
+            headers['Retry-After'] = self.retryAfter
+            headers['X-RateLimit-Remaining'] = self.remaining
+            self.retryAfter = None
+            return (403, headers, dict(message='You have exceeded a secondary rate limit'))
+        if self.remaining <= 0:
+            headers['X-RateLimit-Remaining'] = 0
+            return (403, headers, dict(message='API rate limit exceeded'))
+        self.remaining -= 1
+        headers['X-RateLimit-Remaining'] = self.remaining
+        return None
+
+    def render(self, request):
+        path = request.path.rstrip('/').split('/')[1:]
+        rejected = self.checkRateLimit()
+        if rejected is not None:
+            code, headers, data = rejected
+        else:
+            code, headers, data = self.handle(request, path, parse_qs(request.uri.partition('?')[2]))
+            if code == 304:
+                self.remaining += 1
+            headers.update({'X-RateLimit-Limit': self.limit, 'X-RateLimit-Remaining': self.remaining,
+                            'X-RateLimit-Reset': self.reset})
+        request.setResponseCode(code)
+        for k, v in headers.items():
+            request.setHeader(k, str(v))
+        self.log.append((request.method, request.path, code))
+        if code == 304 or data is None:
+            return ''
+        request.setHeader('Content-Type', 'application/json; charset=utf-8')
+        if request.method == 'POST' and self.postDelay:
+            self.postsInFlight += 1
+            self.maxPostsInFlight = max(self.maxPostsInFlight, self.postsInFlight)
+            def finish():
+                self.postsInFlight -= 1
+                request.write(json.dumps(data))
+                request.finish()
+            reactor.callLater(self.postDelay, finish)
+            return server.NOT_DONE_YET
+        if code == 404 and self.errorBodyDelay:
+            body = json.dumps(data)
+            request.write(body[:1])
+            def finishBody():
+                request.write(body[1:])
+                request.finish()
+            reactor.callLater(self.errorBodyDelay, finishBody)
+            return server.NOT_DONE_YET
+        return json.dumps(data)
+
+    def handle(self, request, path, args):
+        if request.method == 'GET' and path == ['repos', USER, REPO, 'pulls']:
+            return self.getPage(request, args, self.pulls)
+        if request.method == 'GET' and path[:4] == ['repos', USER, REPO, 'commits'] and path[5:] == ['status']:
+            if path[4].startswith('missing'):
+                return (404, {}, dict(message='No commit found for SHA: %s' % path[4]))
+            latest = {}
+            for status in self.statuses.get(path[4], []):
+                latest[status['context']] = status
+            perPage = int(args.get('per_page', ['30'])[0])
+            statuses = sorted(latest.values(), key=lambda s: s['context'])
+            return (200, {}, dict(sha=path[4], statuses=statuses[:perPage], total_count=len(statuses)))
+        if request.method == 'POST' and path[:-1] == ['repos', USER, REPO, 'statuses']:
+            request.content.seek(0)
+            status = json.loads(request.content.read())
+            self.statuses.setdefault(path[-1], []).append(status)
+            status.setdefault('description', None)
+            status.setdefault('target_url', None)
+            return (201, {}, status)
+        return (404, {}, dict(message='Not Found'))
+
+    def getPage(self, request, args, items):
+        perPage = int(args.get('per_page', ['30'])[0])
+        page = int(args.get('page', ['1'])[0])
+        lastPage = max(1, (len(items) + perPage - 1) // perPage)
+        data = items[(page - 1) * perPage:page * perPage]
+        headers = {}
+        if lastPage > 1:
+            url = 'http://%s%s?per_page=%d&page=%%d' % (request.getHeader('host'), request.path, perPage)
+            links = []
+            if page < lastPage:
+                links.append('<%s>; rel="next"' % (url % (page + 1)))
+            links.append('<%s>; rel="last"' % (url % lastPage))
+            headers['Link'] = ', '.join(links)
+        etag = '"%s"' % hashlib.sha1(json.dumps(data)).hexdigest()
+        headers['ETag'] = etag
+        if request.getHeader('if-none-match') == etag:
+            return (304, headers, None)
+        return (200, headers, data)
+
+
+def startServer(site):
+    port = reactor.listenTCP(0, server.Site(site), interface='127.0.0.1')
+    github.GITHUB_URL = 'http://127.0.0.1:%d' % port.getHost().port
+    return port
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print 'OK: %s' % message
+
+
+@defer.inlineCallbacks
+def checkConditionalGET(fake, async):
+    mode = 'async' if async else 'sync'
+    gh = GitHub('Test', async=async)
+    call = lambda: gh.repos(USER)(REPO).pulls.get(per_page=10)
+    if not async:
+        call = lambda fn=call: threads.deferToThread(fn)
+    del fake.log[:]
+    first = yield call()
+    second = yield call()
+    check([c for _, _, c in fake.log] == [200, 304], '%s: the same GET twice is a conditional request' % mode)
+    check(first == second and len(second) == 10, '%s: 304 response returns the cached body' % mode)
+    check(gh._cache.hits == 1, '%s: cache hit is counted' % mode)
+    del second[:]
+    second[0:0] = [dict(number=-1)]
+    third = yield call()
+    check(third == first and third is not first, '%s: changes of the returned data don\'t affect the cached body' % mode)
+
+
+@defer.inlineCallbacks
+def checkGetAll(fake, async):
+    mode = 'async' if async else 'sync'
+    gh = GitHub('Test', async=async)
+    call = lambda: gh.repos(USER)(REPO).pulls.get_all(per_page=100)
+    if not async:
+        call = lambda fn=call: threads.deferToThread(fn)
+    items = yield call()
+    check([pr['number'] for pr in items] == [pr['number'] for pr in fake.pulls], '%s: get_all() receives all pages' % mode)
+    del fake.log[:]
+    items = yield call()
+    check(len(items) == len(fake.pulls) and all(c == 304 for _, _, c in fake.log),
+          '%s: repeated get_all() is served by conditional requests' % mode)
+
+
+@defer.inlineCallbacks
+def checkRateLimitExhausted(fake):
+    gh = GitHub('Test', async=True)
+    scheduler = gh._scheduler
+    fake.setRateLimit(3, 2)
+    del fake.log[:]
+    # different URLs: responses are not served from the cache
+    results = yield defer.DeferredList([gh.repos(USER)(REPO).pulls.get(per_page=1, page=i) for i in range(1, 7)])
+    check(all(success for success, _ in results), 'exhausted quota: all calls succeed after the limit reset')
+    check(any(c == 403 for _, _, c in fake.log), 'exhausted quota: server rejected calls')
+    check(scheduler.stats['retries'] > 0 and scheduler.stats['delayed'] > 0, 'exhausted quota: calls are retried and delayed')
+
+
+@defer.inlineCallbacks
+def checkRetryAfter(fake):
+    gh = GitHub('Test', async=True)
+    fake.setRateLimit(5000, 3600)
+    fake.retryAfter = 1
+    start = time.time()
+    data = yield gh.repos(USER)(REPO).pulls.get(per_page=1, page=10)
+    check(data is not None and time.time() - start >= 1, 'Retry-After: call is repeated after the delay')
+
+
+@defer.inlineCallbacks
+def checkHighPriority(fake):
+    gh = GitHub('Test', async=True)
+    scheduler = gh._scheduler
+    # below the reserve of PRIORITY_HIGH calls: others wait for the reset, PRIORITY_HIGH calls are paced only
+    fake.setRateLimit(5000, 5, remaining=scheduler.reserve - 9)
+    yield gh.repos(USER)(REPO).pulls.get(per_page=1, page=20)
+    done = []
+    start = time.time()
+    low = gh.repos(USER)(REPO).pulls.get(per_page=1, page=21, _priority=github.PRIORITY_LOW)
+    low.addCallback(lambda _: done.append('low'))
+    high = gh.repos(USER)(REPO).statuses('0123abcd').post(state='success', context='test')
+    high.addCallback(lambda _: done.append('high'))
+    yield high
+    check(time.time() - start < 2 and done == ['high'], 'PRIORITY_HIGH call is not blocked by the timer of the limit reset')
+    yield low
+    check(done == ['high', 'low'], 'PRIORITY_LOW call is done after the limit reset')
+    check(fake.statuses['0123abcd'][0]['state'] == 'success', 'commit status is posted')
+
+
+@defer.inlineCallbacks
+def checkCommitStatusUpdates(fake):
+    gh = GitHub('Test', async=True)
+    fake.setRateLimit(5000, 3600)
+    fake.postDelay = 0.5
+    updater = github.GitHubCommitStatus(gh, USER, REPO, context='test')
+    updater.coalesceDelay = 0.1
+    sha = 'c0ffee'
+    yield defer.DeferredList([updater.updateCommit(sha, 'pending', 'queued', None),
+                              updater.updateCommit(sha, 'pending', 'building', None)])
+    check([s['description'] for s in fake.statuses[sha]] == ['building'], 'coalesced updates result into one POST')
+    # the next updates arrive while the POST is in flight
+    d1 = updater.updateCommit(sha, 'failure', 'failed', None)
+    yield deferLater(0.3)
+    d2 = updater.updateCommit(sha, 'success', 'passed', None)
+    yield deferLater(0.3)
+    d3 = updater.updateCommit(sha, 'success', 'passed again', None)
+    yield defer.DeferredList([d1, d2, d3])
+    check(fake.maxPostsInFlight == 1, 'POSTs of the same (sha, context) are serialized')
+    check(fake.statuses[sha][-1]['description'] == 'passed again', 'the last update is posted last')
+    posts = len(fake.statuses[sha])
+    yield updater.updateCommit(sha, 'success', 'passed again', None)
+    check(len(fake.statuses[sha]) == posts, 'update to the posted value is skipped')
+    fake.postDelay = 0
+
+
+@defer.inlineCallbacks
+def checkCommitStatusChecks(fake):
+    gh = GitHub('Test', async=True)
+    fake.setRateLimit(5000, 3600)
+    updater = github.GitHubCommitStatus(gh, USER, REPO, context='test')
+    fake.statuses['beef01'] = [dict(state='success', description='ok', target_url=None, context='test')]
+    shas = ['beef%02d' % i for i in range(1, 9)] + ['missing%02d' % i for i in range(1, 9)]
+    # other responses are received while the body of 404 response is not completed
+    fake.errorBodyDelay = 0.2
+    result = yield updater.checkCommits(shas)
+    fake.errorBodyDelay = 0
+    check(sorted(result.keys()) == sorted(sha for sha in shas if not sha.startswith('missing')),
+          'checkCommits(): concurrent 404 responses fail their own checks only')
+    check(result['beef01'] == {'test': ('success', 'ok', None)}, 'checkCommits(): current status is received')
+
+    # combined status of a commit with many contexts (30 per page by default)
+    sha = 'beef99'
+    fake.statuses[sha] = [dict(state='success', description=None, target_url=None, context='ctx%02d' % i) for i in range(40)]
+    result = yield updater.checkCommits([sha])
+    check(len(result[sha]) == 40, 'checkCommits(): statuses of all contexts are received')
+    posts = len(fake.statuses[sha])
+    updater39 = github.GitHubCommitStatus(gh, USER, REPO, context='ctx39')
+    yield updater39.updateCommit(sha, 'success', None, None)
+    check(len(fake.statuses[sha]) == posts, 'status of the 40th context is not posted again')
+
+
+def deferLater(delay):
+    d = defer.Deferred()
+    reactor.callLater(delay, d.callback, None)
+    return d
+
+
+def main():
+    # requests go to the local server directly
+    for name in ['http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']:
+        os.environ.pop(name, None)
+    fake = FakeGitHub()
+    startServer(fake)
+    result = []
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            for async in [False, True]:
+                yield checkConditionalGET(fake, async)
+                yield checkGetAll(fake, async)
+            yield checkRateLimitExhausted(fake)
+            yield checkRetryAfter(fake)
+            yield checkHighPriority(fake)
+            yield checkCommitStatusUpdates(fake)
+            yield checkCommitStatusChecks(fake)
+            result.append(0)
+        except:
+            log.err()
+            result.append(1)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return result[0] if result else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,7 +5,8 @@ Client for GitHub API v3
 '''
 
 import os, json, urllib, urllib2
-from urlparse import urlparse
+import collections, heapq, time
+from urlparse import urlparse, parse_qs
 
 from twisted.web.client import Agent, ProxyAgent, readBody
 from twisted.internet import defer, reactor
@@ -15,11 +16,19 @@ from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface.declarations import implements
 
-from twisted_connect import HTTPProxyConnector
+from twisted_connect import HTTPProxyConnector, getHTTPConnectionPool
 
 GITHUB_URL = 'https://api.github.com'
 HTTPS_CONNECT=True
 TIMEOUT = 60
+CACHE_SIZE = 256
+PAGE_SIZE = 100
+PAGES_CONCURRENCY = 4
+
+# request priorities of the rate limit scheduler (lower value is served first)
+PRIORITY_HIGH = 0     # commit status updates and other modifications
+PRIORITY_NORMAL = 10  # single GET requests
+PRIORITY_LOW = 20     # bulk listing (pages of list endpoints)
 
 # Exception base class
 class Error(Exception):
@@ -33,18 +42,177 @@ class Error(Exception):
 class ErrorNotFound(Error):
     pass
 
+# Request is rejected by primary or secondary rate limit (403/429), it is re-queued by the scheduler
+class ErrorRateLimit(Error):
+    pass
+
 def getAgent(reactor):
+    pool = getHTTPConnectionPool(reactor)
     http_proxy = os.environ.get('http_proxy', None)
     if http_proxy:
         c = urlparse(http_proxy)
         if HTTPS_CONNECT:
             proxy = HTTPProxyConnector(proxy_host=c.hostname, proxy_port=c.port)
-            agent = Agent(reactor=proxy)
+            agent = Agent(reactor=proxy, pool=pool)
         else:
             endpoint = TCP4ClientEndpoint(reactor, c.hostname, c.port)
-            agent = ProxyAgent(endpoint)
+            agent = ProxyAgent(endpoint, pool=pool)
         return agent
-    return Agent(reactor)
+    return Agent(reactor, pool=pool)
+
+def getPoolStats():
+    return getHTTPConnectionPool(reactor).getStats()
+
+
+class ResponseCache(object):
+    '''
+    Bounded LRU store of GET responses: url -> (ETag, Last-Modified, JSON body, Link)
+    Bodies are decoded on each hit, callers may modify the returned data.
+    '''
+    def __init__(self, maxSize=CACHE_SIZE):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+
+    def get(self, url):
+        e = self.entries.pop(url, None)
+        if e is not None:
+            self.entries[url] = e
+        return e
+
+    def put(self, url, etag, lastModified, body, link=None):
+        self.entries.pop(url, None)
+        if etag is None and lastModified is None:
+            return
+        self.entries[url] = (etag, lastModified, body, link)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+
+def _getHeader(headers, name):
+    for k in headers.keys():
+        if k.lower() == name:
+            return headers[k]
+    return None
+
+def _getLastPage(headers):
+    # Link: <https://api.github.com/...&page=2>; rel="next", <https://api.github.com/...&page=5>; rel="last"
+    link = _getHeader(headers, 'link')
+    if link:
+        for part in link.split(','):
+            if 'rel="last"' in part:
+                url = part.split(';')[0].strip().strip('<>')
+                page = parse_qs(urlparse(url).query).get('page', None)
+                if page:
+                    return int(page[0])
+    return 1
+
+
+class RateLimitScheduler(object):
+    '''
+    Token bucket driven by GitHub rate limit headers (async mode only).
+
+    Queued calls are ordered by priority. When the remaining quota becomes low the calls are
+    spread over the time left till the limit reset, the last 'reserve' tokens are available for
+    PRIORITY_HIGH calls only. Rejected calls (403/429 with exhausted quota or Retry-After)
+    are delayed and re-queued instead of failing.
+    '''
+    maxConcurrency = 8
+    reserve = 50         # tokens kept for PRIORITY_HIGH calls
+    paceThreshold = 500  # start pacing of calls when fewer tokens left
+    maxRetries = 3
+
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self.queue = []  # heap of (priority, seq, retries, fn, d)
+        self.seq = 0
+        self.running = 0
+        self.remaining = None  # unknown until the first response
+        self.reset = None  # epoch time of the rate limit window reset
+        self.blockedUntil = 0  # Retry-After / exhausted quota
+        self.lastDispatch = 0
+        self._timer = None
+        self.stats = dict(requests=0, delayed=0, retries=0)
+
+    def submit(self, priority, fn):
+        d = defer.Deferred()
+        heapq.heappush(self.queue, (priority, self.seq, 0, fn, d))
+        self.seq += 1
+        self._dispatch()
+        return d
+
+    def update(self, code, headers):
+        now = time.time()
+        remaining = _getHeader(headers, 'x-ratelimit-remaining')
+        reset = _getHeader(headers, 'x-ratelimit-reset')
+        if remaining is not None and reset is not None:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+        retryAfter = _getHeader(headers, 'retry-after')
+        if code in [403, 429]:
+            if retryAfter is not None:
+                self.blockedUntil = max(self.blockedUntil, now + int(retryAfter))
+                return True
+            if self.remaining == 0 and self.reset is not None:
+                self.blockedUntil = max(self.blockedUntil, self.reset + 1)
+                return True
+        return False
+
+    def getDelay(self, priority):
+        now = time.time()
+        if now < self.blockedUntil:
+            return self.blockedUntil - now
+        if self.remaining is None or self.reset is None:
+            return 0
+        if now >= self.reset:
+            # new rate limit window, wait for actual values from the next response
+            self.remaining = None
+            return 0
+        available = self.remaining
+        if priority > PRIORITY_HIGH:
+            available -= self.reserve
+        if available <= 0:
+            return self.reset - now + 1
+        if available >= self.paceThreshold:
+            return 0
+        interval = float(self.reset - now) / available
+        return max(0, self.lastDispatch + interval - now)
+
+    def _schedule(self, delay):
+        if self._timer is not None and self._timer.active():
+            if self._timer.getTime() <= self.reactor.seconds() + delay:
+                return
+            # e.g. PRIORITY_HIGH call is paced only, but the timer waits for the limit reset
+            self._timer.cancel()
+        self.stats['delayed'] += 1
+        self._timer = self.reactor.callLater(delay, self._dispatch)
+
+    def _dispatch(self):
+        while self.queue and self.running < self.maxConcurrency:
+            delay = self.getDelay(self.queue[0][0])
+            if delay > 0:
+                self._schedule(delay)
+                return
+            item = heapq.heappop(self.queue)
+            self.running += 1
+            self.lastDispatch = time.time()
+            if self.remaining is not None:
+                self.remaining -= 1  # real value comes with the response
+            self.stats['requests'] += 1
+            d = defer.maybeDeferred(item[3])
+            d.addBoth(self._done, item)
+
+    def _done(self, result, item):
+        self.running -= 1
+        priority, seq, retries, fn, d = item
+        if isinstance(result, failure.Failure) and result.check(ErrorRateLimit) and retries < self.maxRetries:
+            self.stats['retries'] += 1
+            heapq.heappush(self.queue, (priority, seq, retries + 1, fn, d))
+        elif isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        self._dispatch()
 
 
 class GitHub(object):
@@ -53,14 +221,17 @@ class GitHub(object):
     x_ratelimit_remaining = -1
     x_ratelimit_limit = -1
 
-    def __init__(self, userAgent, access_token=None, async=False, reuseETag=False):
+    def __init__(self, userAgent, access_token=None, async=False, reuseETag=True, cacheSize=CACHE_SIZE, rateLimit=True):
         self.userAgent = userAgent
-        self.ETag = None
+        self.ETag = None  # ETag of the last response
         self._authorization = 'token %s' % access_token if access_token else None
         self._async = async
+        # conditional GET requests, GitHub doesn't count "304 Not Modified" responses against the rate limit
         self._reuseETag = reuseETag
+        self._cache = ResponseCache(cacheSize)
+        self._scheduler = RateLimitScheduler() if async and rateLimit else None
 
-    def _process(self, method, path, **kw):
+    def _process(self, method, path, _responseHeaders=None, _priority=None, **kw):
         # prepare HTTP request input parameters
         url_params = None
         http_body = None
@@ -89,6 +260,40 @@ class GitHub(object):
                     self.x_ratelimit_limit = int(headers[k])
             return isValid
 
+        useCache = self._reuseETag and method == 'GET'
+        cached = self._cache.get(url) if useCache else None
+        def _conditionalHeaders():
+            result = {}
+            if cached is not None:
+                etag, lastModified = cached[0], cached[1]
+                if etag:
+                    result['If-None-Match'] = etag
+                if lastModified:
+                    result['If-Modified-Since'] = lastModified
+            return result
+
+        def _notModified():
+            self._cache.hits += 1
+            if _responseHeaders is not None and cached[3] is not None:
+                _responseHeaders['link'] = cached[3]
+            return json.loads(cached[2])
+
+        def _updateCache(headers, body):
+            if useCache:
+                self._cache.put(url, _getHeader(headers, 'etag'), _getHeader(headers, 'last-modified'), body,
+                                _getHeader(headers, 'link'))
+
+        def _storeHeaders(headers, code):
+            # ':status' is the response code of this call ('status' attribute is shared by concurrent calls)
+            if _responseHeaders is not None:
+                _responseHeaders[':status'] = code
+                for k in headers.keys():
+                    _responseHeaders[k.lower()] = headers[k]
+
+        def _checkRateLimit(code, headers):
+            if self._scheduler is not None and self._scheduler.update(code, headers):
+                raise ErrorRateLimit(url, dict(method=method, url=url), dict(code=code, json=None))
+
         if not self._async:
             # process synchronous call
             request = urllib2.Request(url, data=http_body)
@@ -96,17 +301,23 @@ class GitHub(object):
             request.add_header('User-Agent', self.userAgent)
             if self._authorization:
                 request.add_header('Authorization', self._authorization)
-            if self._reuseETag and self.ETag:
-                request.add_header('If-None-Match', self.ETag)
+            for k, v in _conditionalHeaders().items():
+                request.add_header(k, v)
             if method in ['POST', 'PATCH', 'PUT']:
                 request.add_header('Content-Type', 'application/x-www-form-urlencoded')
             try:
                 response = urllib2.build_opener(urllib2.HTTPSHandler).open(request, timeout=TIMEOUT)
                 isValid = _parse_headers(self, response.headers)
+                _storeHeaders(response.headers, response.getcode())
                 if isValid:
-                    return json.loads(response.read())
+                    body = response.read()
+                    _updateCache(response.headers, body)
+                    return json.loads(body)
             except urllib2.HTTPError, e:
                 isValid = _parse_headers(self, e.headers)
+                if e.code == 304 and cached is not None:
+                    _storeHeaders(e.headers, e.code)
+                    return _notModified()
                 if isValid:
                     json_data = json.loads(e.read())
                 else:
@@ -125,19 +336,26 @@ class GitHub(object):
                     headers = {'User-Agent':[self.userAgent]}
                     if self._authorization:
                         headers['Authorization'] = [self._authorization]
-                    if self._reuseETag and self.ETag and method == 'GET':
-                        headers['If-None-Match'] = [self.ETag]
+                    for k, v in _conditionalHeaders().items():
+                        headers[k] = [v]
                     response = yield agent.request(method, url, headers=Headers(headers))
                     self.status = response.code
                     resp_headers = {}
                     for k in response.headers._rawHeaders:
                         resp_headers[k] = response.headers._rawHeaders[k][0];
                     isValid = _parse_headers(self, resp_headers)
+                    _storeHeaders(resp_headers, response.code)
+                    body = yield readBody(response)  # release connection into the pool
+                    _checkRateLimit(response.code, resp_headers)
+                    if response.code == 304 and cached is not None:
+                        defer.returnValue(_notModified())
                     if isValid:
-                        body = yield readBody(response)
-                        defer.returnValue(json.loads(body))
+                        data = json.loads(body)
+                        if response.code == 200:
+                            _updateCache(resp_headers, body)
+                        defer.returnValue(data)
                     defer.returnValue(None)
-                return asyncGet()
+                call = asyncGet
             if method in ['POST', 'PATCH', 'PUT']:
                 @defer.inlineCallbacks
                 def asyncPost():
@@ -159,15 +377,22 @@ class GitHub(object):
                         def resumeProducing(self):
                             pass
                     response = yield agent.request(method, url, headers=Headers(headers), bodyProducer=StringProducer() if http_body else None)
+                    self.status = response.code
                     resp_headers = {}
                     for k in response.headers._rawHeaders:
                         resp_headers[k] = response.headers._rawHeaders[k][0];
                     isValid = _parse_headers(self, resp_headers)
+                    body = yield readBody(response)  # release connection into the pool
+                    _checkRateLimit(response.code, resp_headers)
                     if isValid:
-                        body = yield readBody(response)
                         defer.returnValue(json.loads(body))
                     defer.returnValue(None)
-                return asyncPost()
+                call = asyncPost
+            if self._scheduler is None:
+                return call()
+            if _priority is None:
+                _priority = PRIORITY_NORMAL if method in ['GET', 'DELETE'] else PRIORITY_HIGH
+            return self._scheduler.submit(_priority, call)
 
     '''
     Helper classes for smart path processing
@@ -185,6 +410,59 @@ class GitHub(object):
         def __call__(self, **kw):
             return self._client._process(self._method, self._path, **kw)
 
+    class _PagedEndPoint(object):
+        '''
+        GET of all pages of list endpoints:
+            get_all(**kw) - returns list of items from all pages (Deferred in async mode)
+            get_pages(**kw) - async mode only, returns generator of Deferreds with items of each page.
+                              The first page should be received before advancing the generator,
+                              then the rest pages are requested concurrently.
+        '''
+
+        def __init__(self, client, path, mode):
+            self._client = client
+            self._path = path
+            self._mode = mode
+
+        def __call__(self, **kw):
+            kw.setdefault('per_page', PAGE_SIZE)
+            kw.pop('page', None)
+            if self._mode == 'pages':
+                assert self._client._async
+                return self._pages(kw)
+            if self._client._async:
+                return self._getAllAsync(kw)
+            items = []
+            lastPage = 1
+            page = 1
+            while page <= lastPage:
+                headers = {}
+                data = self._client._process('GET', self._path, _responseHeaders=headers, page=page, **kw)
+                items.extend(data or [])
+                lastPage = _getLastPage(headers)
+                page += 1
+            return items
+
+        def _pages(self, kw):
+            headers = {}
+            d = self._client._process('GET', self._path, _responseHeaders=headers, _priority=PRIORITY_LOW, page=1, **kw)
+            yield d
+            if not d.called:
+                raise RuntimeError('First page should be received before requesting of other pages')
+            lock = defer.DeferredSemaphore(PAGES_CONCURRENCY)
+            pages = [lock.run(self._client._process, 'GET', self._path, _priority=PRIORITY_LOW, page=page, **kw)
+                     for page in range(2, _getLastPage(headers) + 1)]
+            for d in pages:
+                yield d
+
+        @defer.inlineCallbacks
+        def _getAllAsync(self, kw):
+            items = []
+            for d in self._pages(kw):
+                data = yield d
+                items.extend(data or [])
+            defer.returnValue(items)
+
     class _Entry(object):
 
         def __init__(self, client, path):
@@ -194,6 +472,8 @@ class GitHub(object):
         def __getattr__(self, attr):
             if attr in ['get', 'put', 'post', 'patch', 'delete']:
                 return self._client._EndPoint(self._client, self._path, attr.upper())
+            if attr in ['get_all', 'get_pages']:
+                return self._client._PagedEndPoint(self._client, self._path, attr[4:])
             name = '%s/%s' % (self._path, attr)
             return self._client._Entry(self._client, name)
 
@@ -208,37 +488,129 @@ from pprint import pprint
 
 '''
 Commit status updater
+
+Updates are coalesced: several updates of the same (sha, context) within 'coalesceDelay' seconds
+result into single POST of the last one. Publishing is serialized per (sha, context): updates received
+while the POST is in flight are posted after it completes, so GitHub can't receive them out of order. The last posted status is remembered locally, so
+current statuses are requested from GitHub only for unknown sha (i.e. after restart).
+Current statuses are received via combined status endpoint (the latest status of each context),
+checkCommits() receives them for a batch of commits.
 '''
 class GitHubCommitStatus(object):
 
+    coalesceDelay = 2
+    maxConcurrency = 4
+    postedSize = 4096
+    checkConcurrency = 4
+
     def __init__(self, client, username, repo, context='default'):
         self.client = client
         self.username = username
         self.repo = repo
         self.context = context
+        self.posted = collections.OrderedDict()  # (sha, context) -> (state, description, url)
+        self.pending = {}  # (sha, context) -> [(state, description, url), [Deferred]]
+        self.inflight = set()  # (sha, context) of running _publish() calls
+        self.checked = collections.OrderedDict()  # sha -> {context: (state, description, url)}
+        self.lock = defer.DeferredSemaphore(self.maxConcurrency)
+
+    def _remember(self, key, value):
+        self.posted.pop(key, None)
+        self.posted[key] = value
+        if key[0] in self.checked:
+            self.checked[key[0]][key[1]] = value
+        while len(self.posted) > self.postedSize:
+            self.posted.popitem(last=False)
+
+    @defer.inlineCallbacks
+    def checkCommit(self, sha):
+        if sha in self.checked:
+            defer.returnValue(self.checked[sha])
+        headers = {}
+        # combined status lists 30 contexts by default
+        data = yield self.client.repos(self.username)(self.repo).commits(sha).status.get(per_page=100, _responseHeaders=headers)
+        code = headers.get(':status', None)
+        if code not in [200, 304] or data is None:
+            raise Error('commit status %s' % sha, dict(sha=sha), dict(code=code, json=data))
+        statuses = {}
+        for s in data.get('statuses', []):
+            value = (s['state'], s['description'], s['target_url'])
+            statuses[s['context']] = value
+            self._remember((sha, s['context']), value)
+        self.checked.pop(sha, None)
+        self.checked[sha] = statuses
+        while len(self.checked) > self.postedSize:
+            self.checked.popitem(last=False)
+        defer.returnValue(statuses)
 
     @defer.inlineCallbacks
+    def checkCommits(self, shas):
+        '''
+        Returns {sha: {context: (state, description, url)}}, failed commits are skipped
+        '''
+        lock = defer.DeferredSemaphore(self.checkConcurrency)
+        shas = list(set(shas))
+        results = yield defer.DeferredList([lock.run(self.checkCommit, sha) for sha in shas], consumeErrors=True)
+        res = {}
+        for sha, (success, value) in zip(shas, results):
+            if success:
+                res[sha] = value
+            else:
+                log.err(value, 'while receiving commit status of %s' % sha)
+        defer.returnValue(res)
+
     def updateCommit(self, sha, state, description, url, context=None):
         if context is None:
             context = self.context
+        key = (sha, context)
+        value = (state, description, url)
+        d = defer.Deferred()
+        entry = self.pending.get(key, None)
+        if entry is not None:
+            entry[0] = value
+            entry[1].append(d)
+            return d
+        if key not in self.inflight and self.posted.get(key, None) == value:
+            log.msg('Commit status update for %s is NOT required' % sha)
+            return defer.succeed(None)
+        self.pending[key] = [value, [d]]
+        reactor.callLater(self.coalesceDelay, self._flush, key)
+        return d
+
+    def _flush(self, key):
+        if key in self.inflight or key not in self.pending:
+            return  # flushed again when the running POST is completed
+        value, waiters = self.pending.pop(key)
+        self.inflight.add(key)
+        def done(result):
+            self.inflight.discard(key)
+            for d in waiters:
+                d.callback(result)
+            self._flush(key)  # updates received during the POST
+        def fail(f):
+            log.err(f, 'while updating commit status')
+            return None
+        self.lock.run(self._publish, key, value).addErrback(fail).addCallback(done)
+
+    @defer.inlineCallbacks
+    def _publish(self, key, value):
+        sha, context = key
+        state, description, url = value
         result = None
         try:
-            need_update = True
-            try:
-                current_statuses = yield self.client.repos(self.username)(self.repo).statuses(sha).get()
-                if self.client.status == 200:
-                    for s in current_statuses:
-                        if s['context'] == context:
-                            if s['state'] == state and s['description'] == description and s['target_url'] == url:
-                                log.msg('Commit status update for %s is NOT required' % sha)
-                                return
-                            break
-                    log.msg('Commit status update for %s is needed' % sha)
-            except:
-                log.err(failure.Failure(), 'while receiving old commit status')
-                pass
+            if key not in self.posted:
+                try:
+                    yield self.checkCommit(sha)
+                except:
+                    log.err(failure.Failure(), 'while receiving old commit status')
+                    pass
+            if self.posted.get(key, None) == value:
+                log.msg('Commit status update for %s is NOT required' % sha)
+                return
+            log.msg('Commit status update for %s is needed' % sha)
 
             result = yield self.client.repos(self.username)(self.repo).statuses(sha).post(state=state, target_url=url, description=description, context=context)
+            self._remember(key, value)
             log.msg('Commit status for %s is updated to "%s":"%s"' % (sha, state, description))
         except:
             log.err(failure.Failure(), 'while updating commit status')
@@ -16,6 +16,7 @@ from twisted.protocols import tls
 from twisted.python import log
 
 from twisted.web import http
+from twisted.web.client import HTTPConnectionPool
 
 from zope.interface import implements
 
@@ -39,9 +40,9 @@ class HTTPProxyConnector(object):
 
     def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
         f = HTTPProxiedClientFactory(factory, host, port)
-        self.reactor.connectTCP(self.proxy_host,
-                                self.proxy_port,
-                                f, timeout, bindAddress)
+        return self.reactor.connectTCP(self.proxy_host,
+                                       self.proxy_port,
+                                       f, timeout, bindAddress)
 
     def listenSSL(self, port, factory, contextFactory, backlog=50, interface=''):
         raise CannotListenError("Cannot BIND via HTTP proxies")
@@ -52,6 +53,54 @@ class HTTPProxyConnector(object):
         return self.connectTCP(host, port, tlsFactory, timeout, bindAddress)
 
 
+class StatsHTTPConnectionPool(HTTPConnectionPool):
+    """Persistent HTTP connection pool which counts reused, new and evicted connections.
+
+    Connections opened via HTTPProxyConnector are kept after the CONNECT
+    handshake, so reused connections skip both TCP/TLS and proxy round-trips.
+    """
+    maxPersistentPerHost = 4
+    cachedConnectionTimeout = 120
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.stats = dict(requests=0, hits=0, new_connections=0, idle_evictions=0)
+
+    def getConnection(self, key, endpoint):
+        self.stats['requests'] += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.stats['new_connections'] += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _putConnection(self, key, connection):
+        if len(self._connections.get(key, [])) >= self.maxPersistentPerHost:
+            self.stats['idle_evictions'] += 1
+        return HTTPConnectionPool._putConnection(self, key, connection)
+
+    def _removeConnection(self, key, connection):
+        # cached connection is timed out or closed by server
+        self.stats['idle_evictions'] += 1
+        return HTTPConnectionPool._removeConnection(self, key, connection)
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['hits'] = stats['requests'] - stats['new_connections']
+        stats['idle_connections'] = sum([len(c) for c in self._connections.values()])
+        return stats
+
+
+_pool = None
+
+def getHTTPConnectionPool(reactor=reactor):
+    """Returns the keep-alive connection pool shared by the API clients"""
+    global _pool
+    if _pool is None:
+        _pool = StatsHTTPConnectionPool(reactor)
+    return _pool
+
+
 class HTTPProxiedClientFactory(protocol.ClientFactory):
     """ClientFactory wrapper that triggers an HTTP proxy CONNECT on connect"""
     def __init__(self, delegate, dst_host, dst_port):
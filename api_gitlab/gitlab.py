@@ -4,7 +4,8 @@
 Client for GitLab API v3
 '''
 
-import json, urllib, urllib2
+import json, os, sys, urllib, urllib2
+from urlparse import urlparse, parse_qs
 
 from twisted.web.client import Agent, readBody
 from twisted.internet import defer, reactor
@@ -12,7 +13,15 @@ from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface.declarations import implements
 
+# keep-alive connection pool is shared with the GitHub client (api_github/twisted_connect.py)
+_apiGithubDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api_github')
+if _apiGithubDir not in sys.path:
+    sys.path.append(_apiGithubDir)
+from twisted_connect import getHTTPConnectionPool
+
 TIMEOUT = 60
+PAGE_SIZE = 100
+PAGES_CONCURRENCY = 4
 
 # Exception base class
 class Error(Exception):
@@ -26,6 +35,24 @@ class Error(Exception):
 class ErrorNotFound(Error):
     pass
 
+def getPoolStats():
+    return getHTTPConnectionPool(reactor).getStats()
+
+def _getLastPage(headers):
+    totalPages = headers.get('x-total-pages', None)
+    if totalPages:
+        return int(totalPages)
+    # Link: <https://gitlab.example.com/api/v3/...&page=5>; rel="last"
+    link = headers.get('link', None)
+    if link:
+        for part in link.split(','):
+            if 'rel="last"' in part:
+                url = part.split(';')[0].strip().strip('<>')
+                page = parse_qs(urlparse(url).query).get('page', None)
+                if page:
+                    return int(page[0])
+    return 1
+
 class GitLab(object):
 
     status = 0
@@ -38,7 +65,7 @@ class GitLab(object):
         self._private_token = private_token
         self._async = async
 
-    def _process(self, method, path, **kw):
+    def _process(self, method, path, _responseHeaders=None, **kw):
         # prepare HTTP request input parameters
         url_params = None
         http_body = None
@@ -61,6 +88,11 @@ class GitLab(object):
                     isValid = headers[k].startswith('application/json')
             return isValid
 
+        def _storeHeaders(headers):
+            if _responseHeaders is not None:
+                for k in headers.keys():
+                    _responseHeaders[k.lower()] = headers[k]
+
         if not self._async:
             # process synchronous call
             request = urllib2.Request(url, data=http_body)
@@ -72,6 +104,7 @@ class GitLab(object):
             try:
                 response = urllib2.build_opener(urllib2.HTTPHandler, urllib2.HTTPSHandler).open(request, timeout=TIMEOUT)
                 isValid = self._parse_headers(response.headers)
+                _storeHeaders(response.headers)
                 if isValid:
                     return json.loads(response.read())
             except urllib2.HTTPError, e:
@@ -90,7 +123,7 @@ class GitLab(object):
             if method in ['GET', 'DELETE']:
                 @defer.inlineCallbacks
                 def asyncGet():
-                    agent = Agent(reactor)
+                    agent = Agent(reactor, pool=getHTTPConnectionPool(reactor))
                     headers = {'User-Agent':[self.userAgent],
                                'PRIVATE-TOKEN':[self._private_token]}
                     response = yield agent.request(method, url, headers=Headers(headers))
@@ -99,15 +132,16 @@ class GitLab(object):
                     for k in response.headers._rawHeaders:
                         resp_headers[k] = response.headers._rawHeaders[k][0];
                     isValid = self._parse_headers(resp_headers)
+                    _storeHeaders(resp_headers)
+                    body = yield readBody(response)  # release connection into the pool
                     if isValid:
-                        body = yield readBody(response)
                         defer.returnValue(json.loads(body))
                     defer.returnValue(None)
                 return asyncGet()
             if method in ['POST', 'PATCH', 'PUT']:
                 @defer.inlineCallbacks
                 def asyncPost():
-                    agent = Agent(reactor)
+                    agent = Agent(reactor, pool=getHTTPConnectionPool(reactor))
                     headers = {'User-Agent':[self.userAgent],
                                'PRIVATE-TOKEN':[self._private_token],
                                'Content-Type': ['application/json']}
@@ -129,8 +163,8 @@ class GitLab(object):
                     for k in response.headers._rawHeaders:
                         resp_headers[k] = response.headers._rawHeaders[k][0];
                     isValid = self._parse_headers(resp_headers)
+                    body = yield readBody(response)  # release connection into the pool
                     if isValid:
-                        body = yield readBody(response)
                         defer.returnValue(json.loads(body))
                     defer.returnValue(None)
                 return asyncPost()
@@ -151,6 +185,59 @@ class GitLab(object):
         def __call__(self, **kw):
             return self._client._process(self._method, self._path, **kw)
 
+    class _PagedEndPoint(object):
+        '''
+        GET of all pages of list endpoints:
+            get_all(**kw) - returns list of items from all pages (Deferred in async mode)
+            get_pages(**kw) - async mode only, returns generator of Deferreds with items of each page.
+                              The first page should be received before advancing the generator,
+                              then the rest pages are requested concurrently.
+        '''
+
+        def __init__(self, client, path, mode):
+            self._client = client
+            self._path = path
+            self._mode = mode
+
+        def __call__(self, **kw):
+            kw.setdefault('per_page', PAGE_SIZE)
+            kw.pop('page', None)
+            if self._mode == 'pages':
+                assert self._client._async
+                return self._pages(kw)
+            if self._client._async:
+                return self._getAllAsync(kw)
+            items = []
+            lastPage = 1
+            page = 1
+            while page <= lastPage:
+                headers = {}
+                data = self._client._process('GET', self._path, _responseHeaders=headers, page=page, **kw)
+                items.extend(data or [])
+                lastPage = _getLastPage(headers)
+                page += 1
+            return items
+
+        def _pages(self, kw):
+            headers = {}
+            d = self._client._process('GET', self._path, _responseHeaders=headers, page=1, **kw)
+            yield d
+            if not d.called:
+                raise RuntimeError('First page should be received before requesting of other pages')
+            lock = defer.DeferredSemaphore(PAGES_CONCURRENCY)
+            pages = [lock.run(self._client._process, 'GET', self._path, page=page, **kw)
+                     for page in range(2, _getLastPage(headers) + 1)]
+            for d in pages:
+                yield d
+
+        @defer.inlineCallbacks
+        def _getAllAsync(self, kw):
+            items = []
+            for d in self._pages(kw):
+                data = yield d
+                items.extend(data or [])
+            defer.returnValue(items)
+
     class _Entry(object):
 
         def __init__(self, client, path):
@@ -160,6 +247,8 @@ class GitLab(object):
         def __getattr__(self, attr):
             if attr in ['get', 'put', 'post', 'patch', 'delete']:
                 return self._client._EndPoint(self._client, self._path, attr.upper())
+            if attr in ['get_all', 'get_pages']:
+                return self._client._PagedEndPoint(self._client, self._path, attr[4:])
             name = '%s/%s' % (self._path, attr)
             return self._client._Entry(self._client, name)
 
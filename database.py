@@ -1,14 +1,20 @@
+import collections
 import datetime
+import heapq
+import inspect
 import json
 import logging
 import operator
+import os
 import pprint
 import sys
 import threading
+import time
 import types
 
 from pullrequest.constants import BuildStatus
 from pullrequest import constants
+from pullrequest.schedulingpolicy import Job
 from pullrequest.utils import NeedUpdate
 instance_dict = operator.attrgetter("__dict__")
 
@@ -32,7 +38,7 @@ def getTimestamp(d):
     return t
 
 def fromTimestamp(timestamp):
-    t = _epoch + timestamp
+    t = _epoch + datetime.timedelta(seconds=float(timestamp))
     return t
 
 def checkUpdatedAtTimestamp(obj, updated_at_timestamp):
@@ -46,15 +52,103 @@ class _GeneratorWrap():
     def __init__(self, gen):
         self.generator = gen
 
+def _getOperationName(fn):
+    operation = getattr(fn, 'dbOperation', None)  # DBMethodCall wrapper, bound methods forward it too
+    if operation is not None:
+        return operation
+    code = getattr(fn, 'gi_code', None) or getattr(fn, 'func_code', None)
+    if code is None:
+        return getattr(fn, '__name__', type(fn).__name__)
+    return '%s:%d:%s' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+class Histogram(object):
+    '''
+    Fixed-memory histogram with power of 2 bucket bounds: base, base*2, base*4, ...
+    '''
+
+    def __init__(self, base, size):
+        self.bounds = [base * (2 ** i) for i in range(size)]
+        self.counts = [0] * (size + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def getBuckets(self):
+        # [(upper bound, cumulative count)], None bound is +Inf
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + [None], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def asDict(self):
+        return dict(count=self.count, sum=self.sum, buckets=self.getBuckets())
+
+
+class DBStats(object):
+    '''
+    Per call site statistics of DB jobs: queue wait, execution and commit time (seconds), result rows
+    '''
+
+    metrics = ['queue', 'execute', 'commit', 'rows']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}  # operation -> {metric: Histogram}
+
+    def _create(self):
+        return dict(queue=Histogram(0.0001, 20), execute=Histogram(0.0001, 20),
+                    commit=Histogram(0.0001, 20), rows=Histogram(1, 16))
+
+    def record(self, operation, queue=None, execute=None, commit=None, rows=None):
+        with self.lock:
+            hs = self.operations.get(operation, None)
+            if hs is None:
+                hs = self.operations[operation] = self._create()
+            for name, value in [('queue', queue), ('execute', execute), ('commit', commit), ('rows', rows)]:
+                if value is not None:
+                    hs[name].add(value)
+
+    def asDict(self):
+        with self.lock:
+            return dict((operation, dict((name, h.asDict()) for name, h in hs.items()))
+                        for operation, hs in self.operations.items())
+
+
+def _countRows(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple, set, dict)):
+        return len(result)
+    return 1
+
 # Only one thread
+#
+# Unit of work: each plain asyncRun() job is committed once at the end, a job which raises an exception is rolled back.
+# Generator jobs are not atomic: the session is shared by all jobs, so a generator job is committed each time
+# it hands control back to the reactor (yield of a Deferred or of a nested generator), other jobs may run before
+# its next step. Yields of other values don't leave the DB thread. A failed step is rolled back alone
+# (exceptions of nested generators are passed to the parent job). Use plain jobs for atomic updates.
 class PRDBThread(threadpool.ThreadPool):
 
     running = False
     session = None  # DB session
     workerThread = None
+    operation = None  # name of the running job, for commit statistics
+    handoffs = 0  # number of jobs passed from the reactor to the DB thread
+    started = 0  # number of jobs started by the DB thread
 
     def __init__(self, context):
         self.context = context
+        self.commitStats = collections.defaultdict(lambda: [0, 0])  # operation -> [jobs, commits]
 
         threadpool.ThreadPool.__init__(self, minthreads=1, maxthreads=1, name='PRDB-%s' % context.dbname)
 
@@ -70,9 +164,83 @@ class PRDBThread(threadpool.ThreadPool):
                 raise
         if self.workerThread == threading.current_thread():
             return proxy()
-        else:
+        elif inspect.isgeneratorfunction(fn):
             d = defer.maybeDeferred(self._asyncRunEx, None, fn, *args, **kwargs)
             return d
+        else:
+            return self._runJob(fn, *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def _runJob(self, fn, *args, **kwargs):
+        # Plain DB closure: one hand-off to the DB thread, committed there
+        operation = _getOperationName(fn)
+        submitted = time.time()
+        def worker():
+            completed = True
+            failed = False
+            self.operation = operation
+            self.started += 1
+            start = time.time()
+            res = None
+            try:
+                res = fn(self.session, *args, **kwargs)
+                if isinstance(res, types.GeneratorType):
+                    completed = False
+                    return _GeneratorWrap(res)
+                if isinstance(res, defer.Deferred):
+                    return _DeferredWrap(res)
+                return res
+            except:
+                failed = True
+                raise
+            finally:
+                self.context.db.stats.record(operation, queue=start - submitted, execute=time.time() - start,
+                                             rows=_countRows(res) if completed and not failed else None)
+                if failed:
+                    self._rollbackJob()
+                elif completed:
+                    self._commitJob()
+                self.operation = None
+        self.handoffs += 1
+        result = yield threads.deferToThreadPool(reactor, self, worker)
+        if isinstance(result, _GeneratorWrap):
+            result = yield self._asyncRunEx(result.generator, None)
+        elif isinstance(result, _DeferredWrap):
+            result = yield result.deferred
+        defer.returnValue(result)
+
+    def onCommit(self, session):
+        if self.operation is not None:
+            self.commitStats[self.operation][1] += 1
+
+    def getQueueDepth(self):
+        return self.handoffs - self.started
+
+    def getCommitStats(self):
+        # operation -> dict(jobs, commits)
+        return dict((op, dict(jobs=jobs, commits=commits)) for op, (jobs, commits) in self.commitStats.items())
+
+    def _commitJob(self, completed=True):
+        if completed:
+            self.commitStats[self.operation][0] += 1
+        start = time.time()
+        try:
+            self.session.commit()
+        except:
+            self._rollbackJob()
+            raise
+        finally:
+            self.context.db.stats.record(self.operation, commit=time.time() - start)
+
+    def _rollbackJob(self):
+        # DataSnapshot drops the changes of the rolled back transaction too
+        self.session.rollback()
+        # rollback expires all loaded objects: reload them here, they are read from the reactor thread too
+        for obj in list(self.session.identity_map.values()):
+            try:
+                self.session.refresh(obj)
+            except sa.exc.InvalidRequestError:  # the row doesn't exist anymore
+                self.session.expunge(obj)
 
     @defer.inlineCallbacks
     def asyncRunEx(self, fn, *args, **kwargs):
@@ -86,11 +254,19 @@ class PRDBThread(threadpool.ThreadPool):
 
     @defer.inlineCallbacks
     def _asyncRunEx(self, gen, fn, *args, **kwargs):
+        nested = kwargs.pop('_nested', False)
         params = [gen]
         result = None
+        operation = _getOperationName(gen if gen is not None else fn)
         while 1:
             try:
+                submitted = time.time()
                 def worker():
+                    completed = True
+                    failed = False
+                    self.operation = operation
+                    self.started += 1
+                    start = time.time()
                     try:
                         gen = params[0]
                         if gen is None:
@@ -109,20 +285,34 @@ class PRDBThread(threadpool.ThreadPool):
                                 res = gen.send(res)
                             if isinstance(res, defer.Deferred):
                                 res = _DeferredWrap(res)
+                                completed = False
                                 return res
                             if isinstance(res, types.GeneratorType):
                                 res = _GeneratorWrap(res)
+                                completed = False
                                 return res
+                    except (StopIteration, defer._DefGen_Return):
+                        raise  # the job is completed
+                    except:
+                        failed = True
+                        raise
                     finally:
-                        self.session.commit()
+                        self.context.db.stats.record(operation, queue=start - submitted, execute=time.time() - start)
+                        if failed:
+                            self._rollbackJob()
+                        else:
+                            # control goes back to the reactor: no uncommitted writes are left on the shared session
+                            self._commitJob(completed=completed and not nested)
+                        self.operation = None
+                self.handoffs += 1
                 result = yield threads.deferToThreadPool(reactor, self, worker)
                 if isinstance(result, _DeferredWrap):
                     d = result.deferred
                     d.callback(None)
-                    result = yield d
+                    result = yield d  # the job is interrupted by a failed reactor call, its steps are committed
                 elif isinstance(result, _GeneratorWrap):
                     try:
-                        result = yield defer.maybeDeferred(self._asyncRunEx, result.generator, None)
+                        result = yield defer.maybeDeferred(self._asyncRunEx, result.generator, None, _nested=True)
                     except:
                         log.err()
                         result = failure.Failure()
@@ -157,10 +347,134 @@ class PRDBThread(threadpool.ThreadPool):
         self.running = False
 
 
+class PRDBReadThreadPool(threadpool.ThreadPool):
+    '''
+    Pool of threads for pure read queries, they run concurrently with the writer PRDBThread (SQLite WAL mode).
+    Each call uses own session which is closed after the call: return plain values, not ORM objects.
+    '''
+
+    running = False
+
+    def __init__(self, context):
+        self.context = context
+        self.local = threading.local()
+
+        threadpool.ThreadPool.__init__(self, minthreads=1, maxthreads=context.dbReadThreads, name='PRDB-%s-read' % context.dbname)
+
+        self._start_evt = reactor.callWhenRunning(self._start)
+
+    def asyncRead(self, fn, *args, **kwargs):
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            return fn(session, *args, **kwargs)
+        if self.context.thread.workerThread == threading.current_thread():
+            return self.context.thread.asyncRun(fn, *args, **kwargs)
+        def worker():
+            self.local.session = self.context.db._createSession()
+            try:
+                return fn(self.local.session, *args, **kwargs)
+            finally:
+                self.local.session.close()
+                self.local.session = None
+        return threads.deferToThreadPool(reactor, self, worker)
+
+    def _start(self):
+        self._start_evt = None
+        if not self.running:
+            self.start()
+            self._stop_evt = reactor.addSystemEventTrigger('during', 'shutdown', self._stop)
+            self.running = True
+
+    def _stop(self):
+        self._stop_evt = None
+        self.stop()
+        self.running = False
+
+
+def _setSQLitePragmas(dbapi_connection, connection_record):
+    # WAL: readers don't block the writer and see the last committed state
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _createEngine(context):
+    url = sa.engine.url.make_url(context.dbURL or 'sqlite:///%s.sqlite' % context.dbname)
+    if url.drivername.startswith('sqlite'):
+        engine = sa.create_engine(url, echo=context.debug_db)
+        sa.event.listen(engine, 'connect', _setSQLitePragmas)
+        return engine
+    # server DB (PostgreSQL): connections of the writer and the read threads are pooled
+    poolSize = context.dbPoolSize or context.dbReadThreads + 1
+    engine = sa.create_engine(url, echo=context.debug_db, pool_size=poolSize, max_overflow=2, pool_recycle=3600)
+    if context.dbSchema:
+        # several contexts share one DB, each one has own schema with the same table names
+        def setSearchPath(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET search_path TO "%s"' % context.dbSchema)
+            cursor.close()
+        sa.event.listen(engine, 'connect', setSearchPath)
+        engine.execute('CREATE SCHEMA IF NOT EXISTS "%s"' % context.dbSchema)
+    return engine
+
+
 def getContext(session):
     # :rtype Context
     return session.bind.user_context
 
+class JSONProperty(object):
+    '''
+    JSON value of the string column attribute: decoded on the first access,
+    serialized on flush only if the value was accessed and it is changed.
+    The decoded value is dropped when the column is set, expired or reloaded (see register()).
+    '''
+
+    def __init__(self, column, default):
+        self.column = column  # name of the column attribute
+        self.default = default  # factory of the value for NULL
+        self.key = '_json_cache%s' % column  # instance cache: (raw, value)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        cache = instance.__dict__.get(self.key, None)
+        if cache is None:
+            raw = getattr(instance, self.column)
+            cache = (raw, json.loads(raw) if raw is not None else self.default())
+            instance.__dict__[self.key] = cache
+        return cache[1]
+
+    def __set__(self, instance, value):
+        persistent = sa.orm.util.has_identity(instance)  # sa.inspect() requires SQLAlchemy 0.8+
+        raw = getattr(instance, self.column) if persistent else instance.__dict__.get(self.column, None)
+        instance.__dict__[self.key] = (raw, value)
+        if persistent:
+            # flush event is required even if other columns are not changed
+            sa.orm.attributes.flag_modified(instance, self.column)
+
+    def serialize(self, instance):
+        cache = instance.__dict__.get(self.key, None)
+        if cache is None:
+            if getattr(instance, self.column) is None:
+                setattr(instance, self.column, json.dumps(self.default()))
+            return
+        raw = json.dumps(cache[1])
+        if raw != cache[0]:
+            setattr(instance, self.column, raw)
+        instance.__dict__[self.key] = (getattr(instance, self.column), cache[1])
+
+    def invalidate(self, instance, attrs=None):
+        if attrs is None or self.column in attrs:
+            instance.__dict__.pop(self.key, None)
+
+    def register(self, cls):
+        sa.event.listen(getattr(cls, self.column), 'set',
+                        lambda instance, value, oldvalue, initiator: self.invalidate(instance))
+        sa.event.listen(cls, 'expire', lambda instance, attrs: self.invalidate(instance, attrs))
+        sa.event.listen(cls, 'refresh', lambda instance, context, attrs: self.invalidate(instance, attrs))
+
+
 class BaseMixin(object):
 
     created_at = sa.Column('created_at', sa.DateTime, nullable=False)
@@ -173,12 +487,15 @@ class BaseMixin(object):
         instance.created_at = now
         instance.updated_at = now
         if isinstance(instance, Pullrequest):
-            instance._jsoninfo = json.dumps(instance.info if hasattr(instance, 'info') else {})
+            Pullrequest.info.serialize(instance)
         if isinstance(instance, Builder):
-            instance._builders = json.dumps(instance.builders)
+            Builder.builders.serialize(instance)
             if instance.internal_name in instance._context.builders:
                 b = instance._context.builders[instance.internal_name]
                 instance.isPerf = b.get('isPerf', False)
+        if isinstance(instance, Status):
+            if instance.status in [None, BuildStatus.INQUEUE]:  # None: column default
+                instance.queued_at = now
 
     @staticmethod
     def update_time(mapper, connection, instance):
@@ -186,26 +503,43 @@ class BaseMixin(object):
         now = datetime.datetime.utcnow()
         instance.updated_at = now
         if isinstance(instance, Pullrequest):
-            instance._jsoninfo = json.dumps(instance.info if hasattr(instance, 'info') else {})
+            Pullrequest.info.serialize(instance)
         if isinstance(instance, Builder):
-            instance._builders = json.dumps(instance.builders)
+            Builder.builders.serialize(instance)
+        if isinstance(instance, Status):
+            # the status is queued again (requestCancelled(), re-queue)
+            if instance.status == BuildStatus.INQUEUE and \
+                    BuildStatus.INQUEUE not in sa.orm.attributes.get_history(instance, 'status').unchanged:
+                instance.queued_at = now
 
     @staticmethod
     def load(instance, context):
         instance._context = getContext(object_session(instance))
-        if isinstance(instance, Pullrequest):
-            instance.info = json.loads(instance._jsoninfo) if instance._jsoninfo is not None else {}
+        # JSON columns (Pullrequest.info, Builder.builders) are decoded on the first access
         if isinstance(instance, Builder):
-            instance.builders = json.loads(instance._builders) if instance._builders is not None else []
             if instance.internal_name in instance._context.builders:
                 b = instance._context.builders[instance.internal_name]
                 instance.isPerf = b.get('isPerf', False)
 
+    @staticmethod
+    def after_change(mapper, connection, instance):
+        getContext(object_session(instance)).db.snapshot.update(instance)
+
+    @staticmethod
+    def after_delete(mapper, connection, instance):
+        getContext(object_session(instance)).db.snapshot.remove(instance)
+
     @classmethod
     def register(cls):
         sa.event.listen(cls, 'load', cls.load)
         sa.event.listen(cls, 'before_insert', cls.create_time)
         sa.event.listen(cls, 'before_update', cls.update_time)
+        sa.event.listen(cls, 'after_insert', cls.after_change)
+        sa.event.listen(cls, 'after_update', cls.after_change)
+        sa.event.listen(cls, 'after_delete', cls.after_delete)
+        for prop in cls.__dict__.values():
+            if isinstance(prop, JSONProperty):
+                prop.register(cls)
 
     def getContext(self):
         ':rtype context.Context'
@@ -232,6 +566,7 @@ class Pullrequest(Base, BaseMixin):
     head_branch = sa.Column(sa.String)
     head_sha = sa.Column(sa.String)
     _jsoninfo = sa.Column('info', sa.String, default='{}', nullable=False)  # JSON string
+    info = JSONProperty('_jsoninfo', dict)
     title = sa.Column(sa.String)
     description = sa.Column(sa.String)
     priority = sa.Column(sa.Integer, default=0, nullable=False)
@@ -261,7 +596,7 @@ class Pullrequest(Base, BaseMixin):
                     s.active = False
                     # logger.info('Deactivate PR build status: %s' % repr(s))
             self._buildstatus.append(status)
-            session.commit()
+            session.flush()
         self.getContext().db.asyncRun(fn)
 
 
@@ -279,7 +614,7 @@ class Builder(Base, BaseMixin):
     internal_name = sa.Column(sa.String, unique=True, nullable=False)
     name = sa.Column(sa.String, nullable=False)
     _builders = sa.Column('builders', sa.String)  # JSON
-    builders = []
+    builders = JSONProperty('_builders', list)
     order = sa.Column(sa.Integer, default=-1, nullable=False)
     active = sa.Column(sa.BOOLEAN, default=False, nullable=False)
 
@@ -316,6 +651,7 @@ class Builder(Base, BaseMixin):
                 b.order = builder['order']
             session.commit()
             session.expire_all()
+            context.db.snapshot.reload(session)
         return context.db.asyncRun(fn)
 
 Builder.register()
@@ -332,6 +668,7 @@ class Status(Base, BaseMixin):
     build_number = sa.Column(sa.Integer)
     status = sa.Column(sa.Integer, default=BuildStatus.INQUEUE, nullable=False)
     active = sa.Column(sa.BOOLEAN, default=True)
+    queued_at = sa.Column(sa.DateTime)  # the last time of the change into INQUEUE state
 
     pr = relationship("Pullrequest", backref=backref('_buildstatus', order_by=bid))  # : :type builder: Pullrequest
     builder = relationship("Builder", backref=None)  # : :type builder: Builder
@@ -346,12 +683,392 @@ class Status(Base, BaseMixin):
 Status.register()
 
 
+# Inactive statuses older than Context.statusRetentionDays, moved by StatusConnectorComponent.archiveStatuses()
+class StatusArchive(Base):
+    __tablename__ = 'status_archive'
+
+    sid = sa.Column('id', sa.Integer, primary_key=True, autoincrement=False)
+    prid = sa.Column(sa.Integer, index=True)
+    bid = sa.Column(sa.Integer)
+    head_sha = sa.Column(sa.String)
+    brid = sa.Column(sa.Integer)
+    build_number = sa.Column(sa.Integer)
+    status = sa.Column(sa.Integer, nullable=False)
+    created_at = sa.Column(sa.DateTime, nullable=False)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+    archived_at = sa.Column(sa.DateTime, nullable=False)
+
+
+class _View(object):
+    '''
+    Read-only projection of a model row for the web layer: no ORM state and attributes instrumentation
+    '''
+    __slots__ = ()
+    model = None
+    fields = ()  # model attributes
+
+    def __init__(self, *values):
+        for name, value in zip(self.fields, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def fromInstance(cls, instance):
+        return cls(*[getattr(instance, name) for name in cls.fields])
+
+    @classmethod
+    def select(cls, session, whereclause):
+        # core select() of the columns, without ORM identity map
+        q = sa.select([getattr(cls.model, name) for name in cls.fields], whereclause)
+        return [cls(*row) for row in session.execute(q)]
+
+class PullrequestView(_View):
+    model = Pullrequest
+    fields = ('prid', 'branch', 'author', 'assignee', 'head_user', 'head_repo', 'head_branch', 'head_sha',
+              'title', 'description', 'priority', 'status', 'created_at', 'updated_at', '_jsoninfo')
+    __slots__ = fields + ('_info',)
+
+    @property
+    def info(self):
+        # decoded on the first access
+        try:
+            return self._info
+        except AttributeError:
+            self._info = json.loads(self._jsoninfo) if self._jsoninfo is not None else {}
+            return self._info
+
+    def reuseInfo(self, other):
+        # decoded 'info' of the previous view of the pull request, if the JSON is not changed
+        if other is not None and other._jsoninfo == self._jsoninfo:
+            try:
+                self._info = other._info
+            except AttributeError:
+                pass
+
+class BuilderView(_View):
+    model = Builder
+    fields = ('bid', 'internal_name', 'name', '_builders', 'order', 'active', 'created_at', 'updated_at')
+    __slots__ = fields + ('builders', 'isPerf')
+
+    def __init__(self, *values):
+        _View.__init__(self, *values)
+        self.builders = json.loads(self._builders) if self._builders is not None else []
+        self.isPerf = False
+
+class StatusView(_View):
+    model = Status
+    fields = ('sid', 'prid', 'bid', 'head_sha', 'brid', 'build_number', 'status', 'active', 'created_at', 'updated_at',
+              'queued_at')
+    __slots__ = fields
+
+
+class DataSnapshot():
+    '''
+    In-memory copy of active builders, pull requests and build statuses (read-only *View objects).
+
+    It is loaded once and then kept in sync by the mapper events of the models (applied on commit),
+    so the web resources can read it from the reactor thread without DB access.
+
+    Schedulable statuses (active, INQUEUE, of active pull requests) are indexed by
+    per-builder heaps of (priority, prid, sid). Heap entries are not removed on
+    changes, stale entries are skipped (and dropped) while reading the heap.
+    '''
+
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.RLock()
+        self.loaded = False
+        self._waiters = None
+        self.generation = int(time.time())  # distinguishes versions of different master runs
+        self.version = 0  # incremented on every DB write
+        self.changes = collections.deque(maxlen=self.changeLogSize)  # (version, prid, bid)
+        self._listeners = []
+        self._notifyPending = False
+        self.builders = {}  # bid -> Builder
+        self.pullrequests = {}  # prid -> Pullrequest
+        self.statuses = {}  # (prid, bid) -> Status
+        self.prStatuses = {}  # prid -> {bid: Status}, index of 'statuses'
+        self.queues = {}  # bid -> heap of (priority, prid, sid)
+
+    changeLogSize = 10000
+
+    def load(self):
+        if self.loaded:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        if self._waiters is None:
+            self._waiters = [d]
+            def done(res):
+                waiters, self._waiters = self._waiters, None
+                for w in waiters:
+                    w.callback(None)
+            def fail(f):
+                waiters, self._waiters = self._waiters, None
+                for w in waiters:
+                    w.errback(f)
+            self.context.db.asyncRun(self.reload).addCallbacks(done, fail)
+        else:
+            self._waiters.append(d)
+        return d
+
+    def _builderView(self, b):
+        b = BuilderView.fromInstance(b) if isinstance(b, Builder) else b
+        b.isPerf = self.context.builders.get(b.internal_name, {}).get('isPerf', False)
+        return b
+
+    def reload(self, session):
+        session.flush()
+        session._snapshotReloaded = True  # until the end of the transaction
+        builders = [self._builderView(b) for b in BuilderView.select(session, Builder.active == True)]
+        prs = PullrequestView.select(session, Pullrequest.status >= 0)
+        ss = StatusView.select(session, Status.active == True)
+        with self.lock:
+            previous = self.pullrequests
+        for pr in prs:
+            # pages show 'info' of all active pull requests: it is decoded here, out of the request path
+            pr.reuseInfo(previous.get(pr.prid, None))
+            pr.info
+        with self.lock:
+            self.builders = dict((b.bid, b) for b in builders)
+            self.pullrequests = dict((pr.prid, pr) for pr in prs)
+            self.statuses = dict(((s.prid, s.bid), s) for s in ss)
+            self.prStatuses = {}
+            for s in ss:
+                self.prStatuses.setdefault(s.prid, {})[s.bid] = s
+            self._rebuildQueues()
+            self.loaded = True
+            self._changed(None, None)
+
+    def getVersion(self):
+        return (self.generation, self.version)
+
+    def _changed(self, prid, bid):
+        # prid=None: everything is changed, bid=None: whole pull request is changed
+        self.version += 1
+        self.changes.append((self.version, prid, bid))
+        if not self._notifyPending:
+            self._notifyPending = True
+            reactor.callFromThread(self._notify)
+
+    def _notify(self):
+        with self.lock:
+            self._notifyPending = False
+        listeners, self._listeners = self._listeners, []
+        for d in listeners:
+            if not d.called:
+                d.callback(None)
+
+    def waitForChanges(self, timeout):
+        # Reactor thread only. Fires on the next DB write or after the timeout
+        d = defer.Deferred()
+        self._listeners.append(d)
+        timer = reactor.callLater(timeout, lambda: d.called or d.callback(None))
+        def cleanup(res):
+            if timer.active():
+                timer.cancel()
+            if d in self._listeners:
+                self._listeners.remove(d)
+            return res
+        d.addBoth(cleanup)
+        return d
+
+    def getChangesSince(self, since):
+        '''
+        Returns (version, changes) with the set of (prid, bid) changed after the 'since' version.
+        bid is None for changes of the whole pull request, changes is None if the change log doesn't
+        reach 'since' and the client must reload everything.
+        '''
+        with self.lock:
+            version = self.version
+            if since > version or (len(self.changes) > 0 and self.changes[0][0] > since + 1):
+                return (version, None)
+            result = set()
+            for v, prid, bid in reversed(self.changes):
+                if v <= since:
+                    break
+                if prid is None:
+                    return (version, None)
+                result.add((prid, bid))
+            return (version, result)
+
+    # Mapper events of a flush are recorded in the session and applied on commit, they are dropped on rollback
+
+    def update(self, instance):
+        if isinstance(instance, Pullrequest):
+            change = (Pullrequest, instance.prid, PullrequestView.fromInstance(instance) if instance.status >= 0 else None)
+        elif isinstance(instance, Builder):
+            change = (Builder, instance.bid, self._builderView(instance) if instance.active else None)
+        elif isinstance(instance, Status):
+            change = (Status, instance.prid, instance.bid, instance.sid, StatusView.fromInstance(instance) if instance.active else None)
+        else:
+            return
+        self._addChange(object_session(instance), change)
+
+    def remove(self, instance):
+        if isinstance(instance, Pullrequest):
+            change = (Pullrequest, instance.prid, None)
+        elif isinstance(instance, Builder):
+            change = (Builder, instance.bid, None)
+        elif isinstance(instance, Status):
+            change = (Status, instance.prid, instance.bid, instance.sid, None)
+        else:
+            return
+        self._addChange(object_session(instance), change)
+
+    def _addChange(self, session, change):
+        changes = getattr(session, '_snapshotChanges', None)
+        if changes is None:
+            changes = session._snapshotChanges = []
+        changes.append(change)
+
+    def onCommit(self, session):
+        changes = getattr(session, '_snapshotChanges', None)
+        session._snapshotChanges = None
+        session._snapshotReloaded = False
+        if not changes:
+            return
+        with self.lock:
+            for change in changes:
+                self._apply(change)
+
+    def onRollback(self, session):
+        session._snapshotChanges = None
+        if getattr(session, '_snapshotReloaded', False):
+            # reload() has read uncommitted rows, it is repeated by the next load()
+            session._snapshotReloaded = False
+            with self.lock:
+                self.loaded = False
+                self._changed(None, None)
+
+    def _apply(self, change):
+        if change[0] is Pullrequest:
+            (_, prid, view) = change
+            if view is not None:
+                current = self.pullrequests.get(prid, None)
+                view.reuseInfo(current)
+                self.pullrequests[prid] = view
+                if current is None or current.priority != view.priority:
+                    # entries of the statuses are stale (or missing for inactive pull request)
+                    for st in self.prStatuses.get(prid, {}).values():
+                        self._enqueue(st)
+            else:
+                self.pullrequests.pop(prid, None)
+            self._changed(prid, None)
+        elif change[0] is Builder:
+            (_, bid, view) = change
+            if view is not None:
+                self.builders[bid] = view
+            else:
+                self.builders.pop(bid, None)
+            self._changed(None, None)
+        elif change[0] is Status:
+            (_, prid, bid, sid, view) = change
+            key = (prid, bid)
+            if view is not None:
+                self.statuses[key] = view
+                self.prStatuses.setdefault(prid, {})[bid] = view
+                self._enqueue(view)
+            else:
+                current = self.statuses.get(key, None)
+                if current is not None and current.sid == sid:
+                    del self.statuses[key]
+                    bstatuses = self.prStatuses.get(prid, {})
+                    bstatuses.pop(bid, None)
+                    if not bstatuses:
+                        self.prStatuses.pop(prid, None)
+            self._changed(prid, bid)
+
+    def _getQueueEntry(self, st):
+        if not st.active or st.status != constants.BuildStatus.INQUEUE or st.sid is None:
+            return None
+        pr = self.pullrequests.get(st.prid, None)
+        if pr is None:
+            return None
+        return (pr.priority, st.prid, st.sid)
+
+    def _enqueue(self, st):
+        e = self._getQueueEntry(st)
+        if e is None:
+            return
+        queue = self.queues.setdefault(st.bid, [])
+        heapq.heappush(queue, e)
+        if len(queue) > 2 * len(self.statuses) + 100:
+            self._rebuildQueues()
+
+    def _rebuildQueues(self):
+        queues = {}
+        for st in self.statuses.values():
+            e = self._getQueueEntry(st)
+            if e is not None:
+                queues.setdefault(st.bid, []).append(e)
+        for queue in queues.values():
+            heapq.heapify(queue)
+        self.queues = queues
+
+    def getStatusesToSchedule(self, bid, limit):
+        '''
+        Returns up to 'limit' schedulable statuses (StatusView) of the builder in the scheduling order
+        '''
+        result = []
+        with self.lock:
+            queue = self.queues.get(bid, [])
+            seen = set()
+            taken = []
+            while queue and len(result) < limit:
+                e = heapq.heappop(queue)
+                (priority, prid, sid) = e
+                st = self.statuses.get((prid, bid), None)
+                if st is None or st.sid != sid or self._getQueueEntry(st) != e or sid in seen:
+                    continue  # stale entry
+                seen.add(sid)
+                taken.append(e)
+                result.append(st)
+            for e in taken:
+                heapq.heappush(queue, e)
+        return result
+
+    def getQueuedJobs(self, bid):
+        '''
+        Returns (queued, running) lists of schedulingpolicy.Job of the builder, Job.key is StatusView
+        '''
+        queued = []
+        running = []
+        with self.lock:
+            for (prid, _bid), st in self.statuses.items():
+                if _bid != bid:
+                    continue
+                pr = self.pullrequests.get(prid, None)
+                if pr is None:
+                    continue
+                # updated_at is changed by any flush of the row, queued_at is NULL in rows of old versions
+                job = Job(st, prid, pr.author, pr.priority, getTimestamp(st.queued_at or st.created_at))
+                if self._getQueueEntry(st) is not None:
+                    queued.append(job)
+                elif st.status in [constants.BuildStatus.SCHEDULING, constants.BuildStatus.SCHEDULED, constants.BuildStatus.BUILDING]:
+                    running.append(job)
+        return (queued, running)
+
+    def getActiveBuilders(self):
+        with self.lock:
+            builders = self.builders.values()
+        return sorted(builders, key=lambda b: b.order)
+
+    def getActivePullRequests(self):
+        with self.lock:
+            prs = self.pullrequests.values()
+        return sorted(prs, key=lambda pr: pr.prid, reverse=True)
+
+    def getActiveStatusIndex(self):
+        # (prid, bid) -> Status
+        with self.lock:
+            return dict((k, s) for k, s in self.statuses.items() if k[0] in self.pullrequests)
+
+
 class Database():
 
     def __init__(self, context):
         context.db = self
         self.context = context
-        self.engine = sa.create_engine('sqlite:///%s.sqlite' % context.dbname, echo=context.debug_db)
+        self.engine = _createEngine(context)
         self.engine.user_context = context
 
         if context.debug_db:
@@ -362,6 +1079,14 @@ class Database():
         self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
 
         context.thread = PRDBThread(context)
+        sa.event.listen(self.Session, 'after_commit', context.thread.onCommit)
+        self.readThreads = PRDBReadThreadPool(context)
+
+        self.snapshot = DataSnapshot(context)
+        sa.event.listen(self.Session, 'after_commit', self.snapshot.onCommit)
+        sa.event.listen(self.Session, 'after_rollback', self.snapshot.onRollback)
+
+        self.stats = DBStats()
 
         self.prcc = PullRequestConnectorComponent(self)
         self.bcc = BuilderConnectorComponent(self)
@@ -370,14 +1095,31 @@ class Database():
         Base.metadata.create_all(self.engine)
 
         # TODO: use DB migrations
-        try:
-            sa.Index('pullrequest_status', Pullrequest.status).create(self.engine)
-            sa.Index('status_active', Status.active).create(self.engine)
-            sa.Index('status_prid', Status.prid).create(self.engine)
-            sa.Index('status_bid', Status.bid).create(self.engine)
-        except:
-            # already exists
-            pass
+        for table, column in [(Status.__table__, Status.__table__.c.queued_at)]:
+            try:
+                self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                        table.name, column.name, column.type.compile(dialect=self.engine.dialect)))
+            except:
+                # already exists
+                pass
+        for index in [
+                sa.Index('pullrequest_status', Pullrequest.status),
+                sa.Index('status_active', Status.active),
+                sa.Index('status_prid', Status.prid),
+                sa.Index('status_bid', Status.bid),
+                # delta queries (changed_since)
+                sa.Index('pullrequest_updated_at', Pullrequest.updated_at, Pullrequest.status),
+                sa.Index('status_updated_at', Status.updated_at, Status.prid, Status.bid),
+                # getStatusForBuildRequest() / getStatusForBuildNumber()
+                sa.Index('status_prid_bid_brid', Status.prid, Status.bid, Status.brid),
+                sa.Index('status_prid_bid_build_number', Status.prid, Status.bid, Status.build_number),
+                # status compaction
+                sa.Index('status_active_updated_at', Status.active, Status.updated_at)]:
+            try:
+                index.create(self.engine)
+            except:
+                # already exists
+                pass
 
     def _createSession(self):
         # :rtype sqlalchemy.orm.session.Session
@@ -386,6 +1128,55 @@ class Database():
     def asyncRun(self, fn, *args, **kwargs):
         return self.context.thread.asyncRun(fn, *args, **kwargs)
 
+    def asyncRead(self, fn, *args, **kwargs):
+        return self.readThreads.asyncRead(fn, *args, **kwargs)
+
+    def isSQLite(self):
+        return self.engine.dialect.name == 'sqlite'
+
+    def getSize(self):
+        # SQLite only: (DB size in bytes, free bytes)
+        def thd(session):
+            if not self.isSQLite():
+                return (None, None)
+            pageSize = session.execute('PRAGMA page_size').scalar()
+            pageCount = session.execute('PRAGMA page_count').scalar()
+            freeCount = session.execute('PRAGMA freelist_count').scalar()
+            return (pageSize * pageCount, pageSize * freeCount)
+        return self.asyncRun(thd)
+
+    def vacuum(self, allowFull=False):
+        '''
+        SQLite only: returns free pages to the filesystem by 'PRAGMA incremental_vacuum'.
+        DB in other auto_vacuum mode needs one full VACUUM to switch the mode, it rebuilds the DB file and blocks
+        DB writes for its duration, so it is done with 'allowFull' only.
+        Returns 'incremental', 'full' or None (nothing is done)
+        '''
+        def thd(session):
+            if not self.isSQLite():
+                return None
+            session.commit()
+            if session.execute('PRAGMA auto_vacuum').scalar() == 2:  # INCREMENTAL
+                # each fetched row is a freed page, SQLAlchemy treats the result as rowless (empty description)
+                cursor = session.connection().connection.cursor()
+                try:
+                    cursor.execute('PRAGMA incremental_vacuum')
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+                return 'incremental'
+            session.commit()
+            if not allowFull:
+                return None
+            connection = self.engine.connect()
+            try:
+                connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                connection.execute('VACUUM')
+            finally:
+                connection.close()
+            return 'full'
+        return self.asyncRun(thd)
+
     def asyncRunEx(self, fn, *args, **kwargs):
         return self.context.thread.asyncRunEx(fn, *args, **kwargs)
 
@@ -408,10 +1199,17 @@ class PullRequestConnectorComponent():
             return prs
         return self.db.asyncRun(thd)
 
+    def getPullRequestsChangedSince(self, updated_at):
+        # returns [(prid, status)]
+        def thd(session):
+            rows = session.query(Pullrequest.prid, Pullrequest.status).filter(Pullrequest.updated_at >= updated_at).all()
+            return [tuple(row) for row in rows]
+        return self.db.asyncRead(thd)
+
     def insertPullRequest(self, pr):
         def thd(session):
             session.add(pr)
-            session.commit()
+            session.flush()
             # session.expunge(pr)
             return pr
         return self.db.asyncRun(thd)
@@ -419,7 +1217,7 @@ class PullRequestConnectorComponent():
     def updatePullRequest(self, pr):
         def thd(session):
             _pr = session.merge(pr)
-            session.commit()
+            session.flush()
             # session.expunge(_pr)
             return _pr
         return self.db.asyncRun(thd)
@@ -452,7 +1250,7 @@ class BuilderConnectorComponent():
     def insertBuilder(self, b):
         def thd(session):
             _b = session.add(b)
-            session.commit()
+            session.flush()
             # session.expunge(_b)
             return _b
         return self.db.asyncRun(thd)
@@ -460,7 +1258,7 @@ class BuilderConnectorComponent():
     def updateBuilder(self, b):
         def thd(session):
             _b = session.merge(b)
-            session.commit()
+            session.flush()
             # session.expunge(_b)
             return _b
         return self.db.asyncRun(thd)
@@ -490,22 +1288,29 @@ class StatusConnectorComponent():
     def insertStatus(self, s):
         def thd(session):
             _s = session.add(s)
-            session.commit()
+            session.flush()
             return _s
         return self.db.asyncRun(thd)
 
     def updateStatus(self, s):
         def thd(session):
             _s = session.merge(s)
-            session.commit()
+            session.flush()
             return _s
         return self.db.asyncRun(thd)
 
+    def updateStatuses(self, statuses):
+        def thd(session):
+            _statuses = [session.merge(s) for s in statuses]
+            session.flush()
+            return _statuses
+        return self.db.asyncRun(thd)
+
     def deleteStatus(self, s):
         def thd(session):
             _s = session.merge(s)
             session.delete(_s)
-            session.commit()
+            session.flush()
             return
         return self.db.asyncRun(thd)
 
@@ -523,18 +1328,98 @@ class StatusConnectorComponent():
             return ss
         return self.db.asyncRun(thd)
 
+    def archiveStatuses(self, updated_before, limit):
+        '''
+        Moves up to 'limit' inactive statuses updated before 'updated_before' into the status_archive table.
+        Returns number of archived rows
+        '''
+        def thd(session):
+            st = Status.__table__
+            rows = session.execute(sa.select([st])
+                    .where(st.c.active == False)
+                    .where(st.c.updated_at < updated_before)
+                    .order_by(st.c.id)
+                    .limit(limit)).fetchall()
+            if not rows:
+                return 0
+            now = datetime.datetime.utcnow()
+            session.execute(StatusArchive.__table__.insert(),
+                    [dict(id=row['id'], prid=row['prid'], bid=row['bid'], head_sha=row['head_sha'], brid=row['brid'],
+                          build_number=row['build_number'], status=row['status'],
+                          created_at=row['created_at'], updated_at=row['updated_at'], archived_at=now)
+                     for row in rows])
+            sids = [row['id'] for row in rows]
+            session.execute(st.delete().where(st.c.id.in_(sids)))
+            # rows are removed bypassing ORM: drop loaded objects and collections
+            for row in rows:
+                s = session.identity_map.get(sa.orm.util.identity_key(Status, row['id']), None)
+                pr = session.identity_map.get(sa.orm.util.identity_key(Pullrequest, row['prid']), None)
+                if pr is not None:
+                    session.expire(pr, ['_buildstatus'])
+                if s is not None:
+                    session.expunge(s)
+            return len(rows)
+        return self.db.asyncRun(thd)
+
+    def getStatusesChangedSince(self, updated_at):
+        # returns [(prid, bid)], including deactivated statuses
+        def thd(session):
+            rows = session.query(Status.prid, Status.bid).filter(Status.updated_at >= updated_at).distinct().all()
+            return [tuple(row) for row in rows]
+        return self.db.asyncRead(thd)
+
+    def _queryStatusesToSchedule(self, session, bid):
+        return session.query(Status) \
+                .join(Pullrequest, Status.prid == Pullrequest.prid) \
+                .filter(Status.active == True) \
+                .filter(Status.status == constants.BuildStatus.INQUEUE) \
+                .filter(Status.bid == bid) \
+                .filter(Pullrequest.status >= 0) \
+                .order_by(Pullrequest.priority) \
+                .order_by(Pullrequest.prid)
+
+    def _getStatusesToSchedule(self, session, bid, limit):
+        snapshot = self.db.snapshot
+        if not snapshot.loaded:
+            return self._queryStatusesToSchedule(session, bid).limit(limit).all()
+        policy = self.db.context.schedulingPolicy
+        if policy is not None and not policy.strictOrder:
+            (queued, running) = snapshot.getQueuedJobs(bid)
+            views = [job.key for job in policy.select(queued, running, limit, time.time())]
+        else:
+            if self.db.context.debug:
+                self._checkScheduleQueue(session, bid)
+            views = snapshot.getStatusesToSchedule(bid, limit)
+        return [session.query(Status).get(v.sid) for v in views]
+
     def getStatusToSchedule(self, bid):
         def thd(session):
-            s_pr = session.query(Status, Pullrequest) \
-                    .filter(Status.active == True) \
-                    .filter(Status.status == constants.BuildStatus.INQUEUE) \
-                    .filter(Status.bid == bid) \
-                    .order_by(Pullrequest.priority) \
-                    .order_by(Pullrequest.prid) \
-                    .first()
-            return s_pr[0] if s_pr is not None else None  # returns status
+            ss = self._getStatusesToSchedule(session, bid, 1)
+            return ss[0] if ss else None  # returns status
         return self.db.asyncRun(thd)
 
+    def getStatusesToSchedule(self, bid, limit):
+        def thd(session):
+            return self._getStatusesToSchedule(session, bid, limit)
+        return self.db.asyncRun(thd)
+
+    def checkScheduleQueue(self, bid):
+        '''
+        Compares the in-memory schedule queue of the builder with the DB, the queue is rebuilt on mismatch
+        '''
+        return self.db.asyncRun(lambda session: self._checkScheduleQueue(session, bid))
+
+    def _checkScheduleQueue(self, session, bid):
+        expected = [s.sid for s in self._queryStatusesToSchedule(session, bid).all()]
+        snapshot = self.db.snapshot
+        actual = [s.sid for s in snapshot.getStatusesToSchedule(bid, len(expected) + 1)]
+        if actual != expected:
+            logger.error('Schedule queue of builder %s is inconsistent: queue=%s db=%s' % (bid, actual, expected))
+            with snapshot.lock:
+                snapshot._rebuildQueues()
+            return False
+        return True
+
 def mainThreadCall(fn, *args, **kwargs):
     d = defer.Deferred()
     def callback(_):
@@ -543,13 +1428,22 @@ def mainThreadCall(fn, *args, **kwargs):
     return d
 
 def DBMethodCall(fn):
+    operation = _getOperationName(fn)
     def wrap(*args, **kwargs):
         self = args[0]
+        context = None
         if hasattr(self, 'db'):
+            context = self.db.context
             assert self.db.context.thread.workerThread == threading.current_thread()
         if hasattr(self, 'context'):
+            context = self.context
             assert self.context.thread.workerThread == threading.current_thread()
-        return fn(*args, **kwargs)
+        start = time.time()
+        res = fn(*args, **kwargs)
+        if context is not None:
+            context.db.stats.record(operation, execute=time.time() - start, rows=_countRows(res))
+        return res
+    wrap.dbOperation = operation
     return wrap
 
 if __name__ == '__main__':
@@ -559,9 +1453,16 @@ if __name__ == '__main__':
                         level=logging.DEBUG,
                         format='%(asctime)s %(thread)d %(levelname)s %(name)s %(message)s')
 
+    # Server DB: PULLREQUEST_TEST_DB_URL=postgresql://user@localhost/buildbot [PULLREQUEST_TEST_DB_SCHEMA=test]
     class TestContext():
         dbname = 'test'
+        dbURL = os.environ.get('PULLREQUEST_TEST_DB_URL', None)
+        dbSchema = os.environ.get('PULLREQUEST_TEST_DB_SCHEMA', None)
+        dbPoolSize = None
+        dbReadThreads = 1
+        debug = False
         debug_db = False
+        schedulingPolicy = None
         builders = dict(runtests1=dict(name='t1', builders=['runtests1'], order=0),
                         runtests2=dict(name='t2', builders=['runtests2'], order=1),
                         runtests3=dict(name='t3', builders=['runtests3'], order=2),
@@ -676,6 +1577,106 @@ if __name__ == '__main__':
 
             r = yield db.asyncRun(o.test)
             print r
+
+            # failed jobs are rolled back, including changes of the snapshot
+            yield db.snapshot.load()
+            def failedJob(session, generator):
+                pr = db.prcc.getPullRequest(11)
+                pr.title = 'rolled back'
+                s = Status()
+                s.bid = 2
+                pr.addBuildStatus(s)
+                session.flush()
+                if generator:
+                    yield None
+                raise Exception('test rollback')
+            for generator in [False, True]:
+                try:
+                    yield db.asyncRun(failedJob, generator)
+                    assert False
+                except Exception as e:
+                    assert str(e) == 'test rollback', e
+                pr = yield db.prcc.getPullRequest(11)
+                s = yield db.scc.getStatus(11, 2)
+                assert pr.title != 'rolled back' and s is None, 'job is not rolled back'
+                assert db.snapshot.pullrequests[11].title != 'rolled back' and (11, 2) not in db.snapshot.statuses, \
+                        'snapshot has rolled back changes'
+            print 'Rollback: OK'
+
+            # writes of a generator job are committed before it waits for the reactor,
+            # a failed job which runs meanwhile doesn't drop them
+            suspended = defer.Deferred()
+            resume = defer.Deferred()
+            def suspend():
+                suspended.callback(None)
+                return resume
+            def suspendedJob(session):
+                pr = db.prcc.getPullRequest(11)
+                pr.title = 'before suspend'
+                yield mainThreadCall(suspend)
+                pr.assignee = 'after suspend'
+            def failedPlainJob(session):
+                raise Exception('test rollback')
+            d = db.asyncRun(suspendedJob)
+            yield suspended
+            try:
+                yield db.asyncRun(failedPlainJob)
+                assert False
+            except Exception as e:
+                assert str(e) == 'test rollback', e
+            resume.callback(None)
+            yield d
+            pr = yield db.prcc.getPullRequest(11)
+            assert pr.title == 'before suspend' and pr.assignee == 'after suspend', 'writes of suspended job are lost'
+            print 'Suspended job: OK'
+
+            # JSON columns: the decoded value is cached until the column is set, expired or reloaded
+            def jsonJob(session):
+                pr = db.prcc.getPullRequest(11)
+                info = pr.info
+                assert pr.info is info, 'decoded value is not cached'
+                pr.info = {'a': 1}
+                session.flush()
+                assert json.loads(pr._jsoninfo) == {'a': 1}, pr._jsoninfo
+                pr.info['b'] = 2  # changed in place: dropped by the reload
+                session.refresh(pr)
+                assert pr.info == {'a': 1}, pr.info
+                pr._jsoninfo = json.dumps({'c': 3})
+                assert pr.info == {'c': 3}, pr.info
+                session.flush()
+                session.expire(pr)
+                assert pr.info == {'c': 3}, pr.info
+                pr.info = info
+            yield db.asyncRun(jsonJob)
+            print 'JSON columns: OK'
+
+            # queued_at: the last time of the change into INQUEUE state (age of the job for scheduling policies)
+            def setStatusJob(session, status):
+                s = db.scc.getStatus(11, 1)
+                s.status = status
+                s.build_number = -1 if status == BuildStatus.INQUEUE else 1
+                session.flush()
+                return (s.created_at, s.queued_at)
+            created_at, queued_at = yield db.asyncRun(setStatusJob, BuildStatus.BUILDING)
+            assert queued_at == created_at, (queued_at, created_at)
+            _, requeued_at = yield db.asyncRun(setStatusJob, BuildStatus.INQUEUE)
+            assert requeued_at > queued_at, (requeued_at, queued_at)
+            _, queued_at = yield db.asyncRun(setStatusJob, BuildStatus.INQUEUE)
+            assert queued_at == requeued_at, 'queued_at is changed by update of the queued status'
+            (queued, _) = db.snapshot.getQueuedJobs(1)
+            assert [job.queued_at for job in queued if job.key.prid == 11] == [getTimestamp(requeued_at)]
+            print 'Queued time: OK'
+
+            # SQLite: full VACUUM is done once (it switches the DB into incremental auto_vacuum mode)
+            n = yield db.scc.archiveStatuses(datetime.datetime.utcnow(), 100)
+            mode = yield db.vacuum(allowFull=False)
+            assert mode in ([None, 'incremental'] if db.isSQLite() else [None]), mode
+            mode = yield db.vacuum(allowFull=True)
+            assert mode in (['full', 'incremental'] if db.isSQLite() else [None]), mode
+            mode = yield db.vacuum(allowFull=True)
+            assert mode == ('incremental' if db.isSQLite() else None), mode
+            size = yield db.getSize()
+            print 'Archived statuses: %d, vacuum: OK, DB size: %s' % (n, size)
         except:
             log.err()
         finally:
@@ -1,9 +1,12 @@
 import cgi
 import datetime
+import hashlib
 import logging
+import time
 
 from twisted.internet import defer
 from twisted.web import resource
+from twisted.web import http
 from twisted.web import server
 from twisted.web.resource import NoResource
 
@@ -16,27 +19,46 @@ from .constants import BuildStatus
 from buildbot.status.web.status_json import RequestArgToBool
 from twisted.web.server import Request
 from twisted.python import log
-from pullrequest.utils import NotFound, Forbidden, NeedUpdate, Conflict, BadRequest, RequestArg
-from pullrequest.database import getTimestamp, mainThreadCall, DBMethodCall
+from pullrequest.utils import NotFound, Forbidden, NeedUpdate, Conflict, BadRequest, RequestArg, ResponseCache
+from pullrequest.database import getTimestamp
 from twisted.python.failure import Failure
 
 logger = logging.getLogger(__package__)
 
+def _toId(v):
+    # Object IDs from URL paths are strings
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+@defer.inlineCallbacks
+def getVisibility(authz, request):
+    # (showOperations, showPerf, showRevertOperation), evaluated once per request
+    visibility = getattr(request, '_pullrequestVisibility', None)
+    if visibility is None:
+        showOperations = yield authz.actionAllowed('forceBuild', request)
+        showPerf = yield authz.actionAllowed('prShowPerf', request)
+        showRevertOperation = yield authz.actionAllowed('prRevertBuild', request)
+        visibility = (bool(showOperations), bool(showPerf), bool(showRevertOperation))
+        request._pullrequestVisibility = visibility
+    defer.returnValue(visibility)
+
+# Pullrequest fields of the API, besides 'id', 'created_at', 'updated_at'
+pullrequestInfoFields = ['branch', 'author', 'assignee', 'head_user', 'head_repo', 'head_branch', 'head_sha',
+                         'title', 'description', 'priority', 'status', 'info']
+
 class ApiData(AccessorMixin):
     def __init__(self, context, request):
         self.context = context
         self.request = request
 
-    @DBMethodCall
+    @defer.inlineCallbacks
     def initialize(self, publicOnly=False):
         self.authz = self.getAuthz(self.request)
         if not publicOnly:
-            @defer.inlineCallbacks
-            def fn():
-                self.showOperations = yield self.authz.actionAllowed('forceBuild', self.request)
-                self.showPerf = yield self.authz.actionAllowed('prShowPerf', self.request)
-                self.showRevertOperation = yield self.authz.actionAllowed('prRevertBuild', self.request)
-            yield mainThreadCall(fn)
+            (self.showOperations, self.showPerf, self.showRevertOperation) = \
+                    yield getVisibility(self.authz, self.request)
         else:
             self.showOperations = False
             self.showPerf = False
@@ -44,11 +66,15 @@ class ApiData(AccessorMixin):
         self.db = db = self.context.db
         assert(isinstance(db, database.Database))
 
-        self.active_builders = db.bcc.getActiveBuilders()
-        self.active_pullrequests = db.prcc.getActivePullRequests()
-        self.all_bstatuses = db.scc.getAllActiveStatuses()
+        snapshot = db.snapshot
+        if not snapshot.loaded:
+            yield snapshot.load()
+        self.active_builders = snapshot.getActiveBuilders()
+        self.active_pullrequests = snapshot.getActivePullRequests()
+        self.bstatuses = snapshot.getActiveStatusIndex()  # (prid, bid) -> StatusView
+        self.builders_by_id = dict((b.bid, b) for b in self.active_builders)
+        self.pullrequests_by_id = dict((pr.prid, pr) for pr in self.active_pullrequests)
 
-    @DBMethodCall
     def getBuildersList(self):
         result = {}
         for builder in self.active_builders:
@@ -61,20 +87,11 @@ class ApiData(AccessorMixin):
         return result
 
     def getPr(self, prid):
-        prs = [pr for pr in self.active_pullrequests if str(pr.prid) == str(prid)]
-        if len(prs) == 0:
-            return None
-        assert len(prs) == 1
-        return prs[0]
+        return self.pullrequests_by_id.get(_toId(prid), None)
 
     def getBuilder(self, bid):
-        b = [b for b in self.active_builders if str(b.bid) == str(bid)]
-        if len(b) == 0:
-            return None
-        assert len(b) == 1
-        return b[0]
+        return self.builders_by_id.get(_toId(bid), None)
 
-    @DBMethodCall
     def getPullrequestInfo(self, pr=None, prid=None):
         if pr is None:
             pr = self.getPr(prid)
@@ -82,15 +99,11 @@ class ApiData(AccessorMixin):
                 return None
 
         result = {}
-        dict_ = pr.__dict__
-        for k, v in dict_.items():
-            if k.startswith('_'):
-                continue
-            if k in ['created_at', 'updated_at']:
-                v = getTimestamp(v)
-            if k == 'prid':
-                k = 'id'
-            result[k] = v
+        for k in pullrequestInfoFields:
+            result[k] = getattr(pr, k)
+        result['id'] = pr.prid
+        result['created_at'] = getTimestamp(pr.created_at)
+        result['updated_at'] = getTimestamp(pr.updated_at)
         result['url'] = self.context.getWebAddressPullRequest(pr)
 
         testFilter = self.context.extractRegressionTestFilter(pr.description)
@@ -102,7 +115,6 @@ class ApiData(AccessorMixin):
 
         return result
 
-    @DBMethodCall
     def getPullrequestStatusShort(self, pr=None, prid=None):
         if pr is None:
             pr = self.getPr(prid)
@@ -115,20 +127,16 @@ class ApiData(AccessorMixin):
         return result
 
 
-    @DBMethodCall
     def getPullrequestStatuses(self, pr):
-        bstatuses = [s for s in self.all_bstatuses if str(s.prid) == str(pr.prid)]
-
         result = {}
         for b in self.active_builders:
-            s = self.getPullrequestStatus(pr=pr, bid=b.bid, bstatuses=bstatuses)
+            s = self.getPullrequestStatus(pr=pr, b=b)
 
             if s:
                 result[b.bid] = s
         return result
 
-    @DBMethodCall
-    def getPullrequestStatus(self, pr=None, prid=None, b=None, bid=None, bstatuses=None, shortMode=False):
+    def getPullrequestStatus(self, pr=None, prid=None, b=None, bid=None, shortMode=False):
         if pr is None:
             pr = self.getPr(prid)
             if pr is None:
@@ -141,16 +149,12 @@ class ApiData(AccessorMixin):
                 return None
         bid = b.bid
 
-        if bstatuses is None:
-            bstatuses = [s for s in self.all_bstatuses if str(s.prid) == str(prid)]
-
         if b.isPerf and not self.showPerf:
             return None
 
         testFilter = self.context.extractRegressionTestFilter(pr.description)
 
-        bstatus = [s for s in bstatuses if str(s.bid) == str(bid)]
-        bstatus = bstatus[0] if len(bstatus) > 0 else None
+        bstatus = self.bstatuses.get((prid, bid), None)
 
         s = {}
         operations = []
@@ -208,29 +212,65 @@ class ApiData(AccessorMixin):
             return s
         return None
 
-    @DBMethodCall
     def getPullrequestStatusesShort(self, pr):
-        bstatuses = [s for s in self.all_bstatuses if str(s.prid) == str(pr.prid)]
-
         result = {}
         for b in self.active_builders:
-            s = self.getPullrequestStatus(pr=pr, bid=b.bid, bstatuses=bstatuses, shortMode=True)
+            s = self.getPullrequestStatus(pr=pr, b=b, shortMode=True)
 
             if s:
                 result[b.name] = s
         return result
 
-class JsonResource(resource.Resource):
+responseCache = ResponseCache()
+
+changesReadMargin = datetime.timedelta(seconds=10)
+
+@defer.inlineCallbacks
+def getChangesSince(context, request):
+    '''
+    Handles 'changed_since=<timestamp>' parameter of the delta requests.
+    Returns None for full requests, otherwise (high water mark, set of changed prids).
+    '''
+    changed_since = RequestArg(request, 'changed_since', None)
+    if changed_since is None:
+        defer.returnValue(None)
+    try:
+        updated_at = database.fromTimestamp(changed_since)
+    except (TypeError, ValueError, OverflowError):
+        raise BadRequest('Invalid changed_since parameter: %s' % changed_since)
+    db = context.db
+    def fn(session):
+        # Read runs concurrently with the writer: transactions committed after this read may have
+        # earlier updated_at values, so the high water mark is moved back by the margin
+        now = datetime.datetime.utcnow() - changesReadMargin
+        prs = db.prcc.getPullRequestsChangedSince(updated_at)
+        ss = db.scc.getStatusesChangedSince(updated_at)
+        prids = set([prid for prid, _ in prs]) | set([prid for prid, _ in ss])
+        return (getTimestamp(now), prids)
+    res = yield db.asyncRead(fn)
+    defer.returnValue(res)
+
+class JsonResource(resource.Resource, AccessorMixin):
     requiredAuthAction = None
+    cacheable = False
 
     def getRequiredAuthAction(self, request):
         return self.requiredAuthAction
 
+    def getCacheKey(self, request):
+        # returns (key, version) or None to disable response caching
+        return None
+
     def render(self, request):
         assert isinstance(request, Request)
+        disconnected = []
+        request.notifyFinish().addErrback(lambda _: disconnected.append(True))
         @defer.inlineCallbacks
         def handle():
             try:
+                compact = RequestArgToBool(request, 'compact', False)
+                data = None
+                httpCode = None
                 try:
                     authAction = self.getRequiredAuthAction(request)
                     if authAction is not None:
@@ -240,9 +280,35 @@ class JsonResource(resource.Resource):
                             logger.info("Auth action '%s' is not allowed: %s" % (authAction, request.uri))
                             raise Forbidden('Not allowed: %s' % request.uri)
 
-                    data = yield self.asDict(request)
+                    cacheKey = None
+                    if self.cacheable and authAction is None and request.method in ['GET', 'HEAD']:
+                        cacheKey = yield self.getCacheKey(request)
+                    if cacheKey is not None:
+                        key, version = cacheKey
+                        cacheKey = (request.path, compact, key)
+                        etag = '"%s"' % hashlib.sha1(repr((cacheKey, version))).hexdigest()
+                        if request.setETag(etag) == http.CACHED:
+                            request.setHeader("Access-Control-Allow-Origin", "*")
+                            request.setHeader("Cache-Control", "no-cache")
+                            request.finish()
+                            return
+                        data = responseCache.get(cacheKey, version)
+
                     if data is None:
-                        raise NotFound("Not found: %s" % request.uri)
+                        res = yield self.asDict(request)
+                        if res is None:
+                            raise NotFound("Not found: %s" % request.uri)
+                        assert isinstance(res, dict)
+                        if '_httpCode' in res:
+                            data = res
+                        else:
+                            if compact:
+                                data = json.dumps(res, sort_keys=True, separators=(',', ':'))
+                            else:
+                                data = json.dumps(res, sort_keys=True, indent=2)
+                            data = data.encode("utf-8")
+                            if cacheKey is not None:
+                                responseCache.put(cacheKey, version, data)
                 except NotFound as e:
                     data = dict(message=str(e), _httpCode=404)
                 except Forbidden as e:
@@ -257,18 +323,16 @@ class JsonResource(resource.Resource):
                     log.err()
                     data = dict(message=str(e), _httpCode=500)
 
-                assert isinstance(data, dict)
-                httpCode = data.get('_httpCode', None)
-                if httpCode is not None:
-                    request.setResponseCode(httpCode)
-                    del data['_httpCode']
-
-                compact = RequestArgToBool(request, 'compact', False)
-                if compact:
-                    data = json.dumps(data, sort_keys=True, separators=(',', ':'))
-                else:
-                    data = json.dumps(data, sort_keys=True, indent=2)
-                data = data.encode("utf-8")
+                if isinstance(data, dict):
+                    httpCode = data.pop('_httpCode', None)
+                    if httpCode is not None:
+                        request.setResponseCode(httpCode)
+                        request.responseHeaders.removeHeader('ETag')
+                    if compact:
+                        data = json.dumps(data, sort_keys=True, separators=(',', ':'))
+                    else:
+                        data = json.dumps(data, sort_keys=True, indent=2)
+                    data = data.encode("utf-8")
 
                 request.setHeader("Access-Control-Allow-Origin", "*")
                 request.setHeader("content-type", "application/json")
@@ -278,9 +342,11 @@ class JsonResource(resource.Resource):
                         request.setHeader("content-disposition",
                                           "attachment; filename=\"%s.json\"" % request.path)
 
-                # Make sure we get fresh pages.
-                request.setHeader("Pragma", "no-cache")
+                # Make sure we get fresh pages (revalidated via ETag).
+                request.setHeader("Cache-Control", "no-cache")
 
+                if disconnected:
+                    return
                 request.write(data)
                 request.finish()
             except Exception as e:
@@ -294,8 +360,25 @@ class JsonResource(resource.Resource):
         raise NotImplementedError()
 
 
+class CachedApiDataMixin():
+    publicOnly = False
+    cacheable = True
+
+    @defer.inlineCallbacks
+    def getCacheKey(self, request):
+        if RequestArg(request, 'changed_since', None) is not None:
+            defer.returnValue(None)
+        if self.publicOnly:
+            visibility = 'public'
+        else:
+            visibility = yield getVisibility(self.getAuthz(request), request)
+        # "last_update" fields are relative to the render time, so cached responses expire periodically too
+        version = self.context.db.snapshot.getVersion() + (int(time.time() / self.context.responseCacheTTL),)
+        defer.returnValue((visibility, version))
+
+
 # /pullrequest*
-class PullRequestsResource(JsonResource):
+class PullRequestsResource(CachedApiDataMixin, JsonResource):
 
     def __init__(self, *args, **kw):
         JsonResource.__init__(self)
@@ -303,25 +386,33 @@ class PullRequestsResource(JsonResource):
 
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            import time
-            start = time.time()
+        start = time.time()
+
+        changes = yield getChangesSince(self.context, request)
 
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize()
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize()
 
-            result = {}
-            result['builders'] = yield apiData.getBuildersList()
+        result = {}
+        result['builders'] = apiData.getBuildersList()
 
-            result['pullrequests'] = {}
+        result['pullrequests'] = {}
+        if changes is None:
             for prOrigin in apiData.active_pullrequests:
-                pr = yield apiData.getPullrequestInfo(pr=prOrigin)
+                pr = apiData.getPullrequestInfo(pr=prOrigin)
                 result['pullrequests'][prOrigin.prid] = pr
+        else:
+            result['high_water_mark'], prids = changes
+            result['removed'] = []
+            for prid in prids:
+                pr = apiData.getPullrequestInfo(prid=prid)
+                if pr is None:
+                    result['removed'].append(prid)
+                else:
+                    result['pullrequests'][prid] = pr
 
-            end = time.time()
-            print 'PR API status time: %s' % (end - start)
-            defer.returnValue(result)
-        result = yield self.context.db.asyncRun(fn)
+        end = time.time()
+        print 'PR API status time: %s' % (end - start)
         defer.returnValue(result)
 
     def getChild(self, path, req):
@@ -336,7 +427,7 @@ class PullRequestsResource(JsonResource):
             return NoResource("No such pullrequest '%s'" % cgi.escape(path))
 
 
-class OnePullRequestResource(JsonResource):
+class OnePullRequestResource(CachedApiDataMixin, JsonResource):
     def __init__(self, context, prid):
         JsonResource.__init__(self)
         self.context = context
@@ -350,17 +441,16 @@ class OnePullRequestResource(JsonResource):
 
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize()
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize()
 
-            result = yield apiData.getPullrequestInfo(prid=self.prid)
-            defer.returnValue(result)
-        result = yield self.context.db.asyncRun(fn)
+        result = apiData.getPullrequestInfo(prid=self.prid)
         defer.returnValue(result)
 
 # for merge service
-class OnePullRequestStatusResource(JsonResource):
+class OnePullRequestStatusResource(CachedApiDataMixin, JsonResource):
+    publicOnly = True
+
     def __init__(self, context, prid):
         JsonResource.__init__(self)
         self.context = context
@@ -368,35 +458,109 @@ class OnePullRequestStatusResource(JsonResource):
 
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize(publicOnly=True)
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize(publicOnly=True)
 
-            result = yield apiData.getPullrequestStatusShort(prid=self.prid)
-            defer.returnValue(result)
-        result = yield self.context.db.asyncRun(fn)
+        result = apiData.getPullrequestStatusShort(prid=self.prid)
         defer.returnValue(result)
 
 # for merge service
-class PullRequestsStatusResource(JsonResource):
+class PullRequestsStatusResource(CachedApiDataMixin, JsonResource):
+    publicOnly = True
+
     def __init__(self, context):
         JsonResource.__init__(self)
         self.context = context
 
+    def getChild(self, path, req):
+        if path == 'changes':
+            return PullRequestsStatusChangesResource(self.context)
+        return NoResource()
+
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize(publicOnly=True)
+        changes = yield getChangesSince(self.context, request)
 
-            result = {}
-            result['pullrequests'] = {}
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize(publicOnly=True)
+
+        result = {}
+        result['pullrequests'] = {}
+        if changes is None:
             for pr in apiData.active_pullrequests:
-                pr_status = yield apiData.getPullrequestStatusShort(prid=pr.prid)
+                pr_status = apiData.getPullrequestStatusShort(pr=pr)
                 result['pullrequests'][pr.prid] = pr_status
+        else:
+            result['high_water_mark'], prids = changes
+            result['removed'] = []
+            for prid in prids:
+                pr_status = apiData.getPullrequestStatusShort(prid=prid)
+                if pr_status is None:
+                    result['removed'].append(prid)
+                else:
+                    result['pullrequests'][prid] = pr_status
 
-            defer.returnValue(result)
-        result = yield self.context.db.asyncRun(fn)
+        defer.returnValue(result)
+
+# for merge service: long-poll for status changes
+#   /status/changes?since=<version>&generation=<generation>&timeout=<seconds>
+# Returns changed (prid, builder) entries only. PR entry is null if PR is not active anymore,
+# builder entry is null if there is no build status. 'reset' means the full status map is returned.
+class PullRequestsStatusChangesResource(JsonResource):
+    maxTimeout = 60
+
+    def __init__(self, context):
+        JsonResource.__init__(self)
+        self.context = context
+
+    @defer.inlineCallbacks
+    def asDict(self, request):
+        snapshot = self.context.db.snapshot
+        if not snapshot.loaded:
+            yield snapshot.load()
+
+        since = _toId(RequestArg(request, 'since', None))
+        generation = _toId(RequestArg(request, 'generation', None))
+        try:
+            timeout = min(float(RequestArg(request, 'timeout', 30)), self.maxTimeout)
+        except ValueError:
+            raise BadRequest('Invalid timeout parameter')
+
+        if since is None or generation not in [None, snapshot.generation]:
+            version, changes = snapshot.version, None
+        else:
+            version, changes = snapshot.getChangesSince(since)
+            if changes is not None and len(changes) == 0 and timeout > 0:
+                d = snapshot.waitForChanges(timeout)
+                request.notifyFinish().addBoth(lambda _: d.called or d.callback(None))
+                yield d
+                version, changes = snapshot.getChangesSince(since)
+
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize(publicOnly=True)
+
+        result = dict(version=version, generation=snapshot.generation)
+        prs = result['pullrequests'] = {}
+        if changes is None:
+            result['reset'] = True
+            for pr in apiData.active_pullrequests:
+                prs[pr.prid] = apiData.getPullrequestStatusShort(pr=pr)
+        else:
+            changedPRs = set([prid for prid, bid in changes if bid is None])
+            for prid in changedPRs:
+                prs[prid] = apiData.getPullrequestStatusShort(prid=prid)
+            for prid, bid in changes:
+                if prid in changedPRs:
+                    continue
+                pr = apiData.getPr(prid)
+                if pr is None:
+                    prs[prid] = None
+                    continue
+                b = apiData.getBuilder(bid)
+                if b is None or (b.isPerf and not apiData.showPerf):
+                    continue
+                entry = prs.setdefault(prid, dict(buildstatus={}))
+                entry['buildstatus'][b.name] = apiData.getPullrequestStatus(pr=pr, b=b, shortMode=True)
         defer.returnValue(result)
 
 
@@ -409,17 +573,13 @@ class OnePullRequestBuildResourceBase(JsonResource, AccessorMixin):
 
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize()
-
-            result = yield apiData.getPullrequestStatus(prid=self.prid, bid=self.bid)
-            defer.returnValue(result)
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize()
 
-        result = yield self.context.db.asyncRun(fn)
+        result = apiData.getPullrequestStatus(prid=self.prid, bid=self.bid)
         defer.returnValue(result)
 
-class OnePullRequestBuildResource(OnePullRequestBuildResourceBase):
+class OnePullRequestBuildResource(CachedApiDataMixin, OnePullRequestBuildResourceBase):
 
     def getChild(self, path, request):
         action = None
@@ -435,14 +595,10 @@ class OnePullRequestBuildResource(OnePullRequestBuildResourceBase):
 
     @defer.inlineCallbacks
     def asDict(self, request):
-        def fn(_):
-            apiData = ApiData(self.context, request)
-            yield apiData.initialize()
-
-            result = yield apiData.getPullrequestStatus(prid=self.prid, bid=self.bid)
-            defer.returnValue(result)
+        apiData = ApiData(self.context, request)
+        yield apiData.initialize()
 
-        result = yield self.context.db.asyncRun(fn)
+        result = apiData.getPullrequestStatus(prid=self.prid, bid=self.bid)
         defer.returnValue(result)
 
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+'''
+Scheduling policies of the build queue
+
+Policy selects jobs to start on a builder from the queued jobs (INQUEUE statuses):
+    policy.select(queued, running, limit, now) -> list of up to 'limit' queued jobs in start order
+Jobs are Job tuples, 'key' is the scheduled object (Status).
+
+Usage (see Context.schedulingPolicy):
+    schedulingPolicy = AgingPolicy(agingInterval=3600)
+
+Simulator replays recorded trace of one builder with each policy and reports queue latency:
+    python schedulingpolicy.py trace.json [slaves]
+Trace is JSON list of jobs:
+    [{"prid": 123, "author": "user", "priority": 0, "queued_at": 1500000000.0, "duration": 1800}, ...]
+'''
+
+import collections
+import heapq
+import json
+import sys
+
+Job = collections.namedtuple('Job', 'key prid author priority queued_at')  # queued_at: seconds
+
+
+class SchedulingPolicy(object):
+
+    # True if the order is defined by (priority, prid) only, it is served by the queue index of the DB snapshot
+    strictOrder = False
+
+    def select(self, queued, running, limit, now):
+        assert False
+
+
+class StrictPriorityPolicy(SchedulingPolicy):
+    '''
+    Pullrequest.priority, then older pull requests first
+    '''
+    strictOrder = True
+
+    def select(self, queued, running, limit, now):
+        return sorted(queued, key=lambda j: (j.priority, j.prid))[:limit]
+
+
+class AgingPolicy(SchedulingPolicy):
+    '''
+    Effective priority is raised by 'step' for each 'agingInterval' seconds of waiting
+    '''
+
+    def __init__(self, agingInterval=3600, step=1):
+        self.agingInterval = agingInterval
+        self.step = step
+
+    def getPriority(self, job, now):
+        waiting = max(0, now - job.queued_at)
+        return job.priority - self.step * int(waiting / self.agingInterval)
+
+    def select(self, queued, running, limit, now):
+        return sorted(queued, key=lambda j: (self.getPriority(j, now), j.prid))[:limit]
+
+
+class FairSharePolicy(SchedulingPolicy):
+    '''
+    Authors with fewer running jobs go first, (priority, prid) order within the same share
+    '''
+
+    def select(self, queued, running, limit, now):
+        share = collections.Counter(j.author for j in running)
+        queued = sorted(queued, key=lambda j: (j.priority, j.prid))
+        result = []
+        while queued and len(result) < limit:
+            job = min(queued, key=lambda j: share[j.author])  # min() returns the first of equal items
+            queued.remove(job)
+            share[job.author] += 1
+            result.append(job)
+        return result
+
+
+policies = collections.OrderedDict([
+    ('strict', StrictPriorityPolicy()),
+    ('aging', AgingPolicy()),
+    ('fairshare', FairSharePolicy()),
+])
+
+
+def simulate(policy, trace, slaves=1):
+    '''
+    Discrete-event simulation of one builder with 'slaves' slaves.
+    Returns list of queue latencies (seconds) of the trace jobs.
+    '''
+    if slaves < 1:
+        raise ValueError('Number of slaves should be at least 1: %s' % slaves)
+    jobs = sorted(trace, key=lambda t: t['queued_at'])
+    durations = {}
+    arrivals = []
+    for i, t in enumerate(jobs):
+        job = Job(i, t['prid'], t.get('author', None), t.get('priority', 0), float(t['queued_at']))
+        durations[i] = float(t['duration'])
+        arrivals.append(job)
+    arrivals.reverse()  # pop() returns the earliest job
+
+    finished = []  # heap of (finish time, Job)
+    queued = []
+    running = []
+    latencies = []
+    now = 0
+    while arrivals or queued or running:
+        # advance to the next event
+        events = []
+        if arrivals:
+            events.append(arrivals[-1].queued_at)
+        if finished:
+            events.append(finished[0][0])
+        now = max(now, min(events))
+        while arrivals and arrivals[-1].queued_at <= now:
+            queued.append(arrivals.pop())
+        while finished and finished[0][0] <= now:
+            running.remove(heapq.heappop(finished)[1])
+        free = slaves - len(running)
+        if free > 0 and queued:
+            for job in policy.select(queued, running, free, now):
+                queued.remove(job)
+                running.append(job)
+                latencies.append(now - job.queued_at)
+                heapq.heappush(finished, (now + durations[job.key], job))
+    return latencies
+
+
+def getLatencyStats(latencies):
+    if not latencies:
+        return dict(count=0, mean=0, p95=0)
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return dict(count=len(latencies), mean=sum(latencies) / len(latencies), p95=p95)
+
+
+def main(args):
+    if len(args) < 1:
+        print 'Usage: schedulingpolicy.py trace.json [slaves]'
+        return 1
+    with open(args[0]) as f:
+        trace = json.load(f)
+    slaves = int(args[1]) if len(args) > 1 else 1
+    if slaves < 1:
+        print 'Number of slaves should be at least 1'
+        return 1
+    print '%-12s %8s %12s %12s' % ('policy', 'jobs', 'mean (s)', 'p95 (s)')
+    for name, policy in policies.items():
+        stats = getLatencyStats(simulate(policy, trace, slaves))
+        print '%-12s %8d %12.1f %12.1f' % (name, stats['count'], stats['mean'], stats['p95'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
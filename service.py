@@ -7,6 +7,7 @@ class PullRequestsService(Service):
 
     watchLoop = None
     schedulerLoop = None
+    compactionLoop = None
 
     def __init__(self, *args, **kw):
         self.context = kw.get('context', None)
@@ -27,13 +28,17 @@ class PullRequestsService(Service):
         yield d
 
         try:
-            from .serviceloops import PullRequestsWatchLoop, SchedulerLoop
+            from .serviceloops import PullRequestsWatchLoop, SchedulerLoop, StatusCompactionLoop
 
             self.watchLoop = PullRequestsWatchLoop(self.context)
             yield self.watchLoop.start()
 
             self.schedulerLoop = SchedulerLoop(self.context)
             yield self.schedulerLoop.start();
+
+            if self.context.statusRetentionDays is not None:
+                self.compactionLoop = StatusCompactionLoop(self.context)
+                self.compactionLoop.start()
         except:
             f = failure.Failure()
             log.err(f, 'while starting PullRequest service: %s' % self.context.name)
@@ -48,6 +53,8 @@ class PullRequestsService(Service):
             self.watchLoop.stop()
         if self.schedulerLoop:
             self.schedulerLoop.stop()
+        if self.compactionLoop:
+            self.compactionLoop.stop()
 
 
     def setServiceParent(self, parent):
@@ -1,3 +1,4 @@
+import datetime
 import logging
 
 from twisted.internet import defer, reactor, task
@@ -18,7 +19,6 @@ from buildbot.status.master import Status
 
 from .constants import BuildStatus
 from pullrequest import constants, database
-from pullrequest.database import mainThreadCall
 from pullrequest.utils import NotFound, BadRequest, NeedUpdate
 
 logger = logging.getLogger(__package__)
@@ -35,14 +35,23 @@ class PullRequestsWatchLoop():
             res = yield db.prcc.getActivePullRequests()
             print "Number of active pull requests: %d" % len(res)
 
+            yield db.snapshot.load()
+
             self.context.allowScheduling = False
 
             self.isStarted = True
+            self.context.watchLoop = self
 
             task.deferLater(reactor, 1, self.updatePullRequests)
 
     def stop(self):
             self.isStarted = False
+            self.context.watchLoop = None
+
+    def getUpdateDelay(self):
+        if self.context.webhookSecret is not None:
+            return self.context.reconcilePullRequestsDelay
+        return self.context.updatePullRequestsDelay
 
     @defer.inlineCallbacks
     def updatePullRequests(self):
@@ -50,45 +59,75 @@ class PullRequestsWatchLoop():
             print 'Pull requests service is stopping, exit from update loop...'
             defer.returnValue(None)
 
-        task.deferLater(reactor, self.context.updatePullRequestsDelay, self.updatePullRequests)
+        task.deferLater(reactor, self.getUpdateDelay(), self.updatePullRequests)
 
         db = self.context.db
 
         try:
+            fetchStarted = datetime.datetime.utcnow()
             pullrequests = yield self.context.updatePullRequests()
             if pullrequests is not None:
-                processed_prs = []
-                for pullrequest in pullrequests:
-                    pr = yield self.updatePR(pullrequest)
-                    processed_prs.append(pr['id'])
-
-                active_pullrequests = yield db.prcc.getActivePullRequests()
-
-                for pullRequest in active_pullrequests:
-                    if not pullRequest.prid in processed_prs:
-                        print "Mark PR #%s inactive" % pullRequest.prid
-                        pullRequest.status = -1
-                        yield db.prcc.updatePullRequest(pullRequest)
-                        ss = yield db.asyncRun(lambda _: pullRequest.getBuildStatus())
-                        for s in ss:
-                            if s.active:
-                                try:
-                                    yield cancelBuild(s)
-                                except:
-                                    log.err()
+                (changed, deactivated) = yield db.asyncRun(self._reconcilePullRequests, pullrequests, fetchStarted)
+                for prid, head_sha, head_sha_old in changed:
+                    try:
+                        yield self.queueBuildersForPR(prid, head_sha, head_sha_old)
+                    except:
+                        log.err()
+                for pullRequest, ss in deactivated:
+                    yield self.cancelBuilds(ss)
         except:
             log.err(failure.Failure(), 'while updating pull requests: %s' % self.context.name)
             pass
 
+        self.context.allowScheduling = True
+        yield self.scheduleBuilders()
+
+    @defer.inlineCallbacks
+    def updatePullRequestFromWebhook(self, prid, pr):
+        try:
+            if pr is None:
+                pullRequest = yield self.context.db.prcc.getPullRequest(prid)
+                if pullRequest is not None and pullRequest.status >= 0:
+                    yield self.deactivatePR(pullRequest)
+            else:
+                yield self.updatePR(pr)
+        except:
+            log.err(failure.Failure(), 'while processing webhook for PR #%s: %s' % (prid, self.context.name))
+            pass
+        yield self.scheduleBuilders()
+
+    @defer.inlineCallbacks
+    def scheduleBuilders(self):
+        if not self.context.allowScheduling:
+            return
         try:
-            self.context.allowScheduling = True
-            active_bulders = yield db.bcc.getActiveBuilders()
-            for b in active_bulders:
-                yield tryScheduleForBuilder(self.context, b.builders[0])
+            active_bulders = yield self.context.db.bcc.getActiveBuilders()
+            # builders are scheduled in parallel, tryScheduleForBuilder() serializes calls for the same builder
+            results = yield defer.DeferredList([tryScheduleForBuilder(self.context, b.builders[0]) for b in active_bulders],
+                                               consumeErrors=True)
+            for (success, result) in results:
+                if not success:
+                    log.err(result, 'while scheduling builds: %s' % self.context.name)
         except:
             log.err(failure.Failure(), 'while updating pull requests: %s' % self.context.name)
             pass
 
+    @defer.inlineCallbacks
+    def deactivatePR(self, pullRequest):
+        db = self.context.db
+        print "Mark PR #%s inactive" % pullRequest.prid
+        pullRequest.status = -1
+        yield db.prcc.updatePullRequest(pullRequest)
+        ss = yield db.asyncRun(lambda _: pullRequest.getBuildStatus())
+        yield self.cancelBuilds([s for s in ss if s.active])
+
+    @defer.inlineCallbacks
+    def cancelBuilds(self, ss):
+        for s in ss:
+            try:
+                yield cancelBuild(s)
+            except:
+                log.err()
 
     @defer.inlineCallbacks
     def updatePR(self, pr):
@@ -97,30 +136,8 @@ class PullRequestsWatchLoop():
         head_sha = pr['head_sha']
 
         def fn(session):
-            head_sha_old = None
             current = db.prcc.getPullRequest(prid)
-            if current:
-                if current.status < 0:
-                    current.status = 0
-                head_sha_old = current.head_sha
-                for k in pr.keys():
-                    if k == 'id':
-                        continue
-                    v = getattr(current, k)
-                    if v != pr[k]:
-                        setattr(current, k, pr[k])
-                if current in session.dirty:
-                    persistent_info = current.info.get('persistent', None)
-                    current.info = {'persistent': persistent_info} if persistent_info is not None else {}
-                    current.info.update(pr.get('info', {}))
-                    session.commit()
-            else:
-                current = database.Pullrequest(prid)
-                for k in pr.keys():
-                    if k == 'id':
-                        continue
-                    setattr(current, k, pr[k])
-                current = db.prcc.insertPullRequest(current);
+            current, head_sha_old = self._mergePullRequest(session, current, pr)
             return head_sha_old
         head_sha_old = yield db.asyncRun(fn)
         if head_sha != head_sha_old:
@@ -128,6 +145,73 @@ class PullRequestsWatchLoop():
 
         defer.returnValue(pr)
 
+    @database.DBMethodCall
+    def _mergePullRequest(self, session, current, pr):
+        # Applies fetched PR data to the DB object (or creates a new one), returns (pullrequest, head_sha_old)
+        head_sha_old = None
+        if current:
+            if current.status < 0:
+                current.status = 0
+            head_sha_old = current.head_sha
+            for k in pr.keys():
+                if k == 'id':
+                    continue
+                v = getattr(current, k)
+                if v != pr[k]:
+                    setattr(current, k, pr[k])
+            if current in session.dirty:
+                persistent_info = current.info.get('persistent', None)
+                current.info = {'persistent': persistent_info} if persistent_info is not None else {}
+                current.info.update(pr.get('info', {}))
+        else:
+            current = database.Pullrequest(pr['id'])
+            for k in pr.keys():
+                if k == 'id':
+                    continue
+                setattr(current, k, pr[k])
+            session.add(current)
+        return current, head_sha_old
+
+    @database.DBMethodCall
+    def _reconcilePullRequests(self, session, pullrequests, fetchStarted=None):
+        '''
+        Applies the full list of fetched pull requests in one DB transaction.
+        Pull requests updated after 'fetchStarted' (by webhooks during the fetch) are skipped,
+        the fetched data of them may be older.
+        Returns ([(prid, head_sha, head_sha_old)] of PRs with changed head_sha,
+                 [(pr, active statuses)] of deactivated PRs)
+        '''
+        prids = [pr['id'] for pr in pullrequests]
+        existing = {}
+        for current in database.Pullrequest.query(session).filter(database.Pullrequest.status >= 0).all():
+            existing[current.prid] = current
+        missing = [prid for prid in prids if prid not in existing]
+        for i in range(0, len(missing), 500):  # SQLite limits number of query parameters
+            for current in database.Pullrequest.query(session).filter(database.Pullrequest.prid.in_(missing[i:i + 500])).all():
+                existing[current.prid] = current
+
+        def isUpdatedDuringFetch(current):
+            return fetchStarted is not None and current is not None and current.updated_at >= fetchStarted
+
+        changed = []
+        for pr in pullrequests:
+            if isUpdatedDuringFetch(existing.get(pr['id'], None)):
+                print "Skip PR #%s: updated during the fetch" % pr['id']
+                continue
+            current, head_sha_old = self._mergePullRequest(session, existing.get(pr['id'], None), pr)
+            if pr['head_sha'] != head_sha_old:
+                changed.append((pr['id'], pr['head_sha'], head_sha_old))
+
+        deactivated = []
+        processed = set(prids)
+        for current in existing.values():
+            if current.prid not in processed and current.status >= 0 and not isUpdatedDuringFetch(current):
+                print "Mark PR #%s inactive" % current.prid
+                current.status = -1
+                deactivated.append((current, [s for s in current.getBuildStatus() if s.active]))
+        session.commit()
+        return (changed, deactivated)
+
     @defer.inlineCallbacks
     def queueBuildersForPR(self, prid, head_sha, head_sha_old):
         db = self.context.db
@@ -171,99 +255,133 @@ def _getInternalNameByBuilderName(context, builderName):
             return internal_name
     raise Exception('Unknown builder: %s' % builderName)
 
-schedulerLock = defer.DeferredLock()
+class KeyedDeferredLock(object):
+    '''
+    Set of DeferredLock objects by key, unused locks are dropped
+    '''
+    def __init__(self):
+        self.locks = {}
+
+    def run(self, key, fn, *args, **kw):
+        lock = self.locks.get(key, None)
+        if lock is None:
+            lock = self.locks[key] = defer.DeferredLock()
+        def cleanup(result):
+            if not lock.locked and not lock.waiting and self.locks.get(key, None) is lock:
+                del self.locks[key]
+            return result
+        return lock.run(fn, *args, **kw).addBoth(cleanup)
+
+# Scheduling is serialized per internal builder: buildbot builders of the same Builder.builders list
+# share one queue of statuses, different builders are scheduled in parallel
+schedulerLocks = KeyedDeferredLock()
 
 @defer.inlineCallbacks
 def tryScheduleForBuilder(context, builderName, resetScheduledBuilds=True):
     if not context.allowScheduling:
         return
+    internal_name = _getInternalNameByBuilderName(context, builderName)
+    yield schedulerLocks.run(internal_name, _tryScheduleForBuilder, context, internal_name, builderName, resetScheduledBuilds)
 
+@defer.inlineCallbacks
+def _tryScheduleForBuilder(context, internal_name, builderName, resetScheduledBuilds):
     db = context.db
     master = context.master
     assert isinstance(master, BuildMaster)
 
-    yield schedulerLock.acquire()
-
+    b = yield db.bcc.getBuilderByName(internal_name)
     try:
-        b = yield db.bcc.getBuilderByName(_getInternalNameByBuilderName(context, builderName))
-        try:
-            builders = master.botmaster.builders
-            builder = builders.get(builderName, None)
-            if builder is None:
-                return
-            assert isinstance(builder, Builder)
-            builder_status = builder.builder_status
-            assert isinstance(builder_status, BuilderStatus)
-            if builder_status.currentBigState == 'offline':
-                return
-            pending = yield builder_status.getPendingBuildRequestStatuses()
-            if len(pending) > 0:
-                return
-        except:
-            log.err()
+        builders = master.botmaster.builders
+        builder = builders.get(builderName, None)
+        if builder is None:
             return
+        assert isinstance(builder, Builder)
+        builder_status = builder.builder_status
+        assert isinstance(builder_status, BuilderStatus)
+        if builder_status.currentBigState == 'offline':
+            return
+        pending = yield builder_status.getPendingBuildRequestStatuses()
+        # fill all free slaves in one pass (one build is allowed without attached slaves, like latent slaves)
+        available = len([sb for sb in builder.slaves if sb.isAvailable()])
+        capacity = max(available, 1) - len(pending)
+        if capacity <= 0:
+            return
+    except:
+        log.err()
+        return
 
-#         if resetScheduledBuilds:
-#             # reset lost jobs with 'scheduled' state, but buildbot doesn't have pending builds
-#             yield db.execute(db.m.status.update()
-#                     .where(db.m.status.c.builder_id == b['id'])
-#                     .where(db.m.status.c.status == BuildStatus.SCHEDULED)
-#                     .values(brid=-1, build_number=-1, status=BuildStatus.INQUEUE))
-
-        prb_status = yield db.scc.getStatusToSchedule(b.bid);
-        if prb_status:
-            prid = prb_status.prid
+#     if resetScheduledBuilds:
+#         # reset lost jobs with 'scheduled' state, but buildbot doesn't have pending builds
+#         yield db.execute(db.m.status.update()
+#                 .where(db.m.status.c.builder_id == b['id'])
+#                 .where(db.m.status.c.status == BuildStatus.SCHEDULED)
+#                 .values(brid=-1, build_number=-1, status=BuildStatus.INQUEUE))
 
-            print 'PR #%s scheduling job on builder=%s' % (prid, b.name)
-            try:
-                pr = yield db.asyncRun(lambda _: prb_status.pr)
+    prb_statuses = yield db.scc.getStatusesToSchedule(b.bid, capacity)
+    if not prb_statuses:
+        return
 
-                properties = Properties()
-                properties.setProperty('pullrequest_service', context.name, 'Pull request')
-                sourcestamps = []
-                result = yield context.getBuildProperties(pr, b, properties, sourcestamps)
+    builds = []
+    for prb_status in prb_statuses:
+        prid = prb_status.prid
+        print 'PR #%s scheduling job on builder=%s' % (prid, b.name)
+        try:
+            pr = yield db.asyncRun(lambda _, s=prb_status: s.pr)
 
-                if not result:
-                    print "ERROR: Can't get build properties: PR #%s builder=%s" % (prid, builder.name)
-                    prb_status.status = BuildStatus.FAILURE
-                    yield db.scc.updateStatus(prb_status)
-                    return
+            properties = Properties()
+            properties.setProperty('pullrequest_service', context.name, 'Pull request')
+            sourcestamps = []
+            result = yield context.getBuildProperties(pr, b, properties, sourcestamps)
 
-                setid = yield master.db.sourcestampsets.addSourceStampSet()
-                for ss in sourcestamps:
-                    assert isinstance(ss, dict)
-                    yield master.db.sourcestamps.addSourceStamp(
-                                codebase=ss.get('codebase', None),
-                                repository=ss.get('repository', ''),
-                                branch=ss.get('branch', None),
-                                revision=ss.get('revision', None),
-                                project=ss.get('project', ''),
-                                changeids=[c['number'] for c in ss.get('changes', [])],
-                                patch_body=ss.get('patch_body', None),
-                                patch_level=ss.get('patch_level', None),
-                                patch_author=ss.get('patch_author', None),
-                                patch_comment=ss.get('patch_comment', None),
-                                sourcestampsetid=setid)
-
-                prb_status.status = BuildStatus.SCHEDULING
+            if not result:
+                print "ERROR: Can't get build properties: PR #%s builder=%s" % (prid, builder.name)
+                prb_status.status = BuildStatus.FAILURE
                 yield db.scc.updateStatus(prb_status)
+                continue
 
-                (bsid, brids) = yield master.addBuildset(sourcestampsetid=setid,
-                        reason="#%s (%s) on %s" % (prid, pr.head_sha, builderName),
-                        properties=properties.asDict(),
-                        builderNames=[builderName],
-                        external_idstring="PR #%s" % prid)
-                assert len(brids) == 1
+            prb_status.status = BuildStatus.SCHEDULING
+            builds.append((prb_status, pr, properties, sourcestamps))
+        except:
+            log.err()
+            prb_status.status = BuildStatus.EXCEPTION
+            yield db.scc.updateStatus(prb_status)
 
-                prb_status.brid = brids[builderName]
-                yield db.scc.updateStatus(prb_status)
-            except:
-                log.err()
-                prb_status.status = BuildStatus.EXCEPTION
-                yield db.scc.updateStatus(prb_status)
+    if not builds:
+        return
+    yield db.scc.updateStatuses([build[0] for build in builds])
 
-    finally:
-        schedulerLock.release()
+    for (prb_status, pr, properties, sourcestamps) in builds:
+        prid = prb_status.prid
+        try:
+            setid = yield master.db.sourcestampsets.addSourceStampSet()
+            for ss in sourcestamps:
+                assert isinstance(ss, dict)
+                yield master.db.sourcestamps.addSourceStamp(
+                            codebase=ss.get('codebase', None),
+                            repository=ss.get('repository', ''),
+                            branch=ss.get('branch', None),
+                            revision=ss.get('revision', None),
+                            project=ss.get('project', ''),
+                            changeids=[c['number'] for c in ss.get('changes', [])],
+                            patch_body=ss.get('patch_body', None),
+                            patch_level=ss.get('patch_level', None),
+                            patch_author=ss.get('patch_author', None),
+                            patch_comment=ss.get('patch_comment', None),
+                            sourcestampsetid=setid)
+
+            (bsid, brids) = yield master.addBuildset(sourcestampsetid=setid,
+                    reason="#%s (%s) on %s" % (prid, pr.head_sha, builderName),
+                    properties=properties.asDict(),
+                    builderNames=[builderName],
+                    external_idstring="PR #%s" % prid)
+            assert len(brids) == 1
+
+            prb_status.brid = brids[builderName]
+            yield db.scc.updateStatus(prb_status)
+        except:
+            log.err()
+            prb_status.status = BuildStatus.EXCEPTION
+            yield db.scc.updateStatus(prb_status)
 
 class BuildBotStatusReceiver():
     implements(IStatusReceiver)
@@ -357,35 +475,36 @@ class BuilderStatusReceiver():
             if prid is None:
                 return
             db = self.context.db
+            builders = self.context.master.botmaster.builders
+            builder = builders.get(self.name, None)  # : type builder: buildbot.process.builder.Builder
+            assert isinstance(builder, Builder)
+            b = builder.getBuild(build.number)
+            brid = b.requests[0].id
             def fn(session):
-                # pr = yield db.prcc.getPullRequest(prid)
-                builders = self.context.master.botmaster.builders
-                builder = builders.get(self.name, None)  # : type builder: buildbot.process.builder.Builder
-                assert isinstance(builder, Builder)
-                b = builder.getBuild(build.number)
-                bstatus = db.scc.getStatusForBuildRequest(prid, self.bid, b.requests[0].id)
+                # returns True if the build should be stopped
+                bstatus = db.scc.getStatusForBuildRequest(prid, self.bid, brid)
                 if not bstatus:  # TODO Workaround
                     logger.warning("buildStarted(%s): #PR%s: can't find build status. Ignore" % (builderName, prid))
-                    return
+                    return False
                 sha = properties.getProperty('head_sha', None)
                 if sha != bstatus.head_sha:
                     logger.error('buildStarted(%s): #PR%d: wrong commit hash (build %s vs expected %s). Ignore' % (builderName, prid, sha, bstatus.head_sha))
-                    return
+                    return False
                 logger.info('buildStarted(%s): #PR%d' % (builderName, prid))
                 bstatus.status = BuildStatus.BUILDING
                 bstatus.build_number = build.number
                 db.scc.updateStatus(bstatus)
                 if not bstatus.active:
                     logger.warning('buildStarted(%s): #PR%d. Stop inactive build' % (builderName, prid))
-                    try:
-                        logger.info("Cancel build #%s on %s..." % (bstatus.build_number, builderName))
-                        @defer.inlineCallbacks
-                        def cancel():
-                            yield b.stopBuild("canceled by PR service (run inactive)")
-                        yield mainThreadCall(cancel)
-                    except:
-                        log.err()
-            yield db.asyncRun(fn)
+                    return True
+                return False
+            stopInactive = yield db.asyncRun(fn)
+            if stopInactive:
+                try:
+                    logger.info("Cancel build #%s on %s..." % (build.number, builderName))
+                    yield b.stopBuild("canceled by PR service (run inactive)")
+                except:
+                    log.err()
         except:
             log.err()
 
@@ -434,7 +553,8 @@ class BuilderStatusReceiver():
                 return
             db = self.context.db
             def fn(session):
-                pr = yield db.prcc.getPullRequest(prid)
+                # returns True if the build request should be canceled
+                pr = db.prcc.getPullRequest(prid)
                 bstatus = db.scc.getStatusForBuildRequest(prid, self.bid, request.brid)
                 if not bstatus:
                     logger.info("requestSubmitted(%s #%d): #PR%s: adding new builder status" % (request.buildername, request.brid, prid))
@@ -444,25 +564,24 @@ class BuilderStatusReceiver():
                     bstatus.bid = self.bid
                     bstatus.brid = request.brid
                     bstatus.head_sha = properties.getProperty('head_sha', None)
-                    yield pr.addBuildStatus(bstatus)
-                    return
+                    pr.addBuildStatus(bstatus)
+                    return False
                 sha = properties.getProperty('head_sha', None)
                 if sha != bstatus.head_sha:
                     print 'requestSubmitted(%s): #PR%s: wrong commit hash (request %s vs pr build status %s). Ignore' % (request.buildername, prid, sha, bstatus.head_sha)
-                    return
+                    return False
                 print 'requestSubmitted(%s): #PR%s' % (request.buildername, prid)
                 if bstatus.active:
                     bstatus.status = BuildStatus.SCHEDULED
-                    yield db.scc.updateStatus(bstatus)
-                else:
-                    @defer.inlineCallbacks
-                    def cancel():
-                        buildrequest = yield request._getBuildRequest()
-                        assert isinstance(buildrequest, buildbot.process.buildrequest.BuildRequest)
-                        yield buildrequest.cancelBuildRequest()
-                        logger.info("Build request for PR #%s (on %s) canceled (start inactive build)" % (prid, self.name))
-                    yield mainThreadCall(cancel)
-            yield db.asyncRun(fn)
+                    db.scc.updateStatus(bstatus)
+                    return False
+                return True
+            cancel = yield db.asyncRun(fn)
+            if cancel:
+                buildrequest = yield request._getBuildRequest()
+                assert isinstance(buildrequest, buildbot.process.buildrequest.BuildRequest)
+                yield buildrequest.cancelBuildRequest()
+                logger.info("Build request for PR #%s (on %s) canceled (start inactive build)" % (prid, self.name))
         except:
             log.err()
 
@@ -498,6 +617,57 @@ class BuilderStatusReceiver():
             log.err()
 
 
+class StatusCompactionLoop():
+    '''
+    Moves old inactive build statuses into the archive table by small batches
+    (each batch is a separate DB job) and vacuums the SQLite DB
+    '''
+    isStarted = False
+
+    def __init__(self, context):
+        self.context = context
+        self.archivedRows = 0  # total
+        self.reclaimedBytes = 0  # total
+
+    def start(self):
+        print "PR: Start status compaction service..."
+        self.isStarted = True
+        task.deferLater(reactor, 60, self.compact)
+
+    def stop(self):
+        self.isStarted = False
+
+    @defer.inlineCallbacks
+    def compact(self):
+        if not self.isStarted:
+            return
+        try:
+            db = self.context.db
+            sizeBefore, _ = yield db.getSize()
+            updated_before = datetime.datetime.utcnow() - datetime.timedelta(days=self.context.statusRetentionDays)
+            rows = 0
+            while self.isStarted:
+                n = yield db.scc.archiveStatuses(updated_before, self.context.statusCompactionBatch)
+                rows += n
+                if n < self.context.statusCompactionBatch:
+                    break
+                yield task.deferLater(reactor, 0.1, lambda: None)  # let other DB jobs run
+            # full VACUUM is needed once only, to switch the DB into the incremental auto_vacuum mode
+            allowFull = self.context.statusVacuumHour is not None and \
+                    datetime.datetime.utcnow().hour == self.context.statusVacuumHour
+            vacuum = yield db.vacuum(allowFull=allowFull)
+            sizeAfter, free = yield db.getSize()
+            reclaimed = sizeBefore - sizeAfter if sizeBefore is not None else 0
+            self.archivedRows += rows
+            self.reclaimedBytes += max(0, reclaimed)
+            logger.info('Status compaction: archived %d rows, DB size %s -> %s bytes (reclaimed %s, free %s)%s' %
+                        (rows, sizeBefore, sizeAfter, reclaimed, free, ' after full VACUUM' if vacuum == 'full' else ''))
+        except:
+            log.err(failure.Failure(), 'while compacting statuses: %s' % self.context.name)
+        if self.isStarted:
+            task.deferLater(reactor, self.context.statusCompactionDelay, self.compact)
+
+
 class SchedulerLoop():
     isStarted = False
 
@@ -598,70 +768,61 @@ def cancelBuild(buildStatus, updated_at=None):
     context = buildStatus.getContext()  # : :type context: context.Context
     db = context.db  # : :type db: database.Database
     def fn(session):
-        builderNames = buildStatus.builder.builders
-        master = context.master  # : :type master: buildbot.master.BuildMaster
-        if buildStatus.status in [constants.BuildStatus.INQUEUE]:
-            buildStatus.active = False
-            return
-        elif buildStatus.status in [constants.BuildStatus.SCHEDULING]:
-            buildStatus.active = False
-            return
-        elif buildStatus.status in [constants.BuildStatus.SCHEDULED]:
-            logger.info("Cancel scheduled build: PR=%s, builders=%s" % (buildStatus.pr.prid, ','.join(builderNames)))
+        # DB part, buildbot is called after the commit
+        if buildStatus.status in [constants.BuildStatus.INQUEUE, constants.BuildStatus.SCHEDULING, constants.BuildStatus.SCHEDULED]:
             buildStatus.active = False
-            session.commit()
-            builders = master.botmaster.builders
-            found = False
-            for bName in builderNames:
-                builder = builders.get(bName, None)  # : type builder: buildbot.process.builder.Builder
-                if builder is None:
-                    continue
-                assert isinstance(builder, Builder)
-                builder_status = builder.builder_status
-                assert isinstance(builder_status, BuilderStatus)
-                pendings = yield mainThreadCall(builder_status.getPendingBuildRequestStatuses)
-                if len(pendings) > 0:
-                    for pending in pendings:
-                        assert isinstance(pending, BuildRequestStatus)
-                        if pending.brid == buildStatus.brid:
-                            found = True
-                            try:
-                                @defer.inlineCallbacks
-                                def cancel():
-                                    buildrequest = yield pending._getBuildRequest()
-                                    assert isinstance(buildrequest, buildbot.process.buildrequest.BuildRequest)
-                                    yield buildrequest.cancelBuildRequest()
-                                    logger.info("Build request for PR #%s (on %s) canceled" % (buildStatus.pr.prid, bName))
-                                yield mainThreadCall(cancel)
-                            except:
-                                log.err('during canceling build')
-                                raise
-            if not found:
-                logger.info("Can't find pending build: PR=%s, builders=%s" % (buildStatus.pr.prid, ','.join(builderNames)))
-            return
-        elif buildStatus.status in [constants.BuildStatus.BUILDING]:
-            builders = master.botmaster.builders
-            logger.info("Stop processing build: PR=%s, builders=%s" % (buildStatus.pr.prid, ','.join(builderNames)))
-            for bName in builderNames:
-                builder = builders.get(bName, None)  # : type builder: buildbot.process.builder.Builder
-                if builder is None:
-                    continue
-                assert isinstance(builder, Builder)
-                build = builder.getBuild(buildStatus.build_number)
-                if build:
+        return (buildStatus.status, buildStatus.prid, buildStatus.builder.builders, buildStatus.brid, buildStatus.build_number)
+    (status, prid, builderNames, brid, build_number) = yield db.asyncRun(fn)
+    master = context.master  # : :type master: buildbot.master.BuildMaster
+    if status in [constants.BuildStatus.INQUEUE]:
+        return
+    elif status in [constants.BuildStatus.SCHEDULING]:
+        return
+    elif status in [constants.BuildStatus.SCHEDULED]:
+        logger.info("Cancel scheduled build: PR=%s, builders=%s" % (prid, ','.join(builderNames)))
+        builders = master.botmaster.builders
+        found = False
+        for bName in builderNames:
+            builder = builders.get(bName, None)  # : type builder: buildbot.process.builder.Builder
+            if builder is None:
+                continue
+            assert isinstance(builder, Builder)
+            builder_status = builder.builder_status
+            assert isinstance(builder_status, BuilderStatus)
+            pendings = yield builder_status.getPendingBuildRequestStatuses()
+            for pending in pendings:
+                assert isinstance(pending, BuildRequestStatus)
+                if pending.brid == brid:
+                    found = True
                     try:
-                        assert isinstance(build, buildbot.process.build.Build)
-                        logger.info("Cancel build #%s on %s" % (buildStatus.build_number, bName))
-                        @defer.inlineCallbacks
-                        def cancel():
-                            yield build.stopBuild("canceled by PR service")
-                        yield mainThreadCall(cancel)
+                        buildrequest = yield pending._getBuildRequest()
+                        assert isinstance(buildrequest, buildbot.process.buildrequest.BuildRequest)
+                        yield buildrequest.cancelBuildRequest()
+                        logger.info("Build request for PR #%s (on %s) canceled" % (prid, bName))
                     except:
-                        log.err()
-            return
-        elif buildStatus.status >= constants.BuildStatus.SUCCESS:
-            pr = buildStatus.pr
-            logger.info("Build was already finished with status=%s: PR=%s, builders=%s" % (BuildStatus.toString[buildStatus.status], pr.prid, ','.join(builderNames)))
-            return
-        assert False
-    yield db.asyncRun(fn)
+                        log.err('during canceling build')
+                        raise
+        if not found:
+            logger.info("Can't find pending build: PR=%s, builders=%s" % (prid, ','.join(builderNames)))
+        return
+    elif status in [constants.BuildStatus.BUILDING]:
+        builders = master.botmaster.builders
+        logger.info("Stop processing build: PR=%s, builders=%s" % (prid, ','.join(builderNames)))
+        for bName in builderNames:
+            builder = builders.get(bName, None)  # : type builder: buildbot.process.builder.Builder
+            if builder is None:
+                continue
+            assert isinstance(builder, Builder)
+            build = builder.getBuild(build_number)
+            if build:
+                try:
+                    assert isinstance(build, buildbot.process.build.Build)
+                    logger.info("Cancel build #%s on %s" % (build_number, bName))
+                    yield build.stopBuild("canceled by PR service")
+                except:
+                    log.err()
+        return
+    elif status >= constants.BuildStatus.SUCCESS:
+        logger.info("Build was already finished with status=%s: PR=%s, builders=%s" % (BuildStatus.toString[status], prid, ','.join(builderNames)))
+        return
+    assert False
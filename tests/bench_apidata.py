@@ -0,0 +1,126 @@
+'''
+Benchmark of /pullrequests rendering by ApiData: hashed indexes vs the previous list scans
+
+    python -m pullrequest.tests.bench_apidata [prs] [builders]
+
+Default is 1000 pull requests x 20 builders, each pull request has a build status on every builder.
+'''
+
+import contextlib
+import sys
+
+from twisted.internet import defer
+
+from pullrequest import prstatus
+from pullrequest.tests import common
+
+
+class LinearScanApiData(prstatus.ApiData):
+    '''
+    ApiData lookups before the indexes: list scans with string comparisons of IDs
+    '''
+
+    @defer.inlineCallbacks
+    def initialize(self, publicOnly=False):
+        yield prstatus.ApiData.initialize(self, publicOnly)
+        self.all_bstatuses = self.bstatuses.values()
+        self.bstatuses = _StatusScan(self.all_bstatuses)
+
+    def getPr(self, prid):
+        prs = [pr for pr in self.active_pullrequests if str(pr.prid) == str(prid)]
+        if len(prs) == 0:
+            return None
+        assert len(prs) == 1
+        return prs[0]
+
+    def getBuilder(self, bid):
+        b = [b for b in self.active_builders if str(b.bid) == str(bid)]
+        if len(b) == 0:
+            return None
+        assert len(b) == 1
+        return b[0]
+
+    # statuses of the pull request were filtered once, then scanned for each builder
+    def getPullrequestStatuses(self, pr):
+        with self.bstatuses.forPullRequest(pr.prid):
+            return prstatus.ApiData.getPullrequestStatuses(self, pr)
+
+    def getPullrequestStatusesShort(self, pr):
+        with self.bstatuses.forPullRequest(pr.prid):
+            return prstatus.ApiData.getPullrequestStatusesShort(self, pr)
+
+
+class _StatusScan(object):
+    # (prid, bid) lookups by scans of the status list
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.prStatuses = None
+
+    @contextlib.contextmanager
+    def forPullRequest(self, prid):
+        self.prStatuses = [s for s in self.statuses if str(s.prid) == str(prid)]
+        try:
+            yield
+        finally:
+            self.prStatuses = None
+
+    def get(self, key, default=None):
+        prid, bid = key
+        bstatuses = self.prStatuses
+        if bstatuses is None:
+            bstatuses = [s for s in self.statuses if str(s.prid) == str(prid)]
+        bstatus = [s for s in bstatuses if str(s.bid) == str(bid)]
+        return bstatus[0] if len(bstatus) > 0 else default
+
+
+def render(apiData):
+    # PullRequestsResource.asDict() without changed_since
+    result = dict(builders=apiData.getBuildersList(), pullrequests={})
+    for pr in apiData.active_pullrequests:
+        result['pullrequests'][pr.prid] = apiData.getPullrequestInfo(pr=pr)
+    return result
+
+
+def renderStatus(apiData):
+    # PullRequestsStatusResource.asDict() without changed_since
+    return dict(pullrequests=dict((pr.prid, apiData.getPullrequestStatusShort(pr=pr))
+                                  for pr in apiData.active_pullrequests))
+
+
+def stripLastUpdate(result):
+    # 'last_update' depends on the render time
+    for pr in result['pullrequests'].values():
+        for s in pr['buildstatus'].values():
+            s.pop('last_update', None)
+    return result
+
+
+@defer.inlineCallbacks
+def run(prs, builders):
+    ctx = common.TestContext(builders=builders)
+    try:
+        yield common.populate(ctx, prs)
+        print 'Pull requests: %d, builders: %d, statuses: %d' % (prs, builders, len(ctx.db.snapshot.statuses))
+        print '%-16s %12s %12s' % ('ApiData', 'full (s)', 'status (s)')
+        results = []
+        for name, cls, repeat in [('linear scans', LinearScanApiData, 1), ('indexes', prstatus.ApiData, 3)]:
+            apiData = cls(ctx, common.FakeRequest())
+            yield apiData.initialize()
+            full, fullResult = common.measure(lambda: render(apiData), repeat)
+            status, statusResult = common.measure(lambda: renderStatus(apiData), repeat)
+            print '%-16s %12.3f %12.3f' % (name, full, status)
+            results.append((stripLastUpdate(fullResult), stripLastUpdate(statusResult)))
+        if results[0] != results[1]:
+            print 'ERROR: results are different'
+            defer.returnValue(1)
+    finally:
+        ctx.cleanup()
+
+
+def main(args):
+    prs = int(args[0]) if len(args) > 0 else 1000
+    builders = int(args[1]) if len(args) > 1 else 20
+    return common.runReactor(run, prs, builders)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
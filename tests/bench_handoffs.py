@@ -0,0 +1,344 @@
+'''
+Micro-benchmark of DB thread hand-offs (PRDBThread.handoffs) per status receiver event
+
+    python -m pullrequest.tests.bench_handoffs [events]
+
+Events go through the current BuilderStatusReceiver/cancelBuild() and through their previous
+versions ('legacy'), which called buildbot from inside generator DB jobs via mainThreadCall.
+Buildbot objects are fakes of the classes checked by the handlers.
+'''
+
+import sys
+import time
+
+import buildbot.process.build
+import buildbot.process.buildrequest
+import buildbot.status.build
+from buildbot.process.builder import Builder
+from buildbot.process.properties import Properties
+from buildbot.status.builder import BuilderStatus
+from buildbot.status.buildrequest import BuildRequestStatus
+from twisted.internet import defer
+from twisted.python import log
+
+from pullrequest import constants, database, serviceloops
+from pullrequest.constants import BuildStatus
+from pullrequest.database import mainThreadCall
+from pullrequest.tests import common
+
+BUILDER = 'runtests1'
+
+
+class FakeBuildRequest(buildbot.process.buildrequest.BuildRequest):
+    def __init__(self, calls, brid):
+        self.calls = calls
+        self.id = brid
+
+    def cancelBuildRequest(self):
+        self.calls.append(('cancelBuildRequest', self.id))
+        return defer.succeed(None)
+
+
+class FakeBuildRequestStatus(BuildRequestStatus):
+    def __init__(self, calls, buildername, brid, properties):
+        self.calls = calls
+        self.buildername = buildername
+        self.brid = brid
+        self.properties = properties
+
+    def getBuildProperties(self):
+        return defer.succeed(self.properties)
+
+    def _getBuildRequest(self):
+        return defer.succeed(FakeBuildRequest(self.calls, self.brid))
+
+
+class FakeBuild(buildbot.process.build.Build):
+    def __init__(self, calls, number, brid):
+        self.calls = calls
+        self.number = number
+        self.requests = [FakeBuildRequest(calls, brid)]
+
+    def stopBuild(self, reason="<no reason given>"):
+        self.calls.append(('stopBuild', self.number))
+
+
+class FakeBuildStatus(buildbot.status.build.BuildStatus):
+    def __init__(self, number, properties):
+        self.number = number
+        self.properties = properties
+
+
+class FakeBuilderStatus(BuilderStatus):
+    def __init__(self):
+        self.pendings = []
+
+    def getPendingBuildRequestStatuses(self):
+        return defer.succeed(self.pendings)
+
+
+class FakeBuilder(Builder):
+    def __init__(self, name):
+        self.name = name
+        self.builds = {}  # number -> FakeBuild
+        self.builder_status = FakeBuilderStatus()
+
+    def getBuild(self, number):
+        return self.builds.get(number, None)
+
+
+class FakeBotMaster(object):
+    def __init__(self, builders):
+        self.builders = dict((b.name, b) for b in builders)
+
+
+class FakeMaster(object):
+    def __init__(self, builders):
+        self.botmaster = FakeBotMaster(builders)
+
+
+class LegacyStatusReceiver(serviceloops.BuilderStatusReceiver):
+    '''
+    Handlers before the one-hop DB closures: buildbot calls inside the DB jobs
+    '''
+
+    @defer.inlineCallbacks
+    def buildStarted(self, builderName, build):
+        try:
+            properties = build.properties
+            if properties.getProperty('pullrequest_service', None) != self.context.name:
+                return
+            prid = properties.getProperty('pullrequest', None)
+            if prid is None:
+                return
+            db = self.context.db
+            def fn(session):
+                builders = self.context.master.botmaster.builders
+                builder = builders.get(self.name, None)
+                assert isinstance(builder, Builder)
+                b = builder.getBuild(build.number)
+                bstatus = db.scc.getStatusForBuildRequest(prid, self.bid, b.requests[0].id)
+                if not bstatus:
+                    return
+                sha = properties.getProperty('head_sha', None)
+                if sha != bstatus.head_sha:
+                    return
+                bstatus.status = BuildStatus.BUILDING
+                bstatus.build_number = build.number
+                db.scc.updateStatus(bstatus)
+                if not bstatus.active:
+                    try:
+                        @defer.inlineCallbacks
+                        def cancel():
+                            yield b.stopBuild("canceled by PR service (run inactive)")
+                        yield mainThreadCall(cancel)
+                    except:
+                        log.err()
+            yield db.asyncRun(fn)
+        except:
+            log.err()
+
+    @defer.inlineCallbacks
+    def requestSubmitted(self, request):
+        try:
+            properties = yield request.getBuildProperties()
+            if properties.getProperty('pullrequest_service', None) != self.context.name:
+                return
+            prid = properties.getProperty('pullrequest', None)
+            if prid is None:
+                return
+            if self.name != request.buildername:
+                return
+            db = self.context.db
+            def fn(session):
+                pr = yield db.prcc.getPullRequest(prid)
+                bstatus = db.scc.getStatusForBuildRequest(prid, self.bid, request.brid)
+                if not bstatus:
+                    bstatus = database.Status()
+                    bstatus.active = True
+                    bstatus.status = BuildStatus.SCHEDULED
+                    bstatus.bid = self.bid
+                    bstatus.brid = request.brid
+                    bstatus.head_sha = properties.getProperty('head_sha', None)
+                    yield pr.addBuildStatus(bstatus)
+                    return
+                sha = properties.getProperty('head_sha', None)
+                if sha != bstatus.head_sha:
+                    return
+                if bstatus.active:
+                    bstatus.status = BuildStatus.SCHEDULED
+                    yield db.scc.updateStatus(bstatus)
+                else:
+                    @defer.inlineCallbacks
+                    def cancel():
+                        buildrequest = yield request._getBuildRequest()
+                        assert isinstance(buildrequest, buildbot.process.buildrequest.BuildRequest)
+                        yield buildrequest.cancelBuildRequest()
+                    yield mainThreadCall(cancel)
+            yield db.asyncRun(fn)
+        except:
+            log.err()
+
+
+@defer.inlineCallbacks
+def legacyCancelBuild(buildStatus, updated_at=None):
+    # cancelBuild() before the one-hop DB closures, SCHEDULED and BUILDING statuses only
+    context = buildStatus.getContext()
+    db = context.db
+    def fn(session):
+        builderNames = buildStatus.builder.builders
+        master = context.master
+        if buildStatus.status in [constants.BuildStatus.SCHEDULED]:
+            buildStatus.active = False
+            session.commit()
+            builders = master.botmaster.builders
+            for bName in builderNames:
+                builder = builders.get(bName, None)
+                if builder is None:
+                    continue
+                builder_status = builder.builder_status
+                pendings = yield mainThreadCall(builder_status.getPendingBuildRequestStatuses)
+                for pending in pendings:
+                    if pending.brid == buildStatus.brid:
+                        @defer.inlineCallbacks
+                        def cancel():
+                            buildrequest = yield pending._getBuildRequest()
+                            yield buildrequest.cancelBuildRequest()
+                        yield mainThreadCall(cancel)
+            return
+        elif buildStatus.status in [constants.BuildStatus.BUILDING]:
+            builders = master.botmaster.builders
+            for bName in builderNames:
+                builder = builders.get(bName, None)
+                if builder is None:
+                    continue
+                build = builder.getBuild(buildStatus.build_number)
+                if build:
+                    @defer.inlineCallbacks
+                    def cancel():
+                        yield build.stopBuild("canceled by PR service")
+                    yield mainThreadCall(cancel)
+            return
+        assert False
+    yield db.asyncRun(fn)
+
+
+class Bench(object):
+
+    def __init__(self, ctx, builder, calls):
+        self.ctx = ctx
+        self.db = ctx.db
+        self.builder = builder  # FakeBuilder
+        self.calls = calls
+        self.bid = None
+        self.bridBase = 0  # build request IDs of each scenario are different
+
+    def brid(self, prid):
+        return self.bridBase + prid
+
+    def getProperties(self, prid):
+        properties = Properties()
+        properties.setProperty('pullrequest_service', self.ctx.name, 'test')
+        properties.setProperty('pullrequest', prid, 'test')
+        properties.setProperty('head_sha', '%040x' % prid, 'test')
+        return properties
+
+    def prepare(self, prids, **fields):
+        # new status of each pull request on the builder, previous statuses are deactivated
+        def fn(session):
+            for prid in prids:
+                for s in database.Status.query(session).filter_by(prid=prid, active=True).all():
+                    s.active = False
+                s = database.Status()
+                s.prid = prid
+                s.bid = self.bid
+                s.head_sha = '%040x' % prid
+                for k, v in fields.items():
+                    setattr(s, k, v(prid) if callable(v) else v)
+                session.add(s)
+        return self.db.asyncRun(fn)
+
+    def nextScenario(self, prids):
+        # new build requests, pending in the builder and started as builds
+        self.bridBase += 1000000
+        self.builder.builder_status.pendings = [
+                FakeBuildRequestStatus(self.calls, BUILDER, self.brid(prid), self.getProperties(prid)) for prid in prids]
+        for prid in prids:
+            self.builder.builds[prid] = FakeBuild(self.calls, prid, self.brid(prid))
+
+    def getScenarios(self, receiver, cancelBuild):
+        '''
+        Returns [(event name, preparation of the statuses, event for prid, expected buildbot call)]
+        '''
+        brid = self.brid
+        request = lambda prid: receiver.requestSubmitted(
+                FakeBuildRequestStatus(self.calls, BUILDER, brid(prid), self.getProperties(prid)))
+        started = lambda prid: receiver.buildStarted(BUILDER, FakeBuildStatus(prid, self.getProperties(prid)))
+        @defer.inlineCallbacks
+        def stop(prid):
+            s = yield self.db.scc.getStatus(prid, self.bid)
+            yield cancelBuild(s)
+        return [
+            # build request of the scheduler: new build status
+            ('requestSubmitted', dict(status=BuildStatus.SCHEDULING), request, None),
+            # the status was deactivated while the request was submitted: cancel the request
+            ('requestSubmitted, inactive', dict(status=BuildStatus.SCHEDULING, brid=brid, active=False),
+             request, 'cancelBuildRequest'),
+            ('buildStarted', dict(status=BuildStatus.SCHEDULED, brid=brid), started, None),
+            ('buildStarted, inactive', dict(status=BuildStatus.SCHEDULED, brid=brid, active=False),
+             started, 'stopBuild'),
+            # stop of a scheduled build: cancel the pending request
+            ('cancelBuild, scheduled', dict(status=BuildStatus.SCHEDULED, brid=brid), stop, 'cancelBuildRequest'),
+            ('cancelBuild, building', dict(status=BuildStatus.BUILDING, brid=brid, build_number=lambda prid: prid),
+             stop, 'stopBuild'),
+        ]
+
+
+@defer.inlineCallbacks
+def run(events):
+    ctx = common.TestContext(builders=1)
+    try:
+        yield common.populate(ctx, 2 * events)
+        builder = FakeBuilder(BUILDER)
+        ctx.master = FakeMaster([builder])
+        calls = []
+        bench = Bench(ctx, builder, calls)
+        b = yield ctx.db.bcc.getBuilderByName(BUILDER)
+        bench.bid = b.bid
+        thread = ctx.thread
+        results = {}
+        order = []
+        modes = [('legacy', LegacyStatusReceiver(ctx, b), legacyCancelBuild, range(1, events + 1)),
+                 ('current', serviceloops.BuilderStatusReceiver(ctx, b), serviceloops.cancelBuild,
+                  range(events + 1, 2 * events + 1))]
+        for mode, receiver, cancelBuild, prids in modes:
+            for name, fields, event, expected in bench.getScenarios(receiver, cancelBuild):
+                if name not in order:
+                    order.append(name)
+                bench.nextScenario(prids)
+                yield bench.prepare(prids, **fields)
+                del calls[:]
+                handoffs = thread.handoffs
+                start = time.time()
+                for prid in prids:
+                    yield event(prid)
+                elapsed = time.time() - start
+                if [c[0] for c in calls] != ([expected] * len(prids) if expected else []):
+                    print 'ERROR: %s (%s): unexpected buildbot calls: %s' % (name, mode, calls[:5])
+                    defer.returnValue(1)
+                results[(name, mode)] = (float(thread.handoffs - handoffs) / len(prids), elapsed / len(prids) * 1000)
+        print 'Events: %d per scenario' % events
+        print '%-28s %17s %17s %14s %14s' % ('event', 'legacy hand-offs', 'current hand-offs', 'legacy (ms)', 'current (ms)')
+        for name in order:
+            legacy, current = results[(name, 'legacy')], results[(name, 'current')]
+            print '%-28s %17.1f %17.1f %14.2f %14.2f' % (name, legacy[0], current[0], legacy[1], current[1])
+    finally:
+        ctx.cleanup()
+
+
+def main(args):
+    events = int(args[0]) if len(args) > 0 else 200
+    return common.runReactor(run, events)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,101 @@
+'''
+Memory benchmark of the snapshot data: ORM instances vs slot-based views (database.*View)
+
+    python -m pullrequest.tests.bench_memory [prs] [builders]
+
+Default is 5000 pull requests with a build status on each of 5 builders. Retained size is the size
+of the objects reachable from the loaded rows, without the objects which existed before the load
+(classes, mappers, session, interned strings).
+'''
+
+import gc
+import sys
+import time
+import types
+
+from twisted.internet import defer
+
+from pullrequest.database import Builder, Pullrequest, Status
+from pullrequest.database import BuilderView, PullrequestView, StatusView
+from pullrequest.tests import common
+
+
+def getRetainedSize(roots, existing):
+    seen = set(existing)
+    size = 0
+    stack = list(roots)
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ClassType, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        stack.extend(gc.get_referents(o))
+    return size
+
+
+def loadInstances(session):
+    # previous snapshot: ORM instances of the session (JSON fields were decoded on load)
+    builders = session.query(Builder).filter(Builder.active == True).all()
+    prs = session.query(Pullrequest).filter(Pullrequest.status >= 0).all()
+    ss = session.query(Status).filter(Status.active == True).all()
+    for b in builders:
+        b.builders
+    for pr in prs:
+        pr.info
+    return [builders, prs, ss]
+
+
+def loadViews(session, decodeInfo):
+    # DataSnapshot.reload(), 'info' is decoded by the first page render
+    builders = BuilderView.select(session, Builder.active == True)
+    prs = PullrequestView.select(session, Pullrequest.status >= 0)
+    ss = StatusView.select(session, Status.active == True)
+    if decodeInfo:
+        for pr in prs:
+            pr.info
+    return [builders, prs, ss]
+
+
+def measure(ctx, load):
+    session = ctx.db._createSession()
+    try:
+        session.query(Pullrequest).first()  # mapper configuration, connection
+        gc.collect()
+        existing = set(id(o) for o in gc.get_objects())
+        start = time.time()
+        result = load(session)
+        elapsed = time.time() - start
+        size = getRetainedSize(result, existing)
+        return (size, len(result[1]), sum(len(r) for r in result), elapsed)
+    finally:
+        session.close()
+
+
+@defer.inlineCallbacks
+def run(prs, builders):
+    ctx = common.TestContext(builders=builders)
+    try:
+        yield common.populate(ctx, prs)
+        print 'Pull requests: %d, builders: %d, statuses: %d' % (prs, builders, len(ctx.db.snapshot.statuses))
+        print '%-26s %10s %12s %14s %10s' % ('rows', 'objects', 'total (MB)', 'per PR (bytes)', 'load (s)')
+        results = []
+        for name, load in [('ORM instances', loadInstances),
+                           ('views', lambda session: loadViews(session, False)),
+                           ('views, info decoded', lambda session: loadViews(session, True))]:
+            size, count, objects, elapsed = measure(ctx, load)
+            results.append(size)
+            print '%-26s %10d %12.1f %14d %10.2f' % (name, objects, size / 1024.0 / 1024, size / count, elapsed)
+        print 'ORM instances / views: %.1fx (info decoded: %.1fx)' % (float(results[0]) / results[1],
+                                                                       float(results[0]) / results[2])
+    finally:
+        ctx.cleanup()
+
+
+def main(args):
+    prs = int(args[0]) if len(args) > 0 else 5000
+    builders = int(args[1]) if len(args) > 1 else 5
+    return common.runReactor(run, prs, builders)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
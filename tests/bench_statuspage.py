@@ -0,0 +1,136 @@
+'''
+Benchmark of status page loads: eager JSON decoding (before JSONProperty) vs lazy decoding
+
+    python -m pullrequest.tests.bench_statuspage [prs] [builders]
+
+Default is 5000 pull requests x 5 builders. Steps, as a master does them:
+- startup: snapshot reload (views), the first /pullrequests and /pullrequests/status pages,
+- PR sweep (reconcile of the fetched list): ORM load of active pull requests and builders,
+  flush and commit of the loaded pull requests with a changed column ('info' is not changed),
+  the snapshot views of the pull requests are replaced on commit,
+- the next /pullrequests page.
+'eager' decodes the JSON columns of every loaded row and of every new snapshot view, and serializes
+them again on flush, as BaseMixin.load()/update_time() did. 'lazy' is the current code: the snapshot
+reload decodes 'info' of the views, replaced views reuse it if the JSON is not changed.
+Page renders are done in the reactor thread (request path), other steps in the DB thread.
+'''
+
+import gc
+import sys
+import time
+
+from twisted.internet import defer
+
+from pullrequest import prstatus
+from pullrequest.database import Builder, Pullrequest
+from pullrequest.tests import common
+from pullrequest.tests.bench_apidata import render, renderStatus, stripLastUpdate
+
+STEPS = [('snapshot reload', False), ('first full page', True), ('first status page', True),
+         ('ORM load', False), ('flush', False), ('commit', False), ('full page after sweep', True)]
+
+
+def sweep(ctx, eager, times):
+    session = ctx.db._createSession()
+    try:
+        start = time.time()
+        builders = session.query(Builder).filter(Builder.active == True).all()
+        prs = session.query(Pullrequest).filter(Pullrequest.status >= 0).order_by(Pullrequest.prid.desc()).all()
+        if eager:
+            for b in builders:
+                b.builders
+            for pr in prs:
+                pr.info
+        times['ORM load'] = time.time() - start
+        for pr in prs:
+            pr.priority = 1 - pr.priority
+        start = time.time()
+        session.flush()
+        times['flush'] = time.time() - start
+        start = time.time()
+        session.commit()
+        if eager:
+            for pr in ctx.db.snapshot.pullrequests.values():
+                pr.info
+        times['commit'] = time.time() - start
+    finally:
+        session.close()
+
+
+@defer.inlineCallbacks
+def renderPages(ctx, status=True):
+    apiData = prstatus.ApiData(ctx, common.FakeRequest())
+    yield apiData.initialize()
+    start = time.time()
+    fullResult = render(apiData)
+    full = time.time() - start
+    start = time.time()
+    statusResult = renderStatus(apiData) if status else None
+    defer.returnValue((full, time.time() - start, fullResult, statusResult))
+
+
+@defer.inlineCallbacks
+def runMode(ctx, eager):
+    times = {}
+    snapshot = ctx.db.snapshot
+    with snapshot.lock:
+        snapshot.pullrequests = {}  # startup
+    start = time.time()
+    yield ctx.db.asyncRun(snapshot.reload)
+    if eager:
+        for pr in snapshot.pullrequests.values():
+            pr.info
+    times['snapshot reload'] = time.time() - start
+    times['first full page'], times['first status page'], fullResult, statusResult = yield renderPages(ctx)
+    sweep(ctx, eager, times)
+    times['full page after sweep'], _, _, _ = yield renderPages(ctx, status=False)
+    defer.returnValue((times, (stripSweepChanges(stripLastUpdate(fullResult)), stripLastUpdate(statusResult))))
+
+
+def stripSweepChanges(result):
+    # sweeps toggle the priorities and update the timestamps of pull requests
+    for pr in result['pullrequests'].values():
+        pr.pop('priority')
+        pr.pop('updated_at')
+    return result
+
+
+@defer.inlineCallbacks
+def run(prs, builders, repeat=5):
+    ctx = common.TestContext(builders=builders)
+    try:
+        yield common.populate(ctx, prs)
+        print 'Pull requests: %d, builders: %d, statuses: %d' % (prs, builders, len(ctx.db.snapshot.statuses))
+        best = {}
+        results = {}
+        for _ in range(repeat):
+            for mode in ['eager', 'lazy']:
+                # as timeit: the GC is disabled, full collections are triggered at random steps otherwise
+                gc.collect()
+                gc.disable()
+                try:
+                    times, results[mode] = yield runMode(ctx, mode == 'eager')
+                finally:
+                    gc.enable()
+                for step, t in times.items():
+                    best[(mode, step)] = min(best.get((mode, step), t), t)
+        print '%-24s %12s %12s' % ('step', 'eager (s)', 'lazy (s)')
+        for step, _ in STEPS:
+            print '%-24s %12.3f %12.3f' % (step, best[('eager', step)], best[('lazy', step)])
+        for name, requestPath in [('request path', True), ('DB thread', False)]:
+            total = [sum(best[(mode, step)] for step, r in STEPS if r == requestPath) for mode in ['eager', 'lazy']]
+            print '%-24s %12.3f %12.3f' % ('total, ' + name, total[0], total[1])
+        if results['eager'] != results['lazy']:
+            print 'ERROR: results are different'
+            defer.returnValue(1)
+    finally:
+        ctx.cleanup()
+
+
+def main(args):
+    prs = int(args[0]) if len(args) > 0 else 5000
+    builders = int(args[1]) if len(args) > 1 else 5
+    return common.runReactor(run, prs, builders)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,160 @@
+'''
+Helpers of the benchmarks and load tests: context with a temporary SQLite DB, generated pull requests
+
+Scripts are run as modules from the directory with the 'pullrequest' package:
+    python -m pullrequest.tests.bench_apidata
+'''
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from pullrequest import context, database
+from pullrequest.constants import BuildStatus
+
+
+class TestContext(context.Context):
+
+    name = 'Test'
+    dbReadThreads = 2
+
+    def __init__(self, builders=20, **kw):
+        self.tmpdir = tempfile.mkdtemp(prefix='pullrequest-')
+        self.dbname = os.path.join(self.tmpdir, 'test')
+        self.builders = dict(('runtests%d' % i, dict(name='t%d' % i, builders=['runtests%d' % i], order=i))
+                             for i in range(1, builders + 1))
+        for k, v in kw.items():
+            setattr(self, k, v)
+        context.Context.__init__(self)
+
+    def getWebAddressPullRequest(self, pr):
+        return 'https://github.com/user/repo/pull/%s' % pr.prid
+
+    def getWebAddressPerfRegressionReport(self, pr):
+        return 'https://perf.example.com/%s' % pr.prid
+
+    def cleanup(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class FakeAuthz(object):
+    def __init__(self, allowed=True):
+        self.allowed = allowed
+
+    def actionAllowed(self, action, request, *args):
+        return defer.succeed(self.allowed)
+
+
+class FakeWebStatus(object):
+    # request.site.buildbot_service of buildbot web resources (AccessorMixin)
+    def __init__(self, authz):
+        self.authz = authz
+
+
+class FakeSite(object):
+    def __init__(self, authz):
+        self.buildbot_service = FakeWebStatus(authz)
+
+
+class FakeRequest(object):
+    # enough for ApiData, without HTTP
+    def __init__(self, authz=None):
+        self.args = {}
+        self.site = FakeSite(authz or FakeAuthz())
+
+
+def makePullRequestInfo(prid):
+    # typical size of the 'info' blob
+    return dict(labels=['category: core', 'feature'], mergeable=True, comments=prid % 7,
+                reviewers=['reviewer%d' % (prid % 5)], milestone='4.%d' % (prid % 3),
+                body='Pull request %d: ' % prid + 'x' * 200)
+
+
+@defer.inlineCallbacks
+def populate(ctx, prs):
+    '''
+    Inserts 'prs' active pull requests with a build status on every builder (core inserts),
+    then reloads the snapshot
+    '''
+    db = ctx.db
+    yield database.Builder.startup(ctx)
+    builders = yield db.bcc.getActiveBuilders()
+    bids = sorted(b.bid for b in builders)
+    statuses = [BuildStatus.INQUEUE, BuildStatus.SCHEDULED, BuildStatus.BUILDING,
+                BuildStatus.SUCCESS, BuildStatus.WARNINGS, BuildStatus.FAILURE]
+    updated = datetime.datetime.utcnow() - datetime.timedelta(days=1)  # before 'changed_since' of the tests
+    def fn(session):
+        prRows = []
+        statusRows = []
+        for prid in range(1, prs + 1):
+            sha = '%040x' % prid
+            prRows.append(dict(prid=prid, branch='master', author='author%d' % (prid % 50), assignee=None,
+                               head_user='user%d' % prid, head_repo='repo', head_branch='branch%d' % prid,
+                               head_sha=sha, _jsoninfo=json.dumps(makePullRequestInfo(prid)),
+                               title='PR %d' % prid, description='Description of PR %d' % prid,
+                               priority=prid % 3, status=0, created_at=updated, updated_at=updated))
+            for i, bid in enumerate(bids):
+                statusRows.append(dict(prid=prid, bid=bid, head_sha=sha, brid=prid * 100 + i, build_number=prid,
+                                       status=statuses[(prid + i) % len(statuses)], active=True,
+                                       created_at=updated, updated_at=updated))
+        if prRows:
+            session.execute(database.Pullrequest.__table__.insert(), [_toColumns(database.Pullrequest, row) for row in prRows])
+        if statusRows:
+            session.execute(database.Status.__table__.insert(), [_toColumns(database.Status, row) for row in statusRows])
+        session.commit()
+        db.snapshot.reload(session)
+    yield db.asyncRun(fn)
+
+
+def _toColumns(model, row):
+    # model attributes -> table columns (Pullrequest.prid is 'id' column)
+    return dict((getattr(model, k).property.columns[0].key, v) for k, v in row.items())
+
+
+def measure(fn, repeat=3):
+    # (best wall time of 'repeat' runs in seconds, result of the last run)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return (best, result)
+
+
+def getLatencyStats(latencies):
+    # seconds -> dict of milliseconds
+    if not latencies:
+        return dict(count=0, mean=0, p50=0, p95=0, max=0)
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+    return dict(count=len(latencies), mean=sum(latencies) / len(latencies) * 1000,
+                p50=pick(0.5), p95=pick(0.95), max=latencies[-1] * 1000)
+
+
+def runReactor(fn, *args, **kwargs):
+    '''
+    Runs 'fn' (returns Deferred of the exit code) in the reactor, returns the exit code
+    '''
+    result = []
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            res = yield fn(*args, **kwargs)
+            result.append(res or 0)
+        except:
+            log.err()
+            result.append(1)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    return result[0] if result else 1
@@ -0,0 +1,138 @@
+'''
+Load test: HTTP clients hammer /pullrequests while builds finish (status writes of the DB thread)
+
+    python -m pullrequest.tests.load_pullrequests [seconds] [clients] [prs]
+
+Clients load the full page, then poll 'changed_since' delta pages (the delta queries are DB reads).
+Each run is done twice: with reads on the single writer thread (as before the read pool)
+and with reads on the read pool. Reports latencies of the requests, of their DB reads ('read')
+and of the build finish DB jobs ('write').
+'''
+
+import json
+import os
+import random
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from pullrequest.constants import BuildStatus
+from pullrequest.prstatus import PullRequestsResource
+from pullrequest.tests import common
+
+BUILDERS = 10
+WRITERS = 4  # builders finishing builds concurrently
+BUILD_DELAY = 0.1  # seconds between build finishes of a writer
+FULL_RELOAD = 10  # full page after each 10 delta polls
+POLL_DELAY = 0.05  # seconds
+
+
+@defer.inlineCallbacks
+def client(agent, url, until, latencies):
+    # as the web UI: full page, then polls of the changes since the returned high water mark
+    since = None
+    polls = 0
+    while time.time() < until:
+        kind = 'full' if since is None or polls % FULL_RELOAD == 0 else 'delta'
+        query = '?compact=1' + ('&changed_since=%s' % since if kind == 'delta' else '')
+        start = time.time()
+        response = yield agent.request('GET', url + query, Headers({}))
+        body = yield readBody(response)
+        assert response.code == 200, response.code
+        latencies[kind].append(time.time() - start)
+        res = json.loads(body)
+        since = res.get('high_water_mark', time.time() - 10)
+        polls += 1
+        yield deferLater(POLL_DELAY)
+
+
+@defer.inlineCallbacks
+def buildsFinishing(ctx, prs, until, latencies):
+    # DB job of BuilderStatusReceiver.buildFinished()
+    db = ctx.db
+    builders = yield db.bcc.getActiveBuilders()
+    bids = [b.bid for b in builders]
+    while time.time() < until:
+        prid = random.randint(1, prs)
+        bid = random.choice(bids)
+        def fn(session):
+            bstatus = db.scc.getStatusForBuildNumber(prid, bid, prid)
+            if bstatus is None:
+                return
+            bstatus.status = random.choice([BuildStatus.SUCCESS, BuildStatus.WARNINGS, BuildStatus.FAILURE])
+            db.scc.updateStatus(bstatus)
+        start = time.time()
+        yield db.asyncRun(fn)
+        latencies['write'].append(time.time() - start)
+        yield deferLater(BUILD_DELAY)
+
+
+@defer.inlineCallbacks
+def runMode(readPool, seconds, clients, prs):
+    ctx = common.TestContext(builders=BUILDERS)
+    try:
+        yield common.populate(ctx, prs)
+        latencies = dict(full=[], delta=[], read=[], write=[])
+        asyncRead = ctx.db.asyncRead if readPool else ctx.db.asyncRun
+        def timedRead(fn, *args, **kwargs):
+            # DB part of the delta requests
+            start = time.time()
+            d = asyncRead(fn, *args, **kwargs)
+            if not isinstance(d, defer.Deferred):
+                return d  # nested call of the DB thread
+            d.addCallback(lambda res: latencies['read'].append(time.time() - start) or res)
+            return d
+        ctx.db.asyncRead = timedRead
+        root = resource.Resource()
+        root.putChild(ctx.urlpath, PullRequestsResource(context=ctx))
+        site = server.Site(root)
+        site.buildbot_service = common.FakeWebStatus(common.FakeAuthz())
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        url = 'http://127.0.0.1:%d/%s/' % (port.getHost().port, ctx.urlpath)
+        agent = Agent(reactor)
+        until = time.time() + seconds
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')  # render time prints of the resource
+        try:
+            yield defer.gatherResults([client(agent, url, until, latencies) for _ in range(clients)] +
+                                      [buildsFinishing(ctx, prs, until, latencies) for _ in range(WRITERS)],
+                                      consumeErrors=True)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            yield port.stopListening()
+        defer.returnValue(latencies)
+    finally:
+        ctx.cleanup()
+
+
+@defer.inlineCallbacks
+def run(seconds, clients, prs):
+    print 'Pull requests: %d, builders: %d, clients: %d, writers: %d, %ds per mode' % (prs, BUILDERS, clients, WRITERS, seconds)
+    print '%-14s %-6s %8s %10s %10s %10s %10s' % ('reads', 'kind', 'count', 'mean (ms)', 'p50 (ms)', 'p95 (ms)', 'max (ms)')
+    for name, readPool in [('writer thread', False), ('read pool', True)]:
+        latencies = yield runMode(readPool, seconds, clients, prs)
+        for kind in ['full', 'delta', 'read', 'write']:
+            stats = common.getLatencyStats(latencies[kind])
+            print '%-14s %-6s %8d %10.1f %10.1f %10.1f %10.1f' % (name, kind, stats['count'], stats['mean'],
+                                                                 stats['p50'], stats['p95'], stats['max'])
+
+
+def deferLater(delay):
+    d = defer.Deferred()
+    reactor.callLater(delay, d.callback, None)
+    return d
+
+
+def main(args):
+    seconds = int(args[0]) if len(args) > 0 else 10
+    clients = int(args[1]) if len(args) > 1 else 8
+    prs = int(args[2]) if len(args) > 2 else 300
+    return common.runReactor(run, seconds, clients, prs)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
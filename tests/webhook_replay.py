@@ -0,0 +1,247 @@
+'''
+Replay of recorded GitHub/GitLab webhook deliveries (tests/webhooks/*.json) against a local Twisted site
+
+    python -m pullrequest.tests.webhook_replay
+
+The site serves <urlpath>/webhook as WebStatus does, deliveries are signed with the context secret.
+Accepted events go through PullRequestsWatchLoop.updatePullRequestFromWebhook() into the test DB.
+'''
+
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import sys
+from StringIO import StringIO
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from pullrequest import serviceloops, webstatus
+from pullrequest.constants import BuildStatus
+from pullrequest.prstatus import PullRequestsResource
+from pullrequest.tests import common
+
+WEBHOOKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhooks')
+
+SECRET = u'webhook-secret'  # unicode, as it is loaded from JSON/YAML configs
+
+
+class WebhookTestContext(common.TestContext):
+
+    webhookSecret = SECRET
+
+    def updatePullRequests(self):
+        return None  # no full poll
+
+    def getListOfAutomaticBuilders(self, pr):
+        return [b['name'] for b in self.builders.values()]
+
+    def parseWebhookEvent(self, event, payload):
+        if event == 'pull_request':
+            action = payload['action']
+            if action not in ['opened', 'reopened', 'synchronize', 'edited', 'closed']:
+                return None
+            pr = payload['pull_request']
+            if action == 'closed':
+                return (pr['number'], None)
+            head = pr['head']
+            return (pr['number'], dict(id=pr['number'], branch=pr['base']['ref'], author=pr['user']['login'],
+                                       assignee=(pr['assignee'] or {}).get('login', None),
+                                       head_user=head['repo']['owner']['login'], head_repo=head['repo']['name'],
+                                       head_branch=head['ref'], head_sha=head['sha'],
+                                       title=pr['title'], description=pr['body'],
+                                       info=dict(labels=[l['name'] for l in pr['labels']])))
+        if event == 'Merge Request Hook':
+            mr = payload['object_attributes']
+            if mr['state'] != 'opened':
+                return (mr['iid'], None)
+            return (mr['iid'], dict(id=mr['iid'], branch=mr['target_branch'], author=payload['user']['username'],
+                                    assignee=None, head_user=mr['source']['namespace'], head_repo=mr['source']['name'],
+                                    head_branch=mr['source_branch'], head_sha=mr['last_commit']['id'],
+                                    title=mr['title'], description=mr['description'],
+                                    info=dict(labels=[l['title'] for l in payload.get('labels', [])])))
+        return None
+
+
+class RecordingWatchLoop(serviceloops.PullRequestsWatchLoop):
+    # the resource doesn't wait for the update, the replay does
+    def __init__(self, context):
+        serviceloops.PullRequestsWatchLoop.__init__(self, context)
+        self.calls = []  # (prid, pr, deferred)
+
+    def updatePullRequestFromWebhook(self, prid, pr):
+        d = serviceloops.PullRequestsWatchLoop.updatePullRequestFromWebhook(self, prid, pr)
+        self.calls.append((prid, pr, d))
+        return d
+
+
+def loadDelivery(name):
+    with open(os.path.join(WEBHOOKS_DIR, name)) as f:
+        return f.read()
+
+
+def githubHeaders(event, body, secret=SECRET, legacy=False):
+    secret = secret.encode('utf-8')
+    if legacy:
+        signature = 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest()
+        return {'X-GitHub-Event': event, 'X-Hub-Signature': signature}
+    signature = 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return {'X-GitHub-Event': event, 'X-Hub-Signature-256': signature}
+
+
+def gitlabHeaders(event, token=SECRET):
+    return {'X-Gitlab-Event': event, 'X-Gitlab-Token': token.encode('utf-8')}
+
+
+def check(condition, message):
+    if not condition:
+        raise Exception('FAILED: ' + message)
+    print 'OK: ' + message
+
+
+class Replay(object):
+
+    def __init__(self, ctx, url):
+        self.ctx = ctx
+        self.url = url
+        self.agent = Agent(reactor)
+
+    @defer.inlineCallbacks
+    def post(self, body, headers, method='POST'):
+        '''
+        Sends the delivery, waits for the started PR update. Returns (HTTP code, response, webhook calls)
+        '''
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        watchLoop = self.ctx.watchLoop
+        first = len(watchLoop.calls)
+        response = yield self.agent.request(method, self.url,
+                                            Headers(dict((k, [v]) for k, v in headers.items())),
+                                            FileBodyProducer(StringIO(body)) if body is not None else None)
+        data = yield readBody(response)
+        calls = watchLoop.calls[first:]
+        for _, _, d in calls:
+            yield d
+        defer.returnValue((response.code, json.loads(data), [(prid, pr) for prid, pr, _ in calls]))
+
+    @defer.inlineCallbacks
+    def getPullRequest(self, prid):
+        db = self.ctx.db
+        pr = yield db.prcc.getPullRequest(prid)
+        statuses = yield db.scc.getStatusesForPullRequest(prid)
+        defer.returnValue((pr, [s for s in statuses if s.active]))
+
+
+@defer.inlineCallbacks
+def run():
+    ctx = WebhookTestContext(builders=3)
+    try:
+        yield common.populate(ctx, 0)
+        watchLoop = RecordingWatchLoop(ctx)
+        yield watchLoop.start()
+
+        # <urlpath>/webhook, as WebStatus.setupUsualPages() does
+        prResource = PullRequestsResource(context=ctx)
+        prResource.putChild('webhook', webstatus.WebhookResource(ctx))
+        root = resource.Resource()
+        root.putChild(ctx.urlpath, prResource)
+        site = server.Site(root)
+        site.buildbot_service = common.FakeWebStatus(common.FakeAuthz())
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        replay = Replay(ctx, 'http://127.0.0.1:%d/%s/webhook' % (port.getHost().port, ctx.urlpath))
+        try:
+            yield checkDeliveries(ctx, replay)
+        finally:
+            yield port.stopListening()
+            watchLoop.stop()
+    finally:
+        ctx.cleanup()
+
+
+@defer.inlineCallbacks
+def checkDeliveries(ctx, replay):
+    builders = len(ctx.builders)
+
+    body = loadDelivery('github_ping.json')
+    code, res, calls = yield replay.post(body, githubHeaders('ping', body))
+    check(code == 200 and res['message'] == 'pong' and not calls, 'ping: pong')
+
+    body = loadDelivery('github_pull_request_opened.json')
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body))
+    check(code == 200 and res == dict(message='accepted', id=101) and [prid for prid, _ in calls] == [101],
+          'pull_request opened: accepted')
+    pr, statuses = yield replay.getPullRequest(101)
+    check(pr is not None and pr.status == 0 and pr.head_sha == '1' * 40 and pr.author == 'contributor'
+          and pr.title == u'Fix r\xe9sum\xe9 parsing of the calib3d options'
+          and pr.info['labels'] == ['category: calib3d'], 'pull_request opened: pull request is stored')
+    check(len(statuses) == builders and all(s.status == BuildStatus.INQUEUE and s.head_sha == '1' * 40 for s in statuses),
+          'pull_request opened: builds are queued on all builders')
+    check(101 in ctx.db.snapshot.pullrequests, 'pull_request opened: snapshot is updated')
+
+    # deliveries of old hooks have the SHA-1 signature only
+    body = loadDelivery('github_pull_request_synchronize.json')
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body, legacy=True))
+    check(code == 200 and [prid for prid, _ in calls] == [101], 'pull_request synchronize (X-Hub-Signature): accepted')
+    pr, statuses = yield replay.getPullRequest(101)
+    check(pr.head_sha == '2' * 40 and pr.assignee == 'reviewer', 'pull_request synchronize: pull request is updated')
+    check(len(statuses) == builders and all(s.status == BuildStatus.INQUEUE and s.head_sha == '2' * 40 for s in statuses),
+          'pull_request synchronize: builds of the old commit are replaced')
+
+    body = loadDelivery('github_pull_request_labeled.json')
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body))
+    check(code == 200 and res['message'] == 'ignored' and not calls, 'pull_request labeled: ignored')
+
+    body = loadDelivery('github_pull_request_closed.json')
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body, secret=u'other-secret'))
+    check(code == 403 and not calls, 'pull_request closed with wrong signature: 403')
+    headers = githubHeaders('pull_request', body)
+    del headers['X-Hub-Signature-256']
+    code, res, calls = yield replay.post(body, headers)
+    check(code == 403 and not calls, 'pull_request closed without signature: 403')
+    pr, statuses = yield replay.getPullRequest(101)
+    check(pr.status == 0 and len(statuses) == builders, 'rejected deliveries don\'t change the pull request')
+
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body))
+    check(code == 200 and calls == [(101, None)], 'pull_request closed: accepted')
+    pr, statuses = yield replay.getPullRequest(101)
+    check(pr.status < 0 and not statuses, 'pull_request closed: pull request is inactive, queued builds are canceled')
+    check(101 not in ctx.db.snapshot.pullrequests, 'pull_request closed: removed from the snapshot')
+
+    body = loadDelivery('gitlab_merge_request_open.json')
+    code, res, calls = yield replay.post(body, gitlabHeaders('Merge Request Hook', token=u'wrong'))
+    check(code == 403 and not calls, 'GitLab merge request with wrong token: 403')
+    code, res, calls = yield replay.post(body, gitlabHeaders('Merge Request Hook'))
+    check(code == 200 and res == dict(message='accepted', id=7), 'GitLab merge request (X-Gitlab-Token): accepted')
+    pr, statuses = yield replay.getPullRequest(7)
+    check(pr is not None and pr.head_sha == '4' * 40 and pr.head_user == 'glcontributor' and len(statuses) == builders,
+          'GitLab merge request: pull request is stored, builds are queued')
+
+    # sweep of the PR list which was fetched before the webhook update
+    stale = dict(id=7, branch='master', author='glcontributor', assignee=None, head_user='glcontributor',
+                 head_repo='project', head_branch='fix', head_sha='3' * 40, title='Old title', description='', info={})
+    fetchStarted = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+    changed, deactivated = yield ctx.db.asyncRun(ctx.watchLoop._reconcilePullRequests, [stale], fetchStarted)
+    pr, statuses = yield replay.getPullRequest(7)
+    check(not changed and not deactivated and pr.head_sha == '4' * 40 and pr.status >= 0,
+          'sweep fetched before the webhook update doesn\'t revert the pull request')
+    changed, deactivated = yield ctx.db.asyncRun(ctx.watchLoop._reconcilePullRequests, [stale],
+                                                 datetime.datetime.utcnow())
+    pr, statuses = yield replay.getPullRequest(7)
+    check(changed == [(7, '3' * 40, '4' * 40)] and pr.head_sha == '3' * 40,
+          'sweep fetched after the webhook update is applied')
+
+    body = 'not a JSON'
+    code, res, calls = yield replay.post(body, githubHeaders('pull_request', body))
+    check(code == 400 and not calls, 'signed delivery with invalid JSON: 400')
+    code, res, calls = yield replay.post(None, {}, method='GET')
+    check(code == 400 and not calls, 'GET request: 400')
+
+
+def main():
+    return common.runReactor(run)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -97,6 +97,28 @@ class CacheFunction(object):
         return decorator
 
 
+class ResponseCache(object):
+    '''
+    Bounded LRU cache of rendered responses, each entry is valid for one data version only
+    '''
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.cache = collections.OrderedDict()
+
+    def get(self, key, version):
+        e = self.cache.pop(key, None)
+        if e is None or e[0] != version:
+            return None
+        self.cache[key] = e
+        return e[1]
+
+    def put(self, key, version, value):
+        self.cache.pop(key, None)
+        self.cache[key] = (version, value)
+        while len(self.cache) > self.maxEntries:
+            self.cache.popitem(last=False)
+
+
 import json, urllib, urllib2
 
 from twisted.web.client import Agent, readBody  
@@ -1,3 +1,7 @@
+import hashlib
+import hmac
+import json
+import logging
 import os.path
 
 from twisted.python import log
@@ -11,7 +15,9 @@ from buildbot.status.web.base import AccessorMixin
 from buildbot.status.web.base import StaticFile
 from .prstatus import PullRequestsResource
 from .prstatus import JsonResource
-from .utils import NotFound
+from .utils import NotFound, Forbidden, Conflict, BadRequest
+
+logger = logging.getLogger(__package__)
 
 class WebStatus(baseweb.WebStatus):
 
@@ -22,7 +28,13 @@ class WebStatus(baseweb.WebStatus):
     def setupUsualPages(self, numbuilds, num_events, num_events_max):
         baseweb.WebStatus.setupUsualPages(self, numbuilds, num_events, num_events_max)
         for context in self.pullrequests:
-            self.putChild(context.urlpath, PullRequestsResource(context=context))
+            prResource = PullRequestsResource(context=context)
+            if context.webhookSecret is not None:
+                prResource.putChild('webhook', WebhookResource(context))
+            # 'prShowDBStats' authz action, e.g. account.Authz(..., prShowDBStats='auth')
+            prResource.putChild('dbstats', DBStatsResource(context))
+            prResource.putChild('metrics', MetricsResource(context))
+            self.putChild(context.urlpath, prResource)
         pullrequest_ui_dir = 'pullrequest_ui/src'
         if os.path.exists(os.path.join(os.path.dirname(__file__), '../pullrequest_ui/dist')):
             pullrequest_ui_dir = 'pullrequest_ui/dist'
@@ -75,3 +87,151 @@ class AuthInfoResource(JsonResource, AccessorMixin):
         else:
             raise NotFound('Not authorized')
         defer.returnValue(res)
+
+
+def _toStr(v):
+    # hmac in Python 2 doesn't accept unicode values (the secret may come from a JSON/YAML config)
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return str(v)
+
+def verifyWebhookSignature(secret, request, body):
+    secret = _toStr(secret)
+    signature = request.getHeader('X-Hub-Signature-256')
+    if signature is not None:
+        expected = 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, _toStr(signature))
+    signature = request.getHeader('X-Hub-Signature')
+    if signature is not None:
+        expected = 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest()
+        return hmac.compare_digest(expected, _toStr(signature))
+    token = request.getHeader('X-Gitlab-Token')  # GitLab doesn't sign payloads
+    if token is not None:
+        return hmac.compare_digest(secret, _toStr(token))
+    return False
+
+
+# GitHub 'pull_request' / GitLab 'Merge Request Hook' events
+class WebhookResource(JsonResource):
+    isLeaf = True
+
+    def __init__(self, context):
+        JsonResource.__init__(self)
+        self.context = context
+
+    def asDict(self, request):
+        if request.method != 'POST':
+            raise BadRequest('POST request is expected')
+        request.content.seek(0)
+        body = request.content.read()
+        if not verifyWebhookSignature(self.context.webhookSecret, request, body):
+            logger.info('Webhook signature check failed: %s' % request.uri)
+            raise Forbidden('Invalid signature')
+
+        event = request.getHeader('X-GitHub-Event') or request.getHeader('X-Gitlab-Event')
+        if event == 'ping':
+            return dict(message='pong')
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise BadRequest('Invalid JSON payload')
+
+        res = self.context.parseWebhookEvent(event, payload)
+        if res is None:
+            return dict(message='ignored')
+        watchLoop = self.context.watchLoop
+        if watchLoop is None:
+            raise Conflict('Pull request service is not running')
+        prid, pr = res
+        # Reply without waiting for builds rescheduling, webhook senders have short timeouts
+        watchLoop.updatePullRequestFromWebhook(prid, pr)
+        return dict(message='accepted', id=prid)
+
+
+# DB jobs instrumentation (database.DBStats)
+class DBStatsResource(JsonResource):
+    isLeaf = True
+    requiredAuthAction = 'prShowDBStats'
+
+    def __init__(self, context):
+        JsonResource.__init__(self)
+        self.context = context
+
+    def asDict(self, request):
+        thread = self.context.thread
+        return dict(operations=self.context.db.stats.asDict(),
+                    commits=thread.getCommitStats(),
+                    handoffs=thread.handoffs,
+                    queue_depth=thread.getQueueDepth())
+
+
+def _escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Prometheus text format of DBStatsResource data
+class MetricsResource(resource.Resource, AccessorMixin):
+    isLeaf = True
+    requiredAuthAction = 'prShowDBStats'
+
+    metrics = [('queue', 'pullrequest_db_queue_seconds', 'Wait time of DB jobs in the DB thread queue'),
+               ('execute', 'pullrequest_db_execute_seconds', 'Execution time of DB jobs'),
+               ('commit', 'pullrequest_db_commit_seconds', 'Commit time of DB jobs'),
+               ('rows', 'pullrequest_db_rows', 'Result rows of DB jobs')]
+
+    def __init__(self, context):
+        resource.Resource.__init__(self)
+        self.context = context
+
+    def render_GET(self, request):
+        @defer.inlineCallbacks
+        def handle():
+            try:
+                try:
+                    authz = self.getAuthz(request)
+                    allowed = yield defer.maybeDeferred(authz.actionAllowed, self.requiredAuthAction, request)
+                    if allowed:
+                        request.setHeader('content-type', 'text/plain; version=0.0.4')
+                        data = self.getMetrics()
+                    else:
+                        logger.info("Auth action '%s' is not allowed: %s" % (self.requiredAuthAction, request.uri))
+                        request.setResponseCode(403)
+                        data = 'Not allowed: %s\n' % request.uri
+                except Exception as e:
+                    log.err()
+                    request.setResponseCode(500)
+                    data = '%s\n' % e
+                request.write(data)
+                request.finish()
+            except Exception as e:
+                request.processingFailed(Failure(e))
+                return
+        defer.maybeDeferred(handle)
+        return server.NOT_DONE_YET
+
+    def getMetrics(self):
+        thread = self.context.thread
+        operations = self.context.db.stats.asDict()
+        ctx = 'context="%s"' % _escapeLabel(self.context.name)
+        lines = []
+        for key, name, description in self.metrics:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s histogram' % name)
+            for operation in sorted(operations.keys()):
+                h = operations[operation][key]
+                labels = '%s,operation="%s"' % (ctx, _escapeLabel(operation))
+                for bound, count in h['buckets']:
+                    le = '+Inf' if bound is None else repr(float(bound))
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, count))
+                lines.append('%s_sum{%s} %r' % (name, labels, float(h['sum'])))
+                lines.append('%s_count{%s} %d' % (name, labels, h['count']))
+        lines.append('# HELP pullrequest_db_commits_total Commits of DB jobs')
+        lines.append('# TYPE pullrequest_db_commits_total counter')
+        for operation, st in sorted(thread.getCommitStats().items()):
+            lines.append('pullrequest_db_commits_total{%s,operation="%s"} %d' % (ctx, _escapeLabel(operation), st['commits']))
+        lines.append('# HELP pullrequest_db_handoffs_total DB jobs passed to the DB thread')
+        lines.append('# TYPE pullrequest_db_handoffs_total counter')
+        lines.append('pullrequest_db_handoffs_total{%s} %d' % (ctx, thread.handoffs))
+        lines.append('# HELP pullrequest_db_queue_depth DB jobs waiting in the DB thread queue')
+        lines.append('# TYPE pullrequest_db_queue_depth gauge')
+        lines.append('pullrequest_db_queue_depth{%s} %d' % (ctx, thread.getQueueDepth()))
+        return '\n'.join(lines) + '\n'